@@ -0,0 +1,129 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Correctness checks of the training pipeline on synthetic data.
+
+    python benchmarks/checks.py
+    python benchmarks/checks.py resume
+
+Runs the named checks, all by default, with the small random BERT and the
+synthetic NER data of benchmarks/pipeline.py. A failing check raises an
+AssertionError and the script exits with status 1.
+
+resume: a run resumed from a checkpoint in the middle of an epoch and from
+one at the end of an epoch ends with the same weights as the uninterrupted
+run, dropout included.
+
+tokenization: FastBertTokenizer gives the same wordpieces and ids as
+BertTokenizer on the synthetic corpus of benchmarks/tokenization.py, cased
+and uncased.
+"""
+
+import os
+import sys
+import glob
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import Pipeline
+
+
+def check_resume(pipeline):
+    import torch
+    from utils.checkpoint import load_checkpoint
+
+    fit_args = {'num_epochs': 2, 'learning_rate': 1e-3, 'gradient_accumulation_steps': 2}
+    checkpoint_dir = tempfile.mkdtemp(prefix='resume-check-')
+    try:
+        trainer = pipeline.trainer()
+        trainer.fit(checkpoint_dir=checkpoint_dir, checkpoint_interval=3, keep_last=1000, **fit_args)
+        expected = trainer.model.state_dict()
+
+        positions = {}
+        for path in sorted(glob.glob(os.path.join(checkpoint_dir, 'checkpoint-*.pt'))):
+            checkpoint = load_checkpoint(path)
+            if checkpoint['epoch'] < fit_args['num_epochs']:
+                positions.setdefault('end of epoch' if checkpoint['batch'] == 0 else 'mid-epoch', path)
+        assert set(positions) == {'mid-epoch', 'end of epoch'}, "No checkpoints at {}".format(
+            {'mid-epoch', 'end of epoch'} - set(positions))
+
+        for position, path in sorted(positions.items()):
+            resumed = pipeline.trainer()
+            # The resumed run has to restore the random state, not inherit it
+            torch.manual_seed(pipeline.args.seed + 1)
+            resumed.fit(resume_from=path, **fit_args)
+            differences = [name for name, value in resumed.model.state_dict().items()
+                           if not torch.equal(value, expected[name])]
+            assert not differences, "Resuming {} from {} changed {} of the weights, e.g. {}".format(
+                position, os.path.basename(path), len(differences), differences[0])
+            print("resume: {} checkpoint {} reproduces the run".format(position, os.path.basename(path)))
+    finally:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+def check_tokenization(pipeline):
+    from utils.tokenization import FastBertTokenizer
+    from tokenization import synthetic_vocab, synthetic_corpus
+
+    directory = tempfile.mkdtemp(prefix='tokenization-check-')
+    try:
+        vocab_file = os.path.join(directory, 'vocab.txt')
+        synthetic_vocab(vocab_file)
+        texts = synthetic_corpus(2000, seed=pipeline.args.seed)
+        for do_lower_case in (True, False):
+            FastBertTokenizer(vocab_file, do_lower_case=do_lower_case).check_parity(texts)
+            print("tokenization: {} texts tokenized identically, do_lower_case={}".format(len(texts), do_lower_case))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+CHECKS = {'resume': check_resume, 'tokenization': check_tokenization}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('checks', nargs='*', help='checks to run, all by default: {}'.format(', '.join(sorted(CHECKS))))
+    parser.add_argument('--examples', type=int, default=200)
+    parser.add_argument('--max-seq-length', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--hidden-size', type=int, default=32)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error("unknown checks {}".format(', '.join(sorted(unknown))))
+
+    pipeline = Pipeline(args)
+    failed = []
+    try:
+        for name in args.checks or sorted(CHECKS):
+            try:
+                CHECKS[name](pipeline)
+            except AssertionError as e:
+                print("FAIL {}: {}".format(name, e))
+                failed.append(name)
+    finally:
+        shutil.rmtree(pipeline.directory, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+    print("OK: {}".format(', '.join(args.checks or sorted(CHECKS))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" End to end distillation of a small random BERT on synthetic data, on CPU.
+
+    python benchmarks/distillation.py --task ner --teacher-layers 4 --student-layers 2
+    python benchmarks/distillation.py --task classification --student-hidden-size 32
+
+The labels are a function of the wordpiece ids, so the teacher learns them
+in a few epochs of fine-tuning. The student is created from the teacher
+with utils.distillation.create_student, trained with DistillationTrainer
+and compared with the teacher in F1, CPU latency and size.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.datasets import bucketed_dataloader
+from utils.distillation import DistillationTrainer, create_student
+from utils.processors import NERProcessor
+from utils.sinks import MetricsSink, NullBackend
+
+
+class SyntheticDataset(TensorDataset):
+    def lengths(self):
+        return self.tensors[1].sum(1).tolist()
+
+
+def synthetic_dataset(task, num_examples, max_seq_length, vocab_size, seed=0):
+    """ NER labels O, B_COMP and I_COMP by wordpiece id, or a sentence label by the parity of the first wordpiece """
+    rng = np.random.RandomState(seed)
+    lengths = np.clip(rng.lognormal(np.log(20), 0.4, num_examples).astype(int), 4, max_seq_length)
+    input_ids = np.zeros((num_examples, max_seq_length), dtype=np.int64)
+    input_mask = np.zeros_like(input_ids)
+    for i, length in enumerate(lengths):
+        input_ids[i, :length] = rng.randint(5, vocab_size, length)
+        input_mask[i, :length] = 1
+    if task == 'ner':
+        label_ids = (3 + input_ids % 3) * input_mask
+    else:
+        label_ids = input_ids[:, 1] % 2
+    tensors = [torch.from_numpy(a) for a in (input_ids, input_mask, np.zeros_like(input_ids), label_ids)]
+    return SyntheticDataset(*tensors)
+
+
+def fine_tune(model, dataloader, epochs, learning_rate=1e-3):
+    """ Plain fine-tuning of the teacher on the hard labels """
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    model.train()
+    for _ in range(epochs):
+        for input_ids, input_mask, segment_ids, label_ids in dataloader:
+            logits = model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
+            if logits.dim() == 3:
+                active = input_mask.view(-1) != 0
+                loss = torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1))[active],
+                                                         label_ids.view(-1)[active])
+            else:
+                loss = torch.nn.functional.cross_entropy(logits, label_ids)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+    return model.eval()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--task', default='ner', choices=['ner', 'classification'])
+    parser.add_argument('--examples', type=int, default=2000)
+    parser.add_argument('--max-seq-length', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--teacher-layers', type=int, default=4)
+    parser.add_argument('--teacher-epochs', type=int, default=3)
+    parser.add_argument('--student-layers', type=int, default=2)
+    parser.add_argument('--student-hidden-size', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=3)
+    parser.add_argument('--learning-rate', type=float, default=1e-3)
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--alpha', type=float, default=0.5)
+    parser.add_argument('--output', default=None, help='write the report to this JSON file')
+    args = parser.parse_args()
+
+    from pytorch_pretrained_bert.modeling import BertConfig, BertForTokenClassification, BertForSequenceClassification
+    torch.manual_seed(0)
+    vocab_size = 1000
+    label_list = NERProcessor.label_list if args.task == 'ner' else ['0', '1']
+    config = BertConfig(vocab_size, hidden_size=args.hidden_size, num_hidden_layers=args.teacher_layers,
+                        num_attention_heads=4, intermediate_size=args.hidden_size * 4,
+                        max_position_embeddings=args.max_seq_length)
+    model_class = BertForTokenClassification if args.task == 'ner' else BertForSequenceClassification
+    teacher = model_class(config, len(label_list))
+
+    train = synthetic_dataset(args.task, args.examples, args.max_seq_length, vocab_size)
+    valid = synthetic_dataset(args.task, max(args.examples // 5, 64), args.max_seq_length, vocab_size, seed=1)
+    train_dataloader = bucketed_dataloader(train, batch_size=args.batch_size)
+    valid_dataloader = bucketed_dataloader(valid, batch_size=args.batch_size, shuffle=False)
+
+    fine_tune(teacher, train_dataloader, args.teacher_epochs)
+    student = create_student(teacher, num_hidden_layers=args.student_layers, hidden_size=args.student_hidden_size)
+    trainer = DistillationTrainer(teacher, student, train_dataloader, valid_dataloader, label_list, task=args.task,
+                                  temperature=args.temperature, alpha=args.alpha, writer=MetricsSink(NullBackend()),
+                                  device=torch.device('cpu'))
+    trainer.fit(num_epochs=args.epochs, learning_rate=args.learning_rate)
+    report = trainer.report()
+
+    print("{:8s} {:>8s} {:>12s} {:>9s} {:>12s}".format('model', 'F1', 'parameters', 'p50 ms', 'examples/s'))
+    for name in ('teacher', 'student'):
+        result = report[name]
+        print("{:8s} {:8.4f} {:12d} {:9.2f} {:12.1f}".format(
+            name, result['f1_score'], result['parameters'], result['p50_ms'], result['examples_per_second']))
+    print("student: {:.1%} of the teacher F1, {:.2f}x faster, {:.1%} of the parameters".format(
+        report['relative_f1'], report['speedup'], report['size_ratio']))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
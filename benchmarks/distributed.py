@@ -0,0 +1,108 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Distributed NERTrainer throughput on synthetic data.
+
+One run, launched with torchrun, gloo on CPU and nccl on GPU:
+
+    torchrun --standalone --nproc_per_node 4 benchmarks/distributed.py --examples 4000
+
+Scaling table over several process counts, every process using
+--threads threads:
+
+    python benchmarks/distributed.py --scaling 1,2,4 --examples 4000
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from packing import synthetic_dataset
+from utils.distributed import init_distributed, distributed_dataloader, get_world_size, is_main_process
+from utils.processors import NERProcessor
+from utils.sinks import MetricsSink, NullBackend
+from utils.train import NERTrainer
+
+
+def run(args):
+    from pytorch_pretrained_bert.modeling import BertConfig, BertForTokenClassification
+    torch.set_num_threads(args.threads)
+    init_distributed()
+    label_list = NERProcessor.label_list
+    vocab_size = 1000
+    config = BertConfig(vocab_size, hidden_size=args.hidden_size, num_hidden_layers=args.layers,
+                        num_attention_heads=2, intermediate_size=args.hidden_size * 2,
+                        max_position_embeddings=args.max_seq_length)
+    torch.manual_seed(0)
+    model = BertForTokenClassification(config, len(label_list))
+    train = synthetic_dataset(args.examples, args.max_seq_length, vocab_size, len(label_list))
+    valid = synthetic_dataset(64, args.max_seq_length, vocab_size, len(label_list), seed=1)
+
+    trainer = NERTrainer(model, distributed_dataloader(train, args.batch_size),
+                         distributed_dataloader(valid, args.batch_size, train=False),
+                         label_list, writer=MetricsSink(NullBackend()))
+    start = time.perf_counter()
+    trainer.fit(num_epochs=args.epochs, learning_rate=1e-4)
+    elapsed = time.perf_counter() - start
+    if is_main_process():
+        result = {'processes': get_world_size(), 'seconds': elapsed,
+                  'samples_per_second': args.examples * args.epochs / elapsed}
+        print('RESULT ' + json.dumps(result))
+
+
+def scaling(args):
+    forwarded = [a for a in sys.argv[1:] if not a.startswith('--scaling') and a != args.scaling]
+    results = []
+    for processes in [int(n) for n in args.scaling.split(',')]:
+        command = [sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node',
+                   str(processes), os.path.abspath(__file__)] + forwarded
+        output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        line = [l for l in output.splitlines() if l.startswith('RESULT ')][-1]
+        results.append(json.loads(line[len('RESULT '):]))
+
+    base = results[0]['samples_per_second'] / results[0]['processes']
+    print("{:>9s} {:>12s} {:>8s} {:>10s}".format('processes', 'samples/s', 'speedup', 'efficiency'))
+    for result in results:
+        speedup = result['samples_per_second'] / base
+        print("{:9d} {:12.1f} {:8.2f} {:10.1%}".format(
+            result['processes'], result['samples_per_second'], speedup, speedup / result['processes']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scaling', default=None, help='comma separated process counts, e.g. 1,2,4')
+    parser.add_argument('--examples', type=int, default=2000)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--max-seq-length', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--hidden-size', type=int, default=128)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=1, help='torch threads of every process')
+    args = parser.parse_args()
+    if args.scaling:
+        scaling(args)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Recall and latency of exact and IVF search over an EmbeddingStore.
+
+    python benchmarks/embeddings.py --vectors 200000 --dim 768 --num-lists 512 --nprobe 1,4,16,64
+    python benchmarks/embeddings.py --store embeddings/ --queries 200
+
+Without --store a store of clustered random unit vectors is written to a
+temporary directory. Queries are perturbed store vectors. Recall@k is the
+share of the exact top k that IVFIndex returns. --extract N first embeds N
+synthetic sentences with a small random BERT through extract_embeddings,
+interrupting and resuming it half way, and reports examples per second.
+"""
+
+import os
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.embeddings import EmbeddingStore, IVFIndex, exact_search, extract_embeddings
+
+
+def clustered_vectors(num_vectors, dim, num_clusters=256, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(num_clusters, dim))
+    vectors = centers[rng.randint(num_clusters, size=num_vectors)] + 0.5 * rng.normal(size=(num_vectors, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float16)
+
+
+def fill_store(store, num_vectors, block_size=50000):
+    for start in range(0, num_vectors, block_size):
+        count = min(block_size, num_vectors - start)
+        store.add(['v-{}'.format(start + i) for i in range(count)],
+                  clustered_vectors(count, store.dim, seed=start))
+
+
+def extraction(directory, num_examples, batch_size):
+    """ Examples per second of extract_embeddings, interrupted after half of the examples and resumed """
+    import torch
+    from pytorch_pretrained_bert import BertTokenizer
+    from pytorch_pretrained_bert.modeling import BertConfig, BertModel
+    from utils.processors import InputExample
+    words = ("vi erbjuder en spännande tjänst hos oss på arbetsförmedlingen i stockholm välkommen med din "
+             "ansökan volvo ikea systemutvecklare göteborg säljare").split()
+    vocab_file = os.path.join(directory, 'vocab.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + words) + '\n')
+    tokenizer = BertTokenizer(vocab_file)
+    torch.manual_seed(0)
+    model = BertModel(BertConfig(len(tokenizer.vocab), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                                 intermediate_size=128, max_position_embeddings=128))
+    rng = random.Random(0)
+    examples = [InputExample('ad-{}'.format(i), ' '.join(rng.choice(words) for _ in range(rng.randint(5, 60))))
+                for i in range(num_examples)]
+    store = EmbeddingStore(os.path.join(directory, 'extracted'), dim=64)
+    start = time.perf_counter()
+    extract_embeddings(model, examples[:num_examples // 2], tokenizer, store, batch_size=batch_size,
+                       chunk_size=1024)
+    # A new run over all examples skips the ones already in the store
+    store = EmbeddingStore(os.path.join(directory, 'extracted'))
+    added = extract_embeddings(model, examples, tokenizer, store, batch_size=batch_size, chunk_size=1024)
+    seconds = time.perf_counter() - start
+    assert len(store) == num_examples and added == num_examples - num_examples // 2
+    print("extraction: {} examples, {:.1f} examples/s".format(num_examples, num_examples / seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--store', default=None, help='existing EmbeddingStore directory')
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--num-lists', type=int, default=256)
+    parser.add_argument('--nprobe', default='1,4,16,32', help='comma separated nprobe values')
+    parser.add_argument('--block-size', type=int, default=65536)
+    parser.add_argument('--extract', type=int, default=0, help='number of sentences to embed first')
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='embeddings-benchmark-')
+    try:
+        if args.extract:
+            extraction(directory, args.extract, args.batch_size)
+        if args.store:
+            store = EmbeddingStore(args.store)
+        else:
+            store = EmbeddingStore(os.path.join(directory, 'store'), dim=args.dim)
+            fill_store(store, args.vectors)
+        vectors = store.vectors
+        rng = np.random.RandomState(1)
+        queries = vectors[rng.randint(len(vectors), size=args.queries)].astype(np.float32)
+        queries += 0.1 * rng.normal(size=queries.shape).astype(np.float32)
+
+        start = time.perf_counter()
+        _, exact = exact_search(vectors, queries, args.k, args.block_size)
+        exact_ms = 1000.0 * (time.perf_counter() - start) / len(queries)
+
+        start = time.perf_counter()
+        index = IVFIndex(args.num_lists).train(vectors)
+        train_seconds = time.perf_counter() - start
+        print("{} vectors of size {}, {} lists trained in {:.1f}s".format(len(vectors), store.dim, index.num_lists,
+                                                                         train_seconds))
+        print("{:12s} {:>10s} {:>12s}".format('search', 'recall@{}'.format(args.k), 'ms/query'))
+        print("{:12s} {:10.3f} {:12.3f}".format('exact', 1.0, exact_ms))
+        for nprobe in [int(n) for n in args.nprobe.split(',')]:
+            start = time.perf_counter()
+            _, approximate = index.search(vectors, queries, args.k, nprobe)
+            ms = 1000.0 * (time.perf_counter() - start) / len(queries)
+            recall = np.mean([len(set(a) & set(e)) / float(args.k) for a, e in zip(approximate, exact)])
+            print("{:12s} {:10.3f} {:12.3f}".format('ivf/{}'.format(nprobe), recall, ms))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
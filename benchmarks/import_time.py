@@ -0,0 +1,76 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Guards `import utils` against import-time regressions.
+
+Imports the package in fresh interpreters, reports the wall time and peak RSS
+of the import on top of `import torch`, and fails when a heavy optional
+dependency is loaded eagerly or the overhead exceeds --max-seconds.
+
+    python benchmarks/import_time.py --repeat 5 --max-seconds 0.5
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+HEAVY_MODULES = ['tensorflow', 'apex', 'tensorboardX', 'fastprogress', 'seqeval', 'sklearn', 'pandas']
+
+PROBE = """
+import json, sys, time, resource
+import torch
+start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import utils
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'seconds': elapsed, 'rss_kb': rss - start_rss,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+def measure(repo_root):
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=repo_root)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=0.5,
+                        help='maximum median import time of utils on top of torch')
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [measure(repo_root) for _ in range(args.repeat)]
+    seconds = sorted(run['seconds'] for run in runs)[len(runs) // 2]
+    loaded = sorted(set(m for run in runs for m in run['loaded']))
+    result = {'median_seconds': seconds, 'max_rss_kb': max(run['rss_kb'] for run in runs), 'heavy_modules': loaded}
+    print(json.dumps(result, indent=2))
+
+    failed = False
+    if loaded:
+        print("FAIL: heavy modules imported eagerly: {}".format(', '.join(loaded)))
+        failed = True
+    if seconds > args.max_seconds:
+        print("FAIL: import utils took {:.3f}s, limit is {:.3f}s".format(seconds, args.max_seconds))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
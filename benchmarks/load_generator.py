@@ -0,0 +1,161 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Load generator for utils.serving measuring p50/p99 latency against throughput.
+
+Every concurrency level runs for --duration seconds with that many clients,
+each sending one sentence at a time over a keep-alive connection.
+
+    python -m utils.serving --model-dir model/ --port 8080 &
+    python benchmarks/load_generator.py --port 8080 --concurrency 1,4,16,64
+
+With --tiny the script starts a local server with a small randomly
+initialised BERT, so no model download or GPU is needed.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SENTENCES = [
+    "vi erbjuder en spännande tjänst hos oss på arbetsförmedlingen i stockholm",
+    "välkommen med din ansökan",
+    "vi söker en systemutvecklare till volvo i göteborg",
+    "ikea söker säljare till varuhuset i malmö med start i augusti",
+    "du har erfarenhet av python och maskininlärning",
+]
+
+
+async def client(host, port, deadline, texts, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            body = json.dumps({'text': random.choice(texts)}).encode('utf-8')
+            start = time.perf_counter()
+            writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                host, len(body)).encode('latin-1') + body)
+            await writer.drain()
+            status = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await reader.readexactly(length)
+            if b' 200 ' in status:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status.decode('latin-1').strip())
+    finally:
+        writer.close()
+
+
+async def run_level(host, port, concurrency, duration, texts):
+    latencies, errors = [], []
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[client(host, port, deadline, texts, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000.0
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies_ms, 99)) if len(latencies) else None,
+    }
+
+
+async def start_tiny_server(args):
+    import torch
+    from pytorch_pretrained_bert import BertTokenizer
+    from pytorch_pretrained_bert.modeling import BertConfig, BertForTokenClassification
+    from utils.processors import NERProcessor
+    from utils.predict import NERPredictor
+    from utils.serving import MicroBatcher, NERRunner, InferenceServer
+
+    words = sorted(set(' '.join(SENTENCES).split()))
+    vocab_file = os.path.join(tempfile.mkdtemp(), 'vocab.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + words) + '\n')
+    tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+    torch.manual_seed(0)
+    config = BertConfig(len(tokenizer.vocab), hidden_size=128, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=256)
+    model = BertForTokenClassification(config, len(NERProcessor.label_list))
+    predictor = NERPredictor(model, tokenizer, NERProcessor.label_list, NERProcessor.wordpiece_conll_map,
+                             max_seq_length=64, batch_size=args.max_batch_size)
+    batcher = MicroBatcher(NERRunner(predictor), max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    server = InferenceServer(batcher, port=0)
+    await server.start()
+    return server
+
+
+async def main_async(args):
+    server = None
+    port = args.port
+    if args.tiny:
+        server = await start_tiny_server(args)
+        port = server.port
+
+    texts = SENTENCES
+    if args.texts:
+        with open(args.texts, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    results = []
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        result = await run_level(args.host, port, concurrency, args.duration, texts)
+        print("concurrency {concurrency:4d}  {throughput_rps:8.1f} req/s  p50 {p50_ms:8.2f} ms  "
+              "p99 {p99_ms:8.2f} ms  errors {errors}".format(**result))
+        results.append(result)
+
+    if server is not None:
+        results.append({'server': server.batcher.stats()})
+        await server.stop()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--concurrency', default='1,4,16,64', help='comma separated client counts')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per concurrency level')
+    parser.add_argument('--texts', default=None, help='file with one sentence per line')
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    parser.add_argument('--tiny', action='store_true', help='start a local server with a tiny random model')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Training throughput with padding to max_seq_length, length bucketing and packing.
+
+Uses synthetic NER sentences and a small randomly initialised BERT, so no
+download or GPU is needed.
+
+    python benchmarks/packing.py --examples 2000 --max-seq-length 128
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.datasets import bucketed_dataloader
+from utils.packing import PackedDataset, packed_dataloader, packed_forward
+
+
+class SyntheticDataset(TensorDataset):
+    def lengths(self):
+        return self.tensors[1].sum(1).tolist()
+
+
+def synthetic_dataset(num_examples, max_seq_length, vocab_size, num_labels, seed=0):
+    rng = np.random.RandomState(seed)
+    # Job ad sentences are mostly 20-40 wordpieces
+    lengths = np.clip(rng.lognormal(np.log(30), 0.4, num_examples).astype(int), 4, max_seq_length)
+    input_ids = np.zeros((num_examples, max_seq_length), dtype=np.int64)
+    label_ids = np.zeros_like(input_ids)
+    input_mask = np.zeros_like(input_ids)
+    for i, length in enumerate(lengths):
+        input_ids[i, :length] = rng.randint(5, vocab_size, length)
+        label_ids[i, :length] = rng.randint(3, num_labels, length)
+        input_mask[i, :length] = 1
+    tensors = [torch.from_numpy(a) for a in (input_ids, input_mask, np.zeros_like(input_ids), label_ids)]
+    return SyntheticDataset(*tensors)
+
+
+def train_throughput(model, dataloader, num_examples_fn, steps):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    model.train()
+    examples, start, step = 0, time.perf_counter(), 0
+    while step < steps:
+        for batch in dataloader:
+            if len(batch) == 5:
+                logits = packed_forward(model, batch[0], batch[1], batch[2], batch[4])
+            else:
+                logits = model(batch[0], batch[2], batch[1])
+            active = batch[1].view(-1) != 0
+            loss = torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1))[active], batch[3].view(-1)[active])
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            examples += num_examples_fn(batch)
+            step += 1
+            if step >= steps:
+                break
+    return examples / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--examples', type=int, default=2000)
+    parser.add_argument('--max-seq-length', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--steps', type=int, default=30)
+    args = parser.parse_args()
+
+    from pytorch_pretrained_bert.modeling import BertConfig, BertForTokenClassification
+    num_labels, vocab_size = 6, 1000
+    config = BertConfig(vocab_size, hidden_size=128, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=256, max_position_embeddings=args.max_seq_length)
+    torch.manual_seed(0)
+    model = BertForTokenClassification(config, num_labels)
+    dataset = synthetic_dataset(args.examples, args.max_seq_length, vocab_size, num_labels)
+    packed = PackedDataset(dataset, args.max_seq_length)
+
+    padded_efficiency = sum(dataset.lengths()) / float(len(dataset) * args.max_seq_length)
+    per_example = lambda batch: batch[0].size(0)
+    per_packed_example = lambda batch: int(batch[1].max(1)[0].sum())
+    runs = [
+        ('padded', DataLoader(dataset, batch_size=args.batch_size, shuffle=True), per_example, padded_efficiency),
+        ('bucketed', bucketed_dataloader(dataset, batch_size=args.batch_size), per_example, None),
+        ('packed', packed_dataloader(packed, batch_size=args.batch_size), per_packed_example,
+         packed.packing_efficiency()),
+    ]
+    for name, dataloader, count, efficiency in runs:
+        samples_per_second = train_throughput(model, dataloader, count, args.steps)
+        print("{:10s} {:8.1f} samples/s{}".format(
+            name, samples_per_second, '' if efficiency is None else '  efficiency {:.1%}'.format(efficiency)))
+
+
+if __name__ == '__main__':
+    main()
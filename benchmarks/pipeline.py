@@ -0,0 +1,291 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmarks of the data and training pipeline on synthetic NER data.
+
+Every stage runs in its own interpreter with a small randomly initialised
+BERT, so no download or GPU is needed, and reports examples per second and
+the peak RSS of its process as JSON.
+
+    python benchmarks/pipeline.py --output baseline.json
+    python benchmarks/pipeline.py --compare baseline.json --tolerance 0.1
+
+--compare exits with status 1 when a stage is more than --tolerance slower
+than in the baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("vi erbjuder en spännande tjänst hos oss på arbetsförmedlingen i stockholm välkommen med din "
+         "ansökan volvo ikea systemutvecklare göteborg säljare varuhuset malmö erfarenhet python").split()
+SUFFIXES = ['##s', '##en', '##ar', '##na', '##et']
+
+STAGES = ['read_tsv', 'read_csv', 'create_examples', 'bert_labels', 'convert_examples_to_features',
+          'input_example_to_tensors', 'collate', 'train_step', 'validation']
+
+
+class Pipeline(object):
+    """ Synthetic NER files, tokenizer and model shared by the stages """
+
+    def __init__(self, args):
+        from pytorch_pretrained_bert import BertTokenizer
+        from utils.processors import NERProcessor
+
+        self.args = args
+        self.directory = tempfile.mkdtemp(prefix='pipeline-benchmark-')
+        rng = random.Random(args.seed)
+        # Unknown words are split into a known word and suffix wordpieces
+        self.sentences = []
+        for _ in range(args.examples):
+            words = [rng.choice(WORDS) + rng.choice(['', '', 'en', 'ar']) for _ in range(rng.randint(5, 40))]
+            labels = [rng.choice(['O', 'O', 'O', 'B_COMP', 'I_COMP']) for _ in words]
+            self.sentences.append((words, labels))
+
+        with open(os.path.join(self.directory, 'train.csv'), 'w', encoding='utf-8') as f:
+            f.write('labels\ttext\nlabels\ttext\n')
+            for words, labels in self.sentences:
+                f.write('{}\t{}\n'.format(' '.join(labels), ' '.join(words)))
+
+        vocab_file = os.path.join(self.directory, 'vocab.txt')
+        with open(vocab_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS + SUFFIXES) + '\n')
+        self.tokenizer = BertTokenizer(vocab_file, do_lower_case=True)
+        self.processor = NERProcessor(self.directory + '/', self.tokenizer)
+        self.label_list = self.processor.get_label_list()
+
+    def examples(self):
+        return self.processor._create_examples(self.processor._read_csv(self.train_file()), 'train')
+
+    def train_file(self):
+        return os.path.join(self.directory, 'train.csv')
+
+    def dataloader(self, shuffle=True):
+        from utils.datasets import BertDataset, InputExampleToTensors, bucketed_dataloader
+        transform = InputExampleToTensors(self.tokenizer, self.args.max_seq_length, self.label_list,
+                                          pad_to_max_length=False)
+        dataset = BertDataset(self.examples(), transform)
+        return bucketed_dataloader(dataset, batch_size=self.args.batch_size, shuffle=shuffle)
+
+    def trainer(self):
+        import torch
+        from pytorch_pretrained_bert.modeling import BertConfig, BertForTokenClassification
+        from utils.sinks import MetricsSink, NullBackend
+        from utils.train import NERTrainer
+        torch.manual_seed(self.args.seed)
+        config = BertConfig(len(self.tokenizer.vocab), hidden_size=self.args.hidden_size,
+                            num_hidden_layers=self.args.layers, num_attention_heads=2,
+                            intermediate_size=self.args.hidden_size * 2,
+                            max_position_embeddings=self.args.max_seq_length)
+        model = BertForTokenClassification(config, len(self.label_list))
+        return NERTrainer(model, self.dataloader(), self.dataloader(shuffle=False), self.label_list,
+                          writer=MetricsSink(NullBackend()))
+
+
+def stage_read_tsv(pipeline):
+    from utils.processors import DataProcessor
+    return lambda: len(DataProcessor._read_tsv(pipeline.train_file())) - 2
+
+
+def stage_read_csv(pipeline):
+    return lambda: len(pipeline.processor._read_csv(pipeline.train_file()))
+
+
+def stage_create_examples(pipeline):
+    data = pipeline.processor._read_csv(pipeline.train_file())
+    return lambda: len(pipeline.processor._create_examples(data, 'train'))
+
+
+def stage_bert_labels(pipeline):
+    conll_sentences = [list(zip(words, labels)) for words, labels in pipeline.sentences]
+
+    def run():
+        pipeline.processor.token_count = 0
+        for sentence in conll_sentences:
+            pipeline.processor.bert_labels(sentence)
+        return len(conll_sentences)
+    return run
+
+
+def stage_convert_examples_to_features(pipeline):
+    from utils.processors import convert_examples_to_features
+    examples = pipeline.examples()
+    return lambda: len(convert_examples_to_features(examples, pipeline.label_list, pipeline.args.max_seq_length,
+                                                    pipeline.tokenizer))
+
+
+def stage_input_example_to_tensors(pipeline):
+    from utils.datasets import InputExampleToTensors
+    examples = pipeline.examples()
+    transform = InputExampleToTensors(pipeline.tokenizer, pipeline.args.max_seq_length, pipeline.label_list,
+                                      pad_to_max_length=False)
+    return lambda: len([transform(example) for example in examples])
+
+
+def stage_collate(pipeline):
+    dataloader = pipeline.dataloader()
+    return lambda: sum(batch[0].size(0) for batch in dataloader)
+
+
+def stage_train_step(pipeline):
+    """ The body of the NERTrainer.fit loop, one optimizer step per batch """
+    trainer = pipeline.trainer()
+    trainer.learning_rate = 1e-4
+    trainer.optimizer = trainer.create_optimizer(trainer.fp16)
+    batches = [tuple(t.to(trainer.device) for t in batch) for batch in trainer.train_dataloader]
+    batches = batches[:pipeline.args.train_steps]
+    trainer.model.train()
+
+    def run():
+        for batch in batches:
+            with trainer.autocast():
+                logits = trainer.forward(batch)
+            loss = trainer.loss(logits.float(), batch[3], batch[1])
+            trainer.scaler.scale(loss).backward()
+            trainer.scaler.step(trainer.optimizer)
+            trainer.scaler.update()
+            trainer.model.zero_grad()
+        loss.item()
+        return sum(batch[0].size(0) for batch in batches)
+    return run
+
+
+def stage_validation(pipeline):
+    trainer = pipeline.trainer()
+
+    def run():
+        metrics = trainer.validation(0)
+        metrics.loss().item()
+        return len(trainer.valid_dataloader.dataset)
+    return run
+
+
+def run_stage(stage, args):
+    """ Median examples per second of a stage over --repeat runs after a warm-up run """
+    pipeline = Pipeline(args)
+    try:
+        run = globals()['stage_' + stage](pipeline)
+        run()
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = run()
+            timings.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(pipeline.directory, ignore_errors=True)
+    seconds = sorted(timings)[len(timings) // 2]
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+    return {'examples': count, 'seconds': seconds, 'examples_per_second': count / seconds,
+            'peak_rss_mb': peak_rss_mb}
+
+
+def run_all(args, stages):
+    results = {}
+    for stage in stages:
+        command = [sys.executable, os.path.abspath(__file__), '--stage', stage] + stage_arguments(args)
+        output = subprocess.check_output(command, universal_newlines=True)
+        results[stage] = json.loads(output.strip().splitlines()[-1])
+        print("{:30s} {:12.1f} examples/s {:8.1f} MB".format(
+            stage, results[stage]['examples_per_second'], results[stage]['peak_rss_mb']), file=sys.stderr)
+    return results
+
+
+def stage_arguments(args):
+    return ['--examples', str(args.examples), '--max-seq-length', str(args.max_seq_length),
+            '--batch-size', str(args.batch_size), '--hidden-size', str(args.hidden_size),
+            '--layers', str(args.layers), '--train-steps', str(args.train_steps),
+            '--repeat', str(args.repeat), '--seed', str(args.seed)]
+
+
+def environment():
+    import torch
+    return {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads()}
+
+
+def compare(results, baseline, tolerance):
+    """ Prints the change of every stage and returns the stages slower than tolerance """
+    regressions = []
+    print("{:30s} {:>12s} {:>12s} {:>8s}".format('stage', 'baseline', 'current', 'change'))
+    for stage, result in results.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]['examples_per_second']
+        change = result['examples_per_second'] / before - 1.0
+        slower = change < -tolerance
+        if slower:
+            regressions.append(stage)
+        print("{:30s} {:12.1f} {:12.1f} {:+8.1%}{}".format(
+            stage, before, result['examples_per_second'], change, '  SLOWER' if slower else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--stage', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown')
+    parser.add_argument('--examples', type=int, default=2000)
+    parser.add_argument('--max-seq-length', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--train-steps', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.stage:
+        print(json.dumps(run_stage(args.stage, args)))
+        return
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error("unknown stages: {}".format(', '.join(unknown)))
+    report = {'config': {k: v for k, v in vars(args).items() if k not in ('stage', 'output', 'compare')},
+              'environment': environment(), 'results': run_all(args, stages)}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report['results'], baseline['results'], args.tolerance)
+        if regressions:
+            print("FAIL: slower than the baseline: {}".format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
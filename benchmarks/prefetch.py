@@ -0,0 +1,78 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Data wait of NERTrainer.fit with and without a DevicePrefetcher.
+
+    python benchmarks/prefetch.py --prefetch 0,2,4 --examples 2000
+
+Trains one epoch of a small random BERT on the synthetic NER data of
+benchmarks/pipeline.py for every --prefetch value, after a warm-up epoch,
+0 being the loop without prefetching. Prints the seconds of the data and
+h2d stages of the training and validation loops. The examples are tokenized
+in the dataset, so the loader has real work to hide behind the model. The
+overlap needs a free core for the prefetch thread, or a GPU.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline import Pipeline
+
+
+def run(pipeline, prefetch_batches):
+    trainer = pipeline.trainer()
+    trainer.prefetch_batches = prefetch_batches
+    start = time.perf_counter()
+    trainer.fit(num_epochs=1, learning_rate=1e-4)
+    seconds = time.perf_counter() - start
+    train, validation = trainer.timer.totals(), trainer.validation_timer.totals()
+    return {'seconds': seconds, 'train_data': train.get('data', 0.0), 'train_h2d': train.get('h2d', 0.0),
+            'validation_data': validation.get('data', 0.0), 'validation_h2d': validation.get('h2d', 0.0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--prefetch', default='0,2', help='comma separated numbers of prefetched batches')
+    parser.add_argument('--examples', type=int, default=2000)
+    parser.add_argument('--max-seq-length', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--hidden-size', type=int, default=64)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args)
+    try:
+        # Warm-up, the first fit pays for imports and allocations
+        run(pipeline, 0)
+        results = [(int(k), run(pipeline, int(k))) for k in args.prefetch.split(',')]
+    finally:
+        shutil.rmtree(pipeline.directory, ignore_errors=True)
+
+    print("{:>8s} {:>10s} {:>12s} {:>11s} {:>12s} {:>11s}".format(
+        'prefetch', 'epoch s', 'train data', 'train h2d', 'valid data', 'valid h2d'))
+    for prefetch_batches, result in results:
+        print("{:8d} {:10.3f} {:12.3f} {:11.3f} {:12.3f} {:11.3f}".format(
+            prefetch_batches, result['seconds'], result['train_data'], result['train_h2d'],
+            result['validation_data'], result['validation_h2d']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Parity and speed of FastBertTokenizer against BertTokenizer.
+
+    python benchmarks/tokenization.py --vocab swe-uncased_L-12_H-768_A-12/vocab.txt --corpus data/train.csv
+
+Every line of --corpus is a text. Without --vocab and --corpus a synthetic
+vocabulary and corpus are used, with accented, cased, punctuated, CJK,
+control and over-long words. The script exits with status 1 when any text
+is tokenized differently, by FastBertTokenizer.check_parity, and otherwise
+prints texts per second of BertTokenizer, of FastBertTokenizer with an
+empty and a warm word cache and of batch_token_ids. The parity on the
+synthetic corpus is also the tokenization check of benchmarks/checks.py.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pytorch_pretrained_bert import BertTokenizer
+from utils.tokenization import FastBertTokenizer
+
+WORDS = ("vi erbjuder en spännande tjänst hos oss på Arbetsförmedlingen i Stockholm välkommen med din "
+         "ansökan Volvo IKEA systemutvecklare Göteborg säljare varuhuset Malmö erfarenhet python "
+         "café naïve Åre ÖREBRO 2019 50% e-post www.af.se").split()
+ODD_WORDS = ['東京', 'ab​cd', 'a\x0bb', 'tab\tseparated', 'non breaking', 'x' * 120, '[CLS]',
+             '[unk]', 'line separator', 'Ångström', '¡hola!', '...', 'a\x1cb', 'é', 'İstanbul']
+
+
+def synthetic_vocab(path):
+    pieces = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    pieces += sorted(set(w.lower() for w in WORDS[:20]))
+    pieces += ['##s', '##en', '##ar', '##na', '##et', '##are', 'sy', '##stem', '##ut', '##veck', '##lare']
+    letters = 'abcdefghijklmnopqrstuvwxyzåäö0123456789'
+    pieces += list(letters) + ['##' + c for c in letters] + list('.,!?%-¡') + ['東']
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(pieces) + '\n')
+
+
+def synthetic_corpus(num_texts, seed=0):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(num_texts):
+        words = [rng.choice(WORDS) + rng.choice(['', '', 'en', 'ar', ',', '.']) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words)), rng.choice(ODD_WORDS))
+        texts.append(' '.join(words))
+    return texts
+
+
+def read_corpus(path, limit):
+    with open(path, encoding='utf-8') as f:
+        texts = [line.rstrip('\n') for line in f]
+    return texts[:limit] if limit else texts
+
+
+def texts_per_second(function, texts, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(texts)
+        timings.append(time.perf_counter() - start)
+    return len(texts) / sorted(timings)[len(timings) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vocab', default=None, help='vocab.txt, a synthetic vocabulary by default')
+    parser.add_argument('--corpus', default=None, help='file with one text per line, synthetic by default')
+    parser.add_argument('--texts', type=int, default=5000, help='number of texts to use')
+    parser.add_argument('--cased', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    directory = None
+    vocab_file = args.vocab
+    if vocab_file is None:
+        directory = tempfile.mkdtemp(prefix='tokenization-benchmark-')
+        vocab_file = os.path.join(directory, 'vocab.txt')
+        synthetic_vocab(vocab_file)
+    try:
+        slow = BertTokenizer(vocab_file, do_lower_case=not args.cased)
+        fast = FastBertTokenizer(vocab_file, do_lower_case=not args.cased)
+    finally:
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
+    texts = read_corpus(args.corpus, args.texts) if args.corpus else synthetic_corpus(args.texts)
+
+    try:
+        fast.check_parity(texts)
+    except AssertionError as e:
+        print("FAIL: {}".format(e))
+        sys.exit(1)
+    print("parity: {} texts tokenized identically".format(len(texts)))
+
+    def cold(texts):
+        fast.clear_cache()
+        for text in texts:
+            fast.token_ids(text)
+
+    results = [
+        ('BertTokenizer', texts_per_second(
+            lambda texts: [slow.convert_tokens_to_ids(slow.tokenize(text)) for text in texts], texts, args.repeat)),
+        ('FastBertTokenizer cold', texts_per_second(cold, texts, args.repeat)),
+        ('FastBertTokenizer warm', texts_per_second(
+            lambda texts: [fast.token_ids(text) for text in texts], texts, args.repeat)),
+        ('batch_token_ids warm', texts_per_second(fast.batch_token_ids, texts, args.repeat)),
+    ]
+    print("{:26s} {:>12s} {:>8s}".format('tokenizer', 'texts/s', 'speedup'))
+    for name, speed in results:
+        print("{:26s} {:12.1f} {:8.2f}".format(name, speed, speed / results[0][1]))
+    print("cache: {}".format(fast.cache_info()))
+
+
+if __name__ == '__main__':
+    main()
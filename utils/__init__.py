@@ -16,3 +16,17 @@
 from .processors import * 
 from .datasets import *
 from .train import *
+from .cache import *
+from .metrics import *
+from .sinks import *
+from .predict import *
+from .packing import *
+from .checkpoint import *
+from .distributed import *
+from .profiling import *
+from .store import *
+from .tokenization import *
+from .distillation import *
+from .embeddings import *
+from .inference_cache import *
+from .validation import *
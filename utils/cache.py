@@ -0,0 +1,184 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .processors import convert_examples_to_arrays
+
+logger = logging.getLogger(__name__)
+
+FEATURE_NAMES = ('input_ids', 'input_mask', 'segment_ids', 'label_ids', 'lengths')
+# Part of every key, raised when the conversion or the shard format changes
+CACHE_VERSION = 2
+
+
+class FeatureCache(object):
+    """ On-disk cache of converted features stored as fixed-dtype numpy shards.
+
+    Every entry is a directory named after a hash of the source file, the
+    tokenizer vocabulary and settings, the lowercasing flag, the label list,
+    max_seq_length, the processor's alignment settings and CACHE_VERSION,
+    holding one .npy shard per feature. A change to any of them gives a new
+    key, so stale features are never read.
+
+    Args:
+        cache_dir: directory where the entries are stored
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source_file, tokenizer, label_list, max_seq_length, do_lower_case, alignment=None):
+        """ Hash of everything the features depend on, `alignment` being the settings of the processor
+        such as its wordpiece_conll_map and separator
+        """
+        digest = hashlib.sha1()
+        digest.update(self.source_hash(source_file).encode('utf-8'))
+        digest.update(vocab_hash(tokenizer).encode('utf-8'))
+        digest.update(json.dumps([CACHE_VERSION, tokenizer_settings(tokenizer), list(label_list), int(max_seq_length),
+                                  bool(do_lower_case), alignment], sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def source_hash(self, source_file):
+        """ Content hash of the source file, reused while its size and mtime are unchanged """
+        stat = os.stat(source_file)
+        index_file = os.path.join(self.cache_dir, 'sources.json')
+        index = {}
+        if os.path.exists(index_file):
+            with open(index_file, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+
+        path = os.path.abspath(source_file)
+        entry = index.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['sha1']
+
+        digest = hashlib.sha1()
+        with open(source_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': digest.hexdigest()}
+        _atomic_write_json(index_file, index)
+        return index[path]['sha1']
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key):
+        """ Opens the shards of an entry memory-mapped, or returns None when missing """
+        path = self.path(key)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in FEATURE_NAMES}
+
+    def save(self, key, arrays, meta=None):
+        """ Writes the shards to a temporary directory and renames it into place """
+        path = self.path(key)
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in FEATURE_NAMES:
+            np.save(os.path.join(tmp_path, name + '.npy'), arrays[name])
+        meta = dict(meta or {}, num_examples=int(len(arrays['lengths'])))
+        _atomic_write_json(os.path.join(tmp_path, 'meta.json'), meta)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process built the same entry first
+            shutil.rmtree(tmp_path)
+        return self.load(key)
+
+    def get_or_build(self, source_file, tokenizer, label_list, max_seq_length, do_lower_case, build_examples,
+                     num_workers=1, alignment=None):
+        """ Returns memory-mapped features, converting `build_examples()` on a cache miss """
+        key = self.key(source_file, tokenizer, label_list, max_seq_length, do_lower_case, alignment)
+        arrays = self.load(key)
+        if arrays is not None:
+            logger.info("Loaded cached features for {} from {}".format(source_file, self.path(key)))
+            return arrays
+
+        logger.info("Building feature cache for {}".format(source_file))
+        examples = build_examples()
+        arrays = convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, num_workers=num_workers)
+        meta = {'source_file': os.path.abspath(source_file), 'label_list': list(label_list),
+                'max_seq_length': max_seq_length, 'do_lower_case': do_lower_case,
+                'tokenizer': tokenizer_settings(tokenizer), 'alignment': alignment, 'version': CACHE_VERSION}
+        return self.save(key, arrays, meta)
+
+
+class CachedFeatureDataset(Dataset):
+    """ Dataset reading feature tuples from memory-mapped arrays of a FeatureCache """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays['lengths'])
+
+    def __getitem__(self, index):
+        return tuple(torch.from_numpy(np.asarray(self.arrays[name][index], dtype=np.int64))
+                     for name in FEATURE_NAMES[:4])
+
+    def lengths(self):
+        """ Number of wordpieces, including [CLS] and [SEP], of every example """
+        return self.arrays['lengths'].tolist()
+
+
+def cached_dataset(processor, set_type, max_seq_length=128, cache_dir='feature_cache', num_workers=1):
+    """ Dataset of the `set_type` ('train', 'val' or 'test') split of an NERProcessor,
+    served from the feature cache and built on the first call.
+    """
+    cache = FeatureCache(cache_dir)
+    arrays = cache.get_or_build(processor.get_source_file(set_type), processor.tokenizer,
+                                processor.get_label_list(), max_seq_length, processor.do_lower_case,
+                                lambda: processor.get_examples(set_type), num_workers=num_workers,
+                                alignment={'wordpiece_conll_map': processor.wordpiece_conll_map,
+                                           'separator': processor.separator})
+    return CachedFeatureDataset(arrays)
+
+
+def vocab_hash(tokenizer):
+    digest = hashlib.sha1()
+    for token, index in tokenizer.vocab.items():
+        digest.update('{}\t{}\n'.format(token, index).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def tokenizer_settings(tokenizer):
+    """ Settings of a BertTokenizer that change its wordpieces besides the vocabulary """
+    basic = getattr(tokenizer, 'basic_tokenizer', None) if getattr(tokenizer, 'do_basic_tokenize', True) else None
+    wordpiece = tokenizer.wordpiece_tokenizer
+    return {'do_basic_tokenize': basic is not None,
+            # Lowercasing also strips accents
+            'do_lower_case': basic.do_lower_case if basic else None,
+            'never_split': sorted(basic.never_split) if basic else None,
+            'unk_token': wordpiece.unk_token,
+            'max_input_chars_per_word': wordpiece.max_input_chars_per_word}
+
+
+def _atomic_write_json(path, obj):
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
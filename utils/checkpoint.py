@@ -0,0 +1,130 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import glob
+import queue
+import random
+import logging
+import threading
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATTERN = re.compile(r'checkpoint-(\d+)\.pt$')
+
+
+class AsyncCheckpointer(object):
+    """ Writes checkpoints from a background thread.
+
+    save() copies the state to CPU memory on the calling thread, which is the
+    only part that has to wait for the device, and queues the copy. The
+    background thread writes it to a temporary file, renames it into place so
+    a checkpoint is either complete or absent, and removes all but the last
+    `keep_last` checkpoints.
+
+    Args:
+        checkpoint_dir: directory of the checkpoint-<step>.pt files
+        keep_last: number of checkpoints kept on disk, at least 1
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=3):
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1, got {}".format(keep_last))
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='AsyncCheckpointer', daemon=True)
+        self._thread.start()
+
+    def save(self, state, step):
+        self._queue.put((cpu_snapshot(state), step))
+
+    def wait(self):
+        """ Blocks until every queued checkpoint is written """
+        self._queue.join()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                state, step = item
+                path = os.path.join(self.checkpoint_dir, 'checkpoint-{:08d}.pt'.format(step))
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                logger.info("Saved checkpoint {}".format(path))
+                self._rotate()
+            except Exception:
+                logger.exception("Failed to save checkpoint")
+            finally:
+                self._queue.task_done()
+
+    def _rotate(self):
+        for path in list_checkpoints(self.checkpoint_dir)[:-self.keep_last]:
+            os.remove(path)
+
+
+def list_checkpoints(checkpoint_dir):
+    """ Complete checkpoints of a directory, oldest first """
+    paths = [p for p in glob.glob(os.path.join(checkpoint_dir, 'checkpoint-*.pt')) if CHECKPOINT_PATTERN.search(p)]
+    return sorted(paths, key=lambda p: int(CHECKPOINT_PATTERN.search(p).group(1)))
+
+
+def load_checkpoint(path, map_location='cpu'):
+    """ Loads a checkpoint file, or the latest checkpoint of a directory """
+    if os.path.isdir(path):
+        checkpoints = list_checkpoints(path)
+        if not checkpoints:
+            raise FileNotFoundError("No checkpoint in {}".format(path))
+        path = checkpoints[-1]
+    logger.info("Loading checkpoint {}".format(path))
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def cpu_snapshot(obj):
+    """ Copy of a nested state with every tensor copied to CPU memory """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: cpu_snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def capture_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
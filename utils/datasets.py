@@ -13,11 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import queue
 import logging
+import itertools
+import threading
 import numpy as np
 import torch
-from torch.utils.data import Dataset
-from tensorflow.keras.preprocessing.sequence import pad_sequences
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
+
+from .store import ExampleStore
+from .tokenization import token_ids
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -31,43 +36,178 @@ class BertDataset(Dataset):
     def __init__(self, samples, transform, max_len=None):
         """
         Args
-            samples: List of InputExample instances.
+            samples: List of InputExample instances or a utils.store.ExampleStore,
+                which is read column-wise without creating InputExamples
             transform (callable): Transform to be applied on a list of InputExamples
         """
         self.samples = samples
         self.transform = transform
         self.max_len = max_len
+        self.from_store = isinstance(samples, ExampleStore) and hasattr(transform, 'from_store')
         
     def __len__(self):
         if self.max_len: return self.max_len
         return len(self.samples)
     
     def __getitem__(self, index):
+        if self.from_store:
+            return self.transform.from_store(self.samples, index)
         return self.transform(self.samples[index])
+
+    def lengths(self):
+        """ Number of wordpieces, including [CLS] and [SEP], of every sample """
+        if self.from_store and self.samples.has_alignment and 'text_b' not in self.samples.columns:
+            lengths = np.minimum(self.samples.token_lengths() + 2, self.transform.max_seq_length)
+            return lengths[:len(self)].tolist()
+        return [self.transform.sequence_length(self.samples[i]) for i in range(len(self))]
     
 
+class StreamingBertDataset(IterableDataset):
+    """ Bert Dataset streaming examples from a generator, with features created on the fly
+
+    Args:
+        example_stream (callable): called as example_stream(shard_id, num_shards) and returns
+            an iterator over the InputExamples of that shard, e.g.
+            functools.partial(processor.iter_examples, 'train')
+        transform (callable): Transform to be applied on every InputExample
+        shuffle_buffer_size: (Optional) size of the buffer used for approximate shuffling
+        seed: seed of the shuffling
+        length: (Optional) number of examples, needed by len(DataLoader) and NERTrainer
+        num_replicas: number of distributed processes sharing the stream
+        rank: rank of this process, the stream is split into num_replicas * num_workers shards
+        even_shards: cut every shard to length // (num_replicas * num_workers) examples, so all
+            processes run the same number of batches as DistributedDataParallel training needs
+    """
+
+    def __init__(self, example_stream, transform, shuffle_buffer_size=0, seed=0, length=None, num_replicas=1,
+                 rank=0, even_shards=False):
+        self.example_stream = example_stream
+        self.transform = transform
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.length = length
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.even_shards = even_shards
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.length is None:
+            raise TypeError("StreamingBertDataset has no length unless `length` is given")
+        if self.even_shards:
+            # Exact without workers, num_batches counts the examples cut from the worker shards
+            return self.length // self.num_replicas
+        return len(range(self.rank, self.length, self.num_replicas))
+
+    def num_batches(self, batch_size, num_workers=0, drop_last=False):
+        """ Number of batches of a DataLoader over the dataset. Every worker
+        batches its own shard and yields its own last partial batch, so there
+        can be more batches than len(DataLoader), which divides len(dataset).
+        """
+        if self.length is None:
+            raise TypeError("StreamingBertDataset has no number of batches unless `length` is given")
+        num_workers = max(num_workers, 1)
+        num_shards = self.num_replicas * num_workers
+        count = 0
+        for worker_id in range(num_workers):
+            if self.even_shards:
+                examples = self.length // num_shards
+            else:
+                examples = len(range(self.rank * num_workers + worker_id, self.length, num_shards))
+            count += examples // batch_size if drop_last else (examples + batch_size - 1) // batch_size
+        return count
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        shard_id, num_shards = self.rank * num_workers + worker_id, self.num_replicas * num_workers
+        examples = self.example_stream(shard_id, num_shards)
+        if self.even_shards:
+            if self.length is None:
+                raise ValueError("even_shards needs the `length` of the stream")
+            examples = itertools.islice(examples, self.length // num_shards)
+        if self.shuffle_buffer_size > 1:
+            rng = np.random.RandomState(self.seed + self.epoch * num_shards + shard_id)
+            examples = _shuffle_buffer(examples, self.shuffle_buffer_size, rng)
+        for example in examples:
+            yield self.transform(example)
+
+
+def _shuffle_buffer(iterable, buffer_size, rng):
+    """ Approximate shuffle keeping at most buffer_size items in memory """
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randint(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    for item in buffer:
+        yield item
+
+
 class InputExampleToTensors(object):
     """ Converts a InputExample to a tuple of feature tensors.
 
     Args:
         train_examples: a list of InputExample instances
         tokenizer: BertTokenizer used to tokenize to Wordpieces and transform to indices
+        pad_to_max_length: pad every example to max_seq_length. Set to False when
+            batches are padded by DynamicPaddingCollator.
     """
 
-    def __init__(self, tokenizer, max_seq_length=128, label_list=['0', '1']):
+    def __init__(self, tokenizer, max_seq_length=128, label_list=['0', '1'], pad_to_max_length=True):
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
         self.label_list = label_list
+        self.pad_to_max_length = pad_to_max_length
 
     def __call__(self, example):
         
         label_map = {label : i for i, label in enumerate(self.label_list)}
         
-        tokens_a = self.tokenizer.tokenize(example.text_a)
+        # NER examples carry the wordpiece ids from the processor's alignment
+        # stage, so the sentence is only tokenized once.
+        alignment = getattr(example, 'alignment', None)
+        if alignment is not None:
+            tokens_a = list(alignment.input_ids)
+        else:
+            tokens_a = self._token_ids(example.text_a)
         
         tokens_b = None
         if example.text_b:
-            tokens_b = self.tokenizer.tokenize(example.text_b)
+            tokens_b = self._token_ids(example.text_b)
+        
+        if isinstance(example.label, list):
+            label_id = [label_map[label] for label in example.label]
+        else:
+            label_id = label_map[example.label]
+        return self.to_tensors(tokens_a, tokens_b, label_id)
+    
+    def from_store(self, store, index):
+        """ Feature tensors of example `index` of a utils.store.ExampleStore, read from its columns """
+        if store.has_alignment:
+            tokens_a = store.input_ids(index).tolist()
+        else:
+            tokens_a = self._token_ids(store.text_a(index))
+        text_b = store.text_b(index)
+        tokens_b = self._token_ids(text_b) if text_b else None
+        
+        label_ids = store.label_ids(index)
+        if store.label_list != list(self.label_list):
+            label_map = {label : i for i, label in enumerate(self.label_list)}
+            label_ids = [label_map[store.label_list[i]] for i in label_ids]
+        label_id = [int(i) for i in label_ids] if store.token_labels else int(label_ids[0])
+        return self.to_tensors(tokens_a, tokens_b, label_id)
+    
+    def to_tensors(self, tokens_a, tokens_b, label_id):
+        """ Feature tensors of wordpiece ids and label ids, a list for token labels """
+        if tokens_b:
             # Modifies `tokens_a` and `tokens_b` in place so that the total
             # length is less than the specified length.
             # Account for [CLS], [SEP], [SEP] with "- 3"
@@ -95,39 +235,37 @@ class InputExampleToTensors(object):
         # For classification tasks, the first vector (corresponding to [CLS]) is
         # used as as the "sentence vector". Note that this only makes sense because
         # the entire model is fine-tuned.
-        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
+        cls_id, sep_id = self.tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        input_ids = [cls_id] + tokens_a + [sep_id]
+        segment_ids = [0] * len(input_ids)
 
         if tokens_b:
-            tokens += tokens_b + ["[SEP]"]
+            input_ids += tokens_b + [sep_id]
             segment_ids += [1] * (len(tokens_b) + 1)
 
-        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-
         # The mask has 1 for real tokens and 0 for padding tokens. Only real
         # tokens are attended to.
         input_mask = [1] * len(input_ids)
 
         # Zero-pad up to the sequence length.
-        padding = [0] * (self.max_seq_length - len(input_ids))
+        seq_length = self.max_seq_length if self.pad_to_max_length else len(input_ids)
+        padding = [0] * (seq_length - len(input_ids))
         input_ids += padding
         input_mask += padding
         segment_ids += padding
 
-        assert len(input_ids) == self.max_seq_length
-        assert len(input_mask) == self.max_seq_length
-        assert len(segment_ids) == self.max_seq_length
+        assert len(input_ids) == seq_length
+        assert len(input_mask) == seq_length
+        assert len(segment_ids) == seq_length
         
-        if isinstance(example.label, list):
-            label_id = [label_map[label] for label in example.label]
+        if isinstance(label_id, list):
             #label_padding = [0] * (self.max_seq_length - len(label_id))
             #label_id += label_padding
             #label_id = torch.tensor(label_id, dtype=torch.long)
             
-            label_id = self._pad_sequence(label_id, self.max_seq_length, 0)
-            assert len(label_id) == self.max_seq_length
+            label_id = self._pad_sequence(label_id, seq_length, 0)
+            assert len(label_id) == seq_length
         else:
-            label_id = label_map[example.label]
             label_id = torch.tensor(label_id, dtype=torch.long)
             
         input_ids = torch.tensor(input_ids, dtype=torch.long)
@@ -136,9 +274,28 @@ class InputExampleToTensors(object):
            
         return (input_ids, input_mask, segment_ids, label_id)
     
+    def sequence_length(self, example):
+        """ Number of wordpieces the example is converted to, without padding """
+        alignment = getattr(example, 'alignment', None)
+        if alignment is not None and not example.text_b:
+            return min(len(alignment) + 2, self.max_seq_length)
+        if isinstance(example.label, list):
+            # NER labels already hold one label per wordpiece, starting with [CLS]
+            return min(len(example.label) + 1, self.max_seq_length)
+        length = len(self._token_ids(example.text_a)) + 2
+        if example.text_b:
+            length += len(self._token_ids(example.text_b)) + 1
+        return min(length, self.max_seq_length)
+
+    def _token_ids(self, text):
+        return token_ids(self.tokenizer, text)
+
     def _pad_sequence(self, input, maxlen, value):
-        padded = pad_sequences([input], maxlen=self.max_seq_length, padding="post", value=value, dtype="long", truncating="post")
-        return torch.tensor(padded, dtype=torch.long).view(-1)
+        # Post padding and post truncation to maxlen
+        input = input[:maxlen]
+        padded = np.full(maxlen, value, dtype=np.int64)
+        padded[:len(input)] = input
+        return torch.from_numpy(padded)
      
     
     def _truncate_seq_pair(self, tokens_a, tokens_b, max_length):
@@ -156,3 +313,246 @@ class InputExampleToTensors(object):
                 tokens_a.pop()
             else:
                 tokens_b.pop()
+
+
+class DynamicPaddingCollator(object):
+    """ Collates feature tuples into a batch padded to the longest member of the batch.
+
+    Works both with unpadded samples from InputExampleToTensors(pad_to_max_length=False)
+    and with samples already padded to max_seq_length, which are trimmed to the
+    longest real sequence in the batch. The real length of a sample is the number
+    of non-zero entries of its input mask.
+
+    Args:
+        mask_index: position of the input mask in the feature tuple
+        pad_value: value used to pad every sequence feature
+        pad_to_multiple_of: (Optional) round the batch length up to a multiple of this
+    """
+
+    def __init__(self, mask_index=1, pad_value=0, pad_to_multiple_of=None):
+        self.mask_index = mask_index
+        self.pad_value = pad_value
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, batch):
+        lengths = [int((sample[self.mask_index] != 0).sum()) for sample in batch]
+        max_length = max(lengths)
+        if self.pad_to_multiple_of:
+            multiple = self.pad_to_multiple_of
+            max_length = ((max_length + multiple - 1) // multiple) * multiple
+
+        collated = []
+        for features in zip(*batch):
+            if features[0].dim() == 0:
+                collated.append(torch.stack(features))
+                continue
+            padded = features[0].new_full((len(features), max_length), self.pad_value)
+            for i, feature in enumerate(features):
+                length = min(feature.size(0), max_length)
+                padded[i, :length] = feature[:length]
+            collated.append(padded)
+        return tuple(collated)
+
+
+class BucketBatchSampler(Sampler):
+    """ Batch sampler yielding batches of examples with similar length.
+
+    Examples are sorted by length and split into buckets of bucket_size examples.
+    Each bucket is cut into batches, so the padding added by DynamicPaddingCollator
+    stays small. With shuffle the examples inside each bucket and the order of the
+    batches are shuffled, deterministically for a given seed and epoch.
+
+    Args:
+        lengths: sequence length of every example in the dataset
+        batch_size: number of examples in a batch
+        bucket_size: (Optional) number of examples in a bucket, defaults to 50 batches
+        shuffle: shuffle inside the buckets and the order of the batches
+        drop_last: drop the last incomplete batch of every bucket
+        seed: seed of the shuffling
+        num_replicas: number of distributed processes sharing the batches
+        rank: rank of this process, it gets every num_replicas-th batch. Batches
+            are repeated so every process gets the same number of batches.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=None, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size or batch_size * 50
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip(self, num_batches):
+        """ Starts the next iteration at batch num_batches of the epoch, to resume an epoch """
+        self.start_batch = num_batches
+
+    def batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            # Random tie-breaking so examples of equal length move between buckets
+            order = np.lexsort((rng.permutation(len(self.lengths)), self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches = []
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            num_batches = self._num_batches()
+            total = (num_batches + self.num_replicas - 1) // self.num_replicas * self.num_replicas
+            batches = (batches * self.num_replicas)[:total][self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        return iter(self.batches()[start_batch:])
+
+    def __len__(self):
+        return (self._num_batches() + self.num_replicas - 1) // self.num_replicas
+
+    def _num_batches(self):
+        if not self.drop_last:
+            return sum((len(self.lengths[i:i + self.bucket_size]) + self.batch_size - 1) // self.batch_size
+                       for i in range(0, len(self.lengths), self.bucket_size))
+        return sum(len(self.lengths[i:i + self.bucket_size]) // self.batch_size
+                   for i in range(0, len(self.lengths), self.bucket_size))
+
+
+def bucketed_dataloader(dataset, batch_size=32, bucket_size=None, shuffle=True, drop_last=False,
+                        seed=0, num_workers=0, pad_to_multiple_of=None, num_replicas=1, rank=0):
+    """ Creates a DataLoader with length-bucketed batches padded to their longest member.
+
+    Args:
+        dataset: utils.datasets.BertDataset or utils.processors.BertDataset
+        batch_size: number of examples in a batch
+        bucket_size: (Optional) number of examples in a length bucket
+        shuffle: shuffle inside the buckets and the order of the batches
+        num_replicas, rank: shard the batches over distributed processes, see BucketBatchSampler
+    """
+    batch_sampler = BucketBatchSampler(dataset.lengths(), batch_size, bucket_size=bucket_size,
+                                       shuffle=shuffle, drop_last=drop_last, seed=seed,
+                                       num_replicas=num_replicas, rank=rank)
+    collate_fn = DynamicPaddingCollator(pad_to_multiple_of=pad_to_multiple_of)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers)
+
+
+def loader_length(dataloader):
+    """ Number of batches a DataLoader yields, counting the last partial batch
+    of every worker of a StreamingBertDataset
+    """
+    dataset = getattr(dataloader, 'dataset', None)
+    if isinstance(dataset, StreamingBertDataset) and dataloader.batch_size is not None:
+        return dataset.num_batches(dataloader.batch_size, dataloader.num_workers, dataloader.drop_last)
+    return len(dataloader)
+
+
+class DevicePrefetcher(object):
+    """ Iterates a DataLoader with the next `num_batches` batches already on the device.
+
+    A background thread takes the batches from the loader, so loading and
+    collating run while the model computes. On GPU the thread also pins the
+    tensors and copies them with non_blocking copies on a side CUDA stream,
+    and the compute stream only waits for the copy of a batch when the batch
+    is used. The first batch is taken on the calling thread, so a sampler
+    seeded from the global random state draws at the same point of the
+    training loop as without prefetching.
+
+    Args:
+        loader: DataLoader, or any iterable of tuples of tensors
+        device: device the batches are copied to
+        num_batches: number of batches kept ready ahead
+    """
+
+    def __init__(self, loader, device, num_batches=2):
+        self.loader = loader
+        self.device = device
+        self.num_batches = num_batches
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return loader_length(self.loader)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        try:
+            first = self._to_device(next(iterator))
+        except StopIteration:
+            return
+        ready = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._fill, args=(iterator, ready, stop), name='DevicePrefetcher',
+                                  daemon=True)
+        thread.start()
+        try:
+            yield self._wait(first)
+            while True:
+                item = ready.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield self._wait(item)
+        finally:
+            # The loop may stop early, free the thread if it waits for a slot
+            stop.set()
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _fill(self, iterator, ready, stop):
+        try:
+            for batch in iterator:
+                if not self._put(ready, stop, self._to_device(batch)):
+                    return
+            self._put(ready, stop, None)
+        except Exception as e:
+            self._put(ready, stop, e)
+
+    def _put(self, ready, stop, item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _to_device(self, batch):
+        if self.stream is None:
+            return tuple(t.to(self.device) for t in batch), None
+        with torch.cuda.stream(self.stream):
+            batch = tuple((t if t.is_pinned() else t.pin_memory()).to(self.device, non_blocking=True)
+                          for t in batch)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def _wait(self, item):
+        batch, event = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # The memory of the batch belongs to the side stream until the compute stream is done with it
+            for t in batch:
+                t.record_stream(stream)
+        return batch
@@ -0,0 +1,193 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import logging
+import torch
+import torch.nn.functional as F
+
+from .train import NERTrainer, BatchForward
+from .metrics import ClassificationMetrics
+
+logger = logging.getLogger(__name__)
+
+
+def student_layer_ids(teacher_layers, student_layers):
+    """ Evenly spaced teacher layers a student is initialised from, always including the last one """
+    return [int(round((i + 1) * teacher_layers / float(student_layers))) - 1 for i in range(student_layers)]
+
+
+def create_student(teacher, num_hidden_layers=None, hidden_size=None, num_attention_heads=None,
+                   intermediate_size=None, layer_ids=None):
+    """ Smaller model of the teacher's class initialised from the teacher.
+
+    The embeddings, pooler and classifier are copied and student layer i
+    from teacher layer layer_ids[i], by default evenly spaced teacher layers
+    ending with the last. With a smaller hidden size every weight is copied
+    truncated to the leading rows and columns.
+
+    Args:
+        teacher: fine-tuned BertForTokenClassification or BertForSequenceClassification
+        num_hidden_layers: (Optional) layers of the student, those of the teacher by default
+        hidden_size: (Optional) hidden size of the student, that of the teacher by default
+        num_attention_heads: (Optional) heads of the student, must divide hidden_size
+        intermediate_size: (Optional) feed-forward size, 4 * hidden_size when hidden_size is given
+        layer_ids: (Optional) teacher layer of every student layer
+    """
+    config = copy.deepcopy(teacher.config)
+    if num_hidden_layers is not None:
+        config.num_hidden_layers = num_hidden_layers
+    if hidden_size is not None:
+        config.hidden_size = hidden_size
+        config.intermediate_size = intermediate_size or 4 * hidden_size
+    elif intermediate_size is not None:
+        config.intermediate_size = intermediate_size
+    if num_attention_heads is not None:
+        config.num_attention_heads = num_attention_heads
+    if config.hidden_size % config.num_attention_heads:
+        raise ValueError("hidden_size {} is not a multiple of num_attention_heads {}".format(
+            config.hidden_size, config.num_attention_heads))
+
+    if layer_ids is None:
+        layer_ids = student_layer_ids(teacher.config.num_hidden_layers, config.num_hidden_layers)
+    if len(layer_ids) != config.num_hidden_layers:
+        raise ValueError("Got {} layer_ids for {} student layers".format(len(layer_ids), config.num_hidden_layers))
+
+    student = type(teacher)(config, teacher.num_labels)
+    teacher_state = teacher.state_dict()
+    student_state = student.state_dict()
+    for name, parameter in student_state.items():
+        source = name
+        if name.startswith('bert.encoder.layer.'):
+            index, rest = name[len('bert.encoder.layer.'):].split('.', 1)
+            source = 'bert.encoder.layer.{}.{}'.format(layer_ids[int(index)], rest)
+        weight = teacher_state[source]
+        parameter.copy_(weight[tuple(slice(0, size) for size in parameter.shape)])
+    logger.info("Student with {} layers and hidden size {} from teacher layers {}".format(
+        config.num_hidden_layers, config.hidden_size, layer_ids))
+    return student
+
+
+def distillation_loss(student_logits, teacher_logits, label_ids, temperature=2.0, alpha=0.5):
+    """ alpha * soft-target KL divergence + (1 - alpha) * hard-label cross entropy.
+
+    The KL divergence between the teacher and student distributions at
+    `temperature` is multiplied by temperature ** 2, so its gradients keep
+    their scale when the temperature changes. Logits are [items, num_labels].
+    """
+    soft_loss = F.kl_div(F.log_softmax(student_logits / temperature, dim=-1),
+                         F.softmax(teacher_logits / temperature, dim=-1), reduction='batchmean')
+    hard_loss = F.cross_entropy(student_logits, label_ids)
+    return alpha * soft_loss * temperature ** 2 + (1.0 - alpha) * hard_loss
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+class DistillationTrainer(NERTrainer):
+    """ Trains a student model on the soft targets of a frozen teacher and the labels.
+
+    The teacher runs in eval mode without gradients on every train batch
+    and the student minimizes distillation_loss of the two. Validation,
+    checkpoints, gradient accumulation and distributed training are those
+    of NERTrainer, for the student.
+
+    Args:
+        teacher: fine-tuned model, frozen
+        student: smaller model of the same head, e.g. from create_student
+        task: 'ner' for token classification or 'classification' for sentence classification
+        temperature: softmax temperature of the soft targets
+        alpha: weight of the soft-target loss, 1 - alpha is the weight of the hard-label loss
+    """
+
+    def __init__(self, teacher, student, train_dataloader, valid_dataloader, label_list, task='ner',
+                 temperature=2.0, alpha=0.5, **kwargs):
+        if task not in ('ner', 'classification'):
+            raise ValueError("Unknown task {}".format(task))
+        # Set first, the parent constructor asks unused_parameters
+        self.task = task
+        super(DistillationTrainer, self).__init__(student, train_dataloader, valid_dataloader, label_list, **kwargs)
+        self.temperature = temperature
+        self.alpha = alpha
+        self.teacher = teacher.to(self.device).eval()
+        for parameter in self.teacher.parameters():
+            parameter.requires_grad_(False)
+        self.teacher_forward = BatchForward(self.teacher)
+
+    def training_loss(self, logits, batch):
+        if self.task == 'classification' and len(batch) == 5:
+            raise ValueError("Packed batches are only supported for NER distillation")
+        self.teacher.eval()
+        with torch.no_grad(), self.autocast():
+            teacher_logits = self.forward(batch, self.teacher_forward)
+        num_labels = self.model.num_labels
+        student_logits = logits.float().view(-1, num_labels)
+        teacher_logits = teacher_logits.float().view(-1, num_labels)
+        label_ids = batch[3].view(-1)
+        if self.task == 'ner':
+            active = batch[1].view(-1) != 0
+            student_logits, teacher_logits, label_ids = student_logits[active], teacher_logits[active], label_ids[active]
+        return distillation_loss(student_logits, teacher_logits, label_ids, self.temperature, self.alpha)
+
+    def loss(self, logits, label_ids, input_mask=None, reduction='mean'):
+        # A sentence has one label, the input mask only applies to tokens
+        if self.task == 'classification':
+            input_mask = None
+        return super(DistillationTrainer, self).loss(logits, label_ids, input_mask, reduction)
+
+    def num_scored(self, label_ids, input_mask):
+        if self.task == 'classification':
+            return label_ids.numel()
+        return super(DistillationTrainer, self).num_scored(label_ids, input_mask)
+
+    def unused_parameters(self):
+        # The pooler feeds the classifier of a sentence classification model
+        if self.task == 'classification':
+            return []
+        return super(DistillationTrainer, self).unused_parameters()
+
+    def create_metrics(self):
+        if self.task == 'classification':
+            return ClassificationMetrics(self.label_list, self.device)
+        return super(DistillationTrainer, self).create_metrics()
+
+    def create_optimizer(self, fp16=True, **kwargs):
+        # The pooler feeds the classifier of a sentence classification model
+        if self.task == 'classification':
+            kwargs.setdefault('skip', [])
+        return super(DistillationTrainer, self).create_optimizer(fp16, **kwargs)
+
+    def report(self, num_latency_batches=20):
+        """ Validation metrics, CPU latency and size of the teacher and the student.
+
+        `relative_f1` is the F1 score of the student divided by that of the
+        teacher and `speedup` the ratio of their CPU throughputs.
+        """
+        from .quantization import measure_latency
+        report = {}
+        for name, model in (('teacher', self.teacher), ('student', self.model)):
+            metrics = self.evaluate(BatchForward(model))
+            result = {'f1_score': metrics.f1_score(), 'accuracy': float(metrics.accuracy()),
+                      'loss': float(metrics.loss()), 'parameters': count_parameters(model)}
+            result.update(measure_latency(copy.deepcopy(model).cpu(), self.valid_dataloader, num_latency_batches))
+            report[name] = result
+        teacher, student = report['teacher'], report['student']
+        report['relative_f1'] = student['f1_score'] / teacher['f1_score'] if teacher['f1_score'] else 0.0
+        report['speedup'] = student['examples_per_second'] / teacher['examples_per_second']
+        report['size_ratio'] = student['parameters'] / float(teacher['parameters'])
+        logger.info("Student F1 {:.4f} ({:.1%} of the teacher), {:.2f}x faster on CPU, {:.1%} of the parameters".format(
+            student['f1_score'], report['relative_f1'], report['speedup'], report['size_ratio']))
+        return report
@@ -0,0 +1,135 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import copy
+import logging
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Sampler, IterableDataset
+from torch.utils.data.distributed import DistributedSampler
+
+from .datasets import bucketed_dataloader, DynamicPaddingCollator
+
+logger = logging.getLogger(__name__)
+
+
+def init_distributed(backend=None):
+    """ Joins the process group described by the torchrun environment variables.
+
+    The backend defaults to nccl on GPU and gloo on CPU. Every process uses
+    the GPU of its LOCAL_RANK. Returns the device of this process.
+    """
+    if not dist.is_initialized():
+        if backend is None:
+            backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+        dist.init_process_group(backend=backend)
+        logger.info("Initialized process {} of {} with {}".format(get_rank(), get_world_size(), backend))
+    device = default_device()
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    return device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def default_device():
+    if not torch.cuda.is_available():
+        return torch.device('cpu')
+    if dist.is_available() and dist.is_initialized():
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0)))
+    return torch.device('cuda')
+
+
+def all_gather_object(obj):
+    """ List of the objects of all processes, [obj] without a process group """
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+class ShardSampler(Sampler):
+    """ Every num_replicas-th index from rank, in order and without padding.
+
+    For evaluation, where DistributedSampler would count the examples it
+    repeats to even out the shards twice.
+    """
+
+    def __init__(self, num_examples, num_replicas=None, rank=None):
+        self.num_examples = num_examples
+        self.num_replicas = num_replicas if num_replicas is not None else get_world_size()
+        self.rank = rank if rank is not None else get_rank()
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_examples, self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, self.num_examples, self.num_replicas))
+
+
+def distributed_dataloader(dataset, batch_size=32, train=True, bucket_size=None, seed=0, num_workers=0,
+                           pad_to_multiple_of=None):
+    """ Creates the DataLoader of this process' shard of a dataset.
+
+    Training batches are length-bucketed like bucketed_dataloader and shared
+    out so every process gets the same number of batches, which
+    DistributedDataParallel needs. Datasets without lengths() use a
+    DistributedSampler. Evaluation batches use a ShardSampler, so every
+    example is scored exactly once over all processes. A streaming dataset,
+    e.g. utils.datasets.StreamingBertDataset, is split into shards of its
+    example_stream by rank and data loader worker. For training every shard
+    is cut to the same number of examples, so every process runs the same
+    number of batches, which needs the `length` of the stream.
+
+    Args:
+        dataset: utils.datasets.BertDataset or utils.processors.BertDataset
+        batch_size: number of examples in a batch of one process
+        train: shuffle and even out the shards for training
+    """
+    collate_fn = DynamicPaddingCollator(pad_to_multiple_of=pad_to_multiple_of)
+    if isinstance(dataset, IterableDataset):
+        # A sampler cannot index a stream, the dataset shards itself
+        if train and getattr(dataset, 'length', None) is None:
+            raise ValueError("Distributed training on a stream needs its `length` to even out the shards")
+        dataset = copy.copy(dataset)
+        dataset.num_replicas, dataset.rank = get_world_size(), get_rank()
+        dataset.even_shards = train
+        return DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn, num_workers=num_workers)
+    if not train:
+        return DataLoader(dataset, batch_size=batch_size, sampler=ShardSampler(len(dataset)),
+                          collate_fn=collate_fn, num_workers=num_workers)
+    if hasattr(dataset, 'lengths'):
+        return bucketed_dataloader(dataset, batch_size=batch_size, bucket_size=bucket_size, seed=seed,
+                                   num_workers=num_workers, pad_to_multiple_of=pad_to_multiple_of,
+                                   num_replicas=get_world_size(), rank=get_rank())
+    sampler = DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=True, seed=seed)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn,
+                      num_workers=num_workers)
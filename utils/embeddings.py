@@ -0,0 +1,359 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import logging
+import itertools
+import numpy as np
+import torch
+
+from .tokenization import token_ids
+from .distributed import default_device
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore(object):
+    """ Append-only store of float16 vectors on disk with an index of their ids.
+
+    The directory holds vectors.f16, the rows of the vectors as raw float16,
+    ids.txt, one id per line in row order, and meta.json with the number of
+    committed rows. add() appends to both files, syncs them and then replaces
+    meta.json, so a store interrupted in the middle of an add is truncated
+    back to its last committed row when it is opened again.
+
+    Args:
+        path: directory of the store, created if missing
+        dim: size of the vectors, read from meta.json for an existing store
+    """
+
+    def __init__(self, path, dim=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = self._read_meta()
+        if meta is None:
+            if dim is None:
+                raise ValueError("dim is needed to create the store {}".format(path))
+            meta = {'dim': int(dim), 'count': 0}
+            self._write_meta(meta)
+        elif dim is not None and dim != meta['dim']:
+            raise ValueError("Store {} has vectors of size {}, not {}".format(path, meta['dim'], dim))
+        self.dim = meta['dim']
+        self.count = meta['count']
+        self._recover()
+        self._vectors = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        if not os.path.exists(self._file('meta.json')):
+            return None
+        with open(self._file('meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        tmp_path = self._file('meta.json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._file('meta.json'))
+
+    def _recover(self):
+        """ Drops vectors and ids written after the last committed row, or rows missing one of them """
+        row_bytes = self.dim * 2
+        ids = []
+        if os.path.exists(self._file('ids.txt')):
+            with open(self._file('ids.txt'), encoding='utf-8') as f:
+                ids = f.read().splitlines()
+        with open(self._file('vectors.f16'), 'ab') as f:
+            count = min(self.count, len(ids), f.tell() // row_bytes)
+            if count < self.count:
+                logger.warning("Store {} has {} of its {} committed rows".format(self.path, count, self.count))
+                self.count = count
+                self._write_meta({'dim': self.dim, 'count': count})
+            if f.tell() > count * row_bytes:
+                f.truncate(count * row_bytes)
+                logger.warning("Dropped uncommitted vectors of {}".format(self.path))
+        if len(ids) != count:
+            ids = ids[:count]
+            with open(self._file('ids.txt'), 'w', encoding='utf-8') as f:
+                f.writelines(i + '\n' for i in ids)
+        self.ids = ids
+        self.index = {i: row for row, i in enumerate(ids)}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, id):
+        return id in self.index
+
+    @property
+    def vectors(self):
+        """ Read-only memory map of the vectors, [len(store), dim] float16 """
+        if self._vectors is None or len(self._vectors) != self.count:
+            self._vectors = np.memmap(self._file('vectors.f16'), dtype=np.float16, mode='r',
+                                      shape=(self.count, self.dim)) if self.count else \
+                np.zeros((0, self.dim), dtype=np.float16)
+        return self._vectors
+
+    def get(self, id):
+        return self.vectors[self.index[id]]
+
+    def add(self, ids, vectors):
+        """ Appends vectors with their ids and commits them """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float16)
+        if vectors.shape != (len(ids), self.dim):
+            raise ValueError("Expected vectors of shape {}, got {}".format((len(ids), self.dim), vectors.shape))
+        for i in ids:
+            if i in self.index or '\n' in i:
+                raise ValueError("Id {!r} is already in the store or contains a newline".format(i))
+        if len(set(ids)) != len(ids):
+            raise ValueError("Duplicate ids in the batch")
+        with open(self._file('vectors.f16'), 'ab') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self._file('ids.txt'), 'a', encoding='utf-8') as f:
+            f.writelines(i + '\n' for i in ids)
+            f.flush()
+            os.fsync(f.fileno())
+        for i in ids:
+            self.index[i] = len(self.ids)
+            self.ids.append(i)
+        self.count += len(ids)
+        self._write_meta({'dim': self.dim, 'count': self.count})
+
+
+def pool(sequence_output, input_mask, pooling='cls'):
+    """ Sentence vectors of the encoder output, the [CLS] vector or the mean over the unmasked tokens """
+    if pooling == 'cls':
+        return sequence_output[:, 0]
+    if pooling == 'mean':
+        mask = input_mask.unsqueeze(-1).to(sequence_output.dtype)
+        return (sequence_output * mask).sum(1) / mask.sum(1).clamp(min=1)
+    raise ValueError("Unknown pooling {}".format(pooling))
+
+
+def extract_embeddings(model, examples, tokenizer, store, max_seq_length=128, batch_size=64, pooling='cls',
+                       normalize=True, chunk_size=4096, device=None, fp16=False):
+    """ Encodes examples with the BERT encoder of model and appends their vectors to an EmbeddingStore.
+
+    Examples are read in chunks of `chunk_size`, so `examples` can be a
+    stream such as NERProcessor.iter_examples. Every chunk is sorted by length
+    and encoded in batches padded to their longest example, and its vectors
+    are committed to the store. Examples whose guid already is in the store
+    are skipped, so an interrupted extraction resumes by running it again.
+
+    Args:
+        model: BertModel, or a model with a `bert` encoder such as BertForTokenClassification
+        examples: iterable of InputExample, or an ExampleStore
+        tokenizer: BertTokenizer or FastBertTokenizer
+        store: EmbeddingStore with dim of the hidden size of the model
+        pooling: 'cls' for the [CLS] vector or 'mean' for the mean over the tokens
+        normalize: scale the vectors to unit length, so inner product search is cosine similarity
+        fp16: run the encoder under torch.autocast
+    """
+    device = device if device is not None else default_device()
+    bert = getattr(model, 'bert', model).to(device).eval()
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    iterator = iter(examples)
+    added, skipped, start = 0, 0, time.perf_counter()
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            break
+        pending = [example for example in chunk if example.guid not in store]
+        skipped += len(chunk) - len(pending)
+        if not pending:
+            continue
+        sequences = [_input_ids(example, tokenizer, cls_id, sep_id, max_seq_length) for example in pending]
+        order = np.argsort([len(ids) for ids, _ in sequences], kind='stable')
+        vectors = np.zeros((len(pending), store.dim), dtype=np.float16)
+        with torch.no_grad(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=fp16):
+            for batch_start in range(0, len(order), batch_size):
+                rows = order[batch_start:batch_start + batch_size]
+                input_ids, input_mask, segment_ids = _pad([sequences[i] for i in rows], device)
+                sequence_output, _ = bert(input_ids, segment_ids, input_mask, output_all_encoded_layers=False)
+                batch_vectors = pool(sequence_output.float(), input_mask, pooling)
+                if normalize:
+                    batch_vectors = torch.nn.functional.normalize(batch_vectors, dim=-1)
+                vectors[rows] = batch_vectors.cpu().numpy()
+        store.add([example.guid for example in pending], vectors)
+        added += len(pending)
+        logger.info("Embedded {} examples, {:.1f} examples/s, {} skipped".format(
+            added, added / (time.perf_counter() - start), skipped))
+    return added
+
+
+def _input_ids(example, tokenizer, cls_id, sep_id, max_seq_length):
+    """ Wordpiece ids and segment ids of an example with [CLS] and [SEP], truncated to max_seq_length """
+    alignment = getattr(example, 'alignment', None)
+    tokens_a = list(alignment.input_ids) if alignment is not None else token_ids(tokenizer, example.text_a)
+    tokens_b = token_ids(tokenizer, example.text_b) if example.text_b else []
+    # The longer sequence is truncated first, as in _truncate_seq_pair
+    budget = max_seq_length - (3 if tokens_b else 2)
+    while len(tokens_a) + len(tokens_b) > budget:
+        if len(tokens_a) > len(tokens_b):
+            tokens_a.pop()
+        else:
+            tokens_b.pop()
+    ids = [cls_id] + tokens_a + [sep_id] + (tokens_b + [sep_id] if tokens_b else [])
+    return ids, len(tokens_a) + 2
+
+
+def _pad(sequences, device):
+    max_length = max(len(ids) for ids, _ in sequences)
+    input_ids = np.zeros((len(sequences), max_length), dtype=np.int64)
+    input_mask = np.zeros_like(input_ids)
+    segment_ids = np.zeros_like(input_ids)
+    for i, (ids, length_a) in enumerate(sequences):
+        input_ids[i, :len(ids)] = ids
+        input_mask[i, :len(ids)] = 1
+        segment_ids[i, length_a:len(ids)] = 1
+    return tuple(torch.from_numpy(a).to(device) for a in (input_ids, input_mask, segment_ids))
+
+
+def _merge_top_k(scores, indices, block_scores, block_rows, k):
+    """ Merges the top k of the scores [queries, rows] of a block of rows into the running top k """
+    block_k = min(k, block_scores.shape[1])
+    top = np.argpartition(-block_scores, block_k - 1, axis=1)[:, :block_k]
+    candidates = np.concatenate([scores, np.take_along_axis(block_scores, top, axis=1)], axis=1)
+    candidate_indices = np.concatenate([indices, block_rows[top]], axis=1)
+    best = np.argpartition(-candidates, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(candidates, best, axis=1), np.take_along_axis(candidate_indices, best, axis=1)
+
+
+def _empty_top_k(num_queries, k):
+    return np.full((num_queries, k), -np.inf, dtype=np.float32), np.full((num_queries, k), -1, dtype=np.int64)
+
+
+def _sorted(scores, indices):
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def exact_search(vectors, queries, k=10, block_size=65536):
+    """ Exact top k rows of vectors by inner product with every query.
+
+    The vectors, e.g. the memory map of an EmbeddingStore, are read in
+    blocks of `block_size` rows that are converted to float32 and multiplied
+    with all queries at once, so memory stays bounded by the block.
+
+    Returns:
+        scores and row indices, both [num_queries, k], best first. With
+        fewer than k vectors the rest is padded with score -inf and row -1.
+    """
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    scores, indices = _empty_top_k(len(queries), k)
+    for block_start in range(0, len(vectors), block_size):
+        block = np.asarray(vectors[block_start:block_start + block_size], dtype=np.float32)
+        rows = np.arange(block_start, block_start + len(block))
+        scores, indices = _merge_top_k(scores, indices, queries @ block.T, rows, k)
+    return _sorted(scores, indices)
+
+
+class IVFIndex(object):
+    """ Inverted file index for approximate inner product search.
+
+    The vectors are clustered with spherical k-means into `num_lists`
+    lists. A search scores the centroids and only the vectors of the
+    `nprobe` best lists, trading recall for speed. The row indices of every
+    list are kept in one array ordered by list with an offsets array.
+
+    Args:
+        num_lists: number of clusters, about sqrt(len(vectors)) is a good start
+        nprobe: number of lists searched per query
+    """
+
+    def __init__(self, num_lists=1024, nprobe=16):
+        self.num_lists = num_lists
+        self.nprobe = nprobe
+        self.centroids = None
+        self.rows = None
+        self.offsets = None
+
+    def train(self, vectors, num_iterations=10, sample_size=100000, seed=0, block_size=65536):
+        """ Clusters a sample of the vectors and assigns every vector to its nearest centroid """
+        rng = np.random.RandomState(seed)
+        sample_rows = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+        sample = _unit(np.asarray(vectors[sample_rows], dtype=np.float32))
+        num_lists = min(self.num_lists, len(sample))
+        centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+        for _ in range(num_iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assignment, minlength=num_lists)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            sums[counts > 0] = np.add.reduceat(sample[np.argsort(assignment, kind='stable')],
+                                               starts[counts > 0], axis=0)
+            # Empty lists restart from a random sample vector
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = _unit(sums)
+        self.centroids = centroids
+        self.num_lists = num_lists
+
+        assignment = np.concatenate([
+            np.argmax(np.asarray(vectors[s:s + block_size], dtype=np.float32) @ centroids.T, axis=1)
+            for s in range(0, len(vectors), block_size)]) if len(vectors) else np.zeros(0, dtype=np.int64)
+        # Rows ascending within every list, so a list is read from the memory map in file order
+        self.rows = np.argsort(assignment, kind='stable')
+        self.offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=num_lists), out=self.offsets[1:])
+        return self
+
+    def search(self, vectors, queries, k=10, nprobe=None):
+        """ Approximate top k rows of vectors, the vectors the index was trained on.
+
+        Every probed list is read once and scored against all the queries
+        probing it in one matrix product.
+
+        Returns:
+            scores and row indices, both [num_queries, k], best first. Queries
+            with fewer than k candidates are padded with score -inf and row -1.
+        """
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        scores, indices = _empty_top_k(len(queries), k)
+        probe_lists = probes.ravel()
+        probe_queries = np.repeat(np.arange(len(queries)), nprobe)
+        order = np.argsort(probe_lists, kind='stable')
+        list_ids, starts = np.unique(probe_lists[order], return_index=True)
+        for l, group in zip(list_ids, np.split(probe_queries[order], starts[1:])):
+            rows = self.rows[self.offsets[l]:self.offsets[l + 1]]
+            if not len(rows):
+                continue
+            block = np.asarray(vectors[rows], dtype=np.float32)
+            scores[group], indices[group] = _merge_top_k(scores[group], indices[group], queries[group] @ block.T,
+                                                         rows, k)
+        return _sorted(scores, indices)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, rows=self.rows, offsets=self.offsets, nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(len(data['centroids']), int(data['nprobe']))
+        index.centroids, index.rows, index.offsets = data['centroids'], data['rows'], data['offsets']
+        return index
+
+
+def _unit(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
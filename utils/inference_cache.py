@@ -0,0 +1,192 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def model_fingerprint(model, config=None):
+    """ Content hash of the parameters and buffers of a model and a JSON serializable config """
+    digest = hashlib.sha1()
+    digest.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    for name, value in model.state_dict().items():
+        digest.update(name.encode('utf-8'))
+        _hash_value(digest, value)
+    return digest.hexdigest()
+
+
+def _hash_value(digest, value):
+    if isinstance(value, (tuple, list)):
+        # e.g. the packed weights of a dynamically quantized Linear layer
+        for item in value:
+            _hash_value(digest, item)
+    elif isinstance(value, torch.Tensor):
+        value = value.detach().cpu()
+        digest.update(str((value.dtype, tuple(value.shape))).encode('utf-8'))
+        if value.is_quantized:
+            if value.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+                _hash_value(digest, (value.q_per_channel_scales(), value.q_per_channel_zero_points()))
+            else:
+                digest.update(str((value.q_scale(), value.q_zero_point())).encode('utf-8'))
+            value = value.int_repr()
+        digest.update(value.contiguous().reshape(-1).view(torch.uint8).numpy())
+    else:
+        digest.update(repr(value).encode('utf-8'))
+
+
+class InferenceCache(object):
+    """ Content-addressed cache of model results with a memory and an optional disk tier.
+
+    A result is stored under a hash of the model fingerprint and the
+    normalized input, the text as the model's preprocessing sees it. The
+    fingerprint hashes the weights of the model and `config`, e.g.
+    max_seq_length and the label list. Before every lookup the cache checks
+    the in-place version counters of the parameters, which every optimizer
+    step or load_state_dict bumps, and rehashes the weights when they
+    changed, so results of an older model are never returned.
+
+    Results are kept JSON encoded in an LRU memory tier bounded by
+    `max_entries` and `max_bytes`. With `cache_dir` they are also written to
+    one file per entry under a directory per fingerprint, read on a memory
+    miss.
+
+    Args:
+        model: model whose results are cached
+        config: (Optional) JSON serializable settings the results depend on
+        max_entries: number of results in memory
+        max_bytes: bytes of encoded results in memory
+        cache_dir: (Optional) directory of the disk tier
+    """
+
+    def __init__(self, model, config=None, max_entries=100000, max_bytes=256 * 1024 ** 2, cache_dir=None):
+        self.model = model
+        self.config = config
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.counts = {'lookups': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'deduplicated': 0,
+                       'evictions': 0, 'disk_writes': 0, 'disk_bytes_written': 0, 'invalidations': 0}
+        self._versions = None
+        self.fingerprint = None
+        self.check_model()
+
+    def _parameter_versions(self):
+        return tuple((t.data_ptr(), t._version) for t in list(self.model.parameters()) + list(self.model.buffers()))
+
+    def check_model(self):
+        """ Rehashes the model when its weights may have changed and drops the results of an old model """
+        versions = self._parameter_versions()
+        if versions == self._versions:
+            return
+        self._versions = versions
+        fingerprint = model_fingerprint(self.model, self.config)
+        if fingerprint == self.fingerprint:
+            return
+        if self.fingerprint is not None:
+            self.counts['invalidations'] += 1
+            logger.info("Model changed, dropping {} cached results".format(len(self.memory)))
+        self.fingerprint = fingerprint
+        self.memory.clear()
+        self.memory_bytes = 0
+
+    def key(self, normalized_input):
+        return hashlib.sha1('{}\0{}'.format(self.fingerprint, normalized_input).encode('utf-8')).hexdigest()
+
+    def get_or_compute(self, inputs, compute):
+        """ Results of a batch of normalized inputs, computing only the missing ones.
+
+        Identical inputs of the batch are looked up and computed once.
+        `compute` maps a list of inputs to a list of JSON serializable results.
+        """
+        self.check_model()
+        keys = [self.key(i) for i in inputs]
+        self.counts['lookups'] += len(keys)
+        results, missing = {}, OrderedDict()
+        for key, normalized_input in zip(keys, inputs):
+            if key in results or key in missing:
+                self.counts['deduplicated'] += 1
+                continue
+            result = self.get(key)
+            if result is None:
+                missing[key] = normalized_input
+            else:
+                results[key] = result
+        if missing:
+            self.counts['misses'] += len(missing)
+            for key, result in zip(missing, compute(list(missing.values()))):
+                self.put(key, result)
+                results[key] = result
+        return [results[key] for key in keys]
+
+    def get(self, key):
+        encoded = self.memory.get(key)
+        if encoded is not None:
+            self.memory.move_to_end(key)
+            self.counts['memory_hits'] += 1
+            return json.loads(encoded)
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                encoded = f.read()
+            self.counts['disk_hits'] += 1
+            self._remember(key, encoded)
+            return json.loads(encoded)
+        return None
+
+    def put(self, key, result):
+        encoded = json.dumps(result).encode('utf-8')
+        self._remember(key, encoded)
+        path = self._path(key)
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+            self.counts['disk_writes'] += 1
+            self.counts['disk_bytes_written'] += len(encoded)
+
+    def _remember(self, key, encoded):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = encoded
+        self.memory_bytes += len(encoded)
+        while self.memory and (len(self.memory) > self.max_entries or self.memory_bytes > self.max_bytes):
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+            self.counts['evictions'] += 1
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, self.fingerprint[:16], key[:2], key + '.json')
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_bytes = 0
+
+    def stats(self):
+        counts = self.counts
+        hits = counts['memory_hits'] + counts['disk_hits'] + counts['deduplicated']
+        return dict(counts, hit_rate=hits / float(max(counts['lookups'], 1)), entries=len(self.memory),
+                    memory_bytes=self.memory_bytes, fingerprint=self.fingerprint[:16])
@@ -0,0 +1,223 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import torch
+
+SPECIAL_LABELS = ('<pad>', '[CLS]', '[SEP]')
+
+
+class NERMetrics(object):
+    """ Token and entity level metrics of an NER model accumulated on the device.
+
+    Predictions are kept as argmax ids next to a masked token-level confusion
+    matrix, so nothing is copied to the host per batch. Padding, [CLS] and
+    [SEP] positions are excluded. They are set to a sentinel rather than
+    filtered out, so every tensor of update() has the shape of the batch and
+    update() never waits for the device. Pending predictions are decoded to
+    tags only when the entity level F1 score is requested, and folded into
+    running entity counts, so the F1 score can be computed every N steps
+    during training without keeping an epoch of predictions around.
+
+    Args:
+        label_list: list of label names, index i is label id i
+        device: device the counts are kept on
+        ignore_labels: labels excluded from every metric
+    """
+
+    def __init__(self, label_list, device, ignore_labels=SPECIAL_LABELS):
+        self.label_list = label_list
+        self.num_labels = len(label_list)
+        self.device = device
+        # Lookup table of the ignored label ids
+        self.ignored = torch.tensor([label in ignore_labels for label in label_list], dtype=torch.bool,
+                                    device=device)
+        self.reset()
+
+    def reset(self):
+        self.confusion = torch.zeros((self.num_labels, self.num_labels), dtype=torch.long, device=self.device)
+        self.loss_sum = torch.zeros((), dtype=torch.float, device=self.device)
+        self.loss_count = torch.zeros((), dtype=torch.long, device=self.device)
+        self.entity_counts_sum = [0, 0, 0]
+        self.predictions, self.labels = [], []
+
+    def active(self, label_ids, input_mask):
+        """ Mask of the positions that are scored """
+        return input_mask.bool() & ~self.ignored[label_ids]
+
+    def update(self, logits, label_ids, input_mask):
+        """ Adds the predictions of a batch """
+        predictions = logits.detach().argmax(-1)
+        active = self.active(label_ids, input_mask)
+        self.confusion += confusion_counts(label_ids, predictions, self.num_labels, active)
+        # Positions that are not scored hold -1 and are dropped when the tags are decoded
+        self.predictions.append(torch.where(active, predictions, -1).to(torch.int16))
+        self.labels.append(torch.where(active, label_ids, -1).to(torch.int16))
+
+    def add_loss(self, loss, count=1):
+        """ Adds a summed loss over `count` items, e.g. tokens or batches """
+        self.loss_sum += loss.detach().float()
+        self.loss_count += count
+
+    def loss(self):
+        return self.loss_sum / self.loss_count.clamp(min=1)
+
+    def accuracy(self):
+        return self.confusion.diag().sum().float() / self.confusion.sum().clamp(min=1).float()
+
+    def tags(self):
+        """ Decodes the accumulated predictions to lists of tags, one list per sentence """
+        pred_tags, true_tags = [], []
+        for predictions, labels in zip(self.predictions, self.labels):
+            for sentence_predictions, sentence_labels in zip(predictions.tolist(), labels.tolist()):
+                pred_tags.append([self.label_list[p] for p in sentence_predictions if p >= 0])
+                true_tags.append([self.label_list[l] for l in sentence_labels if l >= 0])
+        return pred_tags, true_tags
+
+    def entity_counts(self):
+        """ Number of correct, predicted and true entities, as counted by seqeval """
+        from seqeval.metrics.sequence_labeling import get_entities
+        for pred_tags, true_tags in zip(*self.tags()):
+            pred_entities = set(get_entities(pred_tags))
+            true_entities = set(get_entities(true_tags))
+            self.entity_counts_sum[0] += len(pred_entities & true_entities)
+            self.entity_counts_sum[1] += len(pred_entities)
+            self.entity_counts_sum[2] += len(true_entities)
+        self.predictions, self.labels = [], []
+        return tuple(self.entity_counts_sum)
+
+    def f1_score(self):
+        """ Entity level micro F1 score, the same score as seqeval.metrics.f1_score """
+        return f1_from_counts(*self.entity_counts())
+
+    def reduced(self):
+        """ Copy of the metrics with the counts summed over all processes of
+        the torch.distributed group, every process has to call it.
+        """
+        import torch.distributed as dist
+        self.entity_counts()
+        metrics = copy.copy(self)
+        metrics.predictions, metrics.labels = [], []
+        metrics.confusion = self.confusion.clone()
+        metrics.loss_sum = self.loss_sum.clone()
+        metrics.loss_count = self.loss_count.clone()
+        entity_counts = torch.tensor(self.entity_counts_sum, dtype=torch.long, device=self.device)
+        if dist.is_available() and dist.is_initialized():
+            for tensor in (metrics.confusion, metrics.loss_sum, metrics.loss_count, entity_counts):
+                dist.all_reduce(tensor)
+        metrics.entity_counts_sum = entity_counts.tolist()
+        return metrics
+
+    def state_dict(self):
+        """ Accumulated counts, pending predictions are folded into the entity counts first """
+        self.entity_counts()
+        return {'confusion': self.confusion, 'loss_sum': self.loss_sum, 'loss_count': self.loss_count,
+                'entity_counts_sum': list(self.entity_counts_sum)}
+
+    def load_state_dict(self, state):
+        self.reset()
+        self.confusion = state['confusion'].to(self.device)
+        self.loss_sum = state['loss_sum'].to(self.device)
+        self.loss_count = state['loss_count'].to(self.device)
+        self.entity_counts_sum = list(state['entity_counts_sum'])
+
+
+def confusion_counts(label_ids, predictions, num_labels, active=None):
+    """ [num_labels, num_labels] confusion matrix of the positions of active, all positions by default.
+
+    Inactive positions are counted in an extra bin that is dropped, so the
+    shapes do not depend on the data and nothing waits for the device.
+    """
+    index = label_ids.reshape(-1) * num_labels + predictions.reshape(-1)
+    if active is not None:
+        index = torch.where(active.reshape(-1), index, num_labels ** 2)
+    counts = torch.zeros(num_labels ** 2 + 1, dtype=torch.long, device=index.device)
+    counts.scatter_add_(0, index, torch.ones_like(index))
+    return counts[:-1].view(num_labels, num_labels)
+
+
+def f1_from_counts(correct, predicted, true):
+    precision = correct / predicted if predicted > 0 else 0
+    recall = correct / true if true > 0 else 0
+    if precision + recall == 0:
+        return 0.0
+    return 2 * precision * recall / (precision + recall)
+
+
+class ClassificationMetrics(object):
+    """ Metrics of a sentence classification model accumulated on the device.
+
+    Has the interface of NERMetrics, so NERTrainer can log it, with one
+    prediction per example instead of per token. The F1 score is the macro
+    average over the labels.
+
+    Args:
+        label_list: list of label names, index i is label id i
+        device: device the counts are kept on
+    """
+
+    def __init__(self, label_list, device):
+        self.label_list = label_list
+        self.num_labels = len(label_list)
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.confusion = torch.zeros((self.num_labels, self.num_labels), dtype=torch.long, device=self.device)
+        self.loss_sum = torch.zeros((), dtype=torch.float, device=self.device)
+        self.loss_count = torch.zeros((), dtype=torch.long, device=self.device)
+
+    def update(self, logits, label_ids, input_mask=None):
+        """ Adds the predictions of a batch, input_mask is unused """
+        predictions = logits.detach().argmax(-1)
+        self.confusion += confusion_counts(label_ids, predictions, self.num_labels)
+
+    def add_loss(self, loss, count=1):
+        self.loss_sum += loss.detach().float()
+        self.loss_count += count
+
+    def loss(self):
+        return self.loss_sum / self.loss_count.clamp(min=1)
+
+    def accuracy(self):
+        return self.confusion.diag().sum().float() / self.confusion.sum().clamp(min=1).float()
+
+    def f1_score(self):
+        """ Macro F1 score over the labels that are predicted or true at least once """
+        confusion = self.confusion.tolist()
+        counts = [(confusion[i][i], sum(row[i] for row in confusion), sum(confusion[i]))
+                  for i in range(self.num_labels)]
+        scores = [f1_from_counts(*c) for c in counts if c[1] or c[2]]
+        return sum(scores) / max(len(scores), 1)
+
+    def reduced(self):
+        """ Copy of the metrics with the counts summed over all processes, every process has to call it """
+        import torch.distributed as dist
+        metrics = copy.copy(self)
+        metrics.confusion = self.confusion.clone()
+        metrics.loss_sum = self.loss_sum.clone()
+        metrics.loss_count = self.loss_count.clone()
+        if dist.is_available() and dist.is_initialized():
+            for tensor in (metrics.confusion, metrics.loss_sum, metrics.loss_count):
+                dist.all_reduce(tensor)
+        return metrics
+
+    def state_dict(self):
+        return {'confusion': self.confusion, 'loss_sum': self.loss_sum, 'loss_count': self.loss_count}
+
+    def load_state_dict(self, state):
+        self.confusion = state['confusion'].to(self.device)
+        self.loss_sum = state['loss_sum'].to(self.device)
+        self.loss_count = state['loss_count'].to(self.device)
@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from .datasets import DynamicPaddingCollator
+
+logger = logging.getLogger(__name__)
+
+
+class PackedDataset(Dataset):
+    """ Packs several examples into one sequence of at most max_seq_length wordpieces.
+
+    Every item is a tuple (input_ids, packed_mask, segment_ids, label_ids, position_ids).
+    packed_mask holds the 1-based number of the example every token belongs
+    to and 0 for padding, so it still works as an input mask. packed_forward
+    turns it into a block-diagonal attention mask so packed examples do not
+    attend to each other, and position_ids restart at 0 for every example.
+
+    For NER the wordpiece labels are concatenated. For classification the
+    label of every example is placed at its [CLS] position.
+
+    Args:
+        dataset: dataset of feature tuples (input_ids, input_mask, segment_ids, label_id),
+            padded or not, e.g. utils.datasets.BertDataset or utils.processors.BertDataset
+        max_seq_length: length of a packed sequence
+        task: 'ner' or 'classification'
+    """
+
+    def __init__(self, dataset, max_seq_length=128, task='ner'):
+        self.dataset = dataset
+        self.max_seq_length = max_seq_length
+        self.task = task
+        if hasattr(dataset, 'lengths'):
+            self.example_lengths = list(dataset.lengths())
+        else:
+            self.example_lengths = [int((dataset[i][1] != 0).sum()) for i in range(len(dataset))]
+        # Longer examples are truncated, as pack_lengths counts them
+        self.example_lengths = [min(length, max_seq_length) for length in self.example_lengths]
+        self.packs = pack_lengths(self.example_lengths, max_seq_length)
+        logger.info("Packed {} examples into {} sequences, packing efficiency {:.1%}".format(
+            len(self.example_lengths), len(self.packs), self.packing_efficiency()))
+
+    def __len__(self):
+        return len(self.packs)
+
+    def lengths(self):
+        return [sum(self.example_lengths[i] for i in pack) for pack in self.packs]
+
+    def packing_efficiency(self):
+        """ Real tokens divided by the total number of token slots """
+        return sum(self.example_lengths) / float(max(len(self.packs), 1) * self.max_seq_length)
+
+    def __getitem__(self, index):
+        input_ids, packed_mask, segment_ids, label_ids, position_ids = [], [], [], [], []
+        for number, example_index in enumerate(self.packs[index], 1):
+            example = self.dataset[example_index]
+            length = self.example_lengths[example_index]
+            input_ids.append(example[0][:length])
+            segment_ids.append(example[2][:length])
+            packed_mask.append(torch.full((length,), number, dtype=torch.long))
+            position_ids.append(torch.arange(length, dtype=torch.long))
+            if self.task == 'ner':
+                label_ids.append(example[3][:length])
+            else:
+                labels = torch.zeros(length, dtype=torch.long)
+                labels[0] = example[3]
+                label_ids.append(labels)
+        return tuple(torch.cat(feature) for feature in (input_ids, packed_mask, segment_ids, label_ids, position_ids))
+
+
+def pack_lengths(lengths, max_seq_length):
+    """ Best-fit decreasing bin packing of example lengths into bins of max_seq_length.
+
+    Returns a list of packs, each a list of example indices.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    # bins_by_space[r] holds the packs with r free slots left
+    bins_by_space = [[] for _ in range(max_seq_length + 1)]
+    packs = []
+    for i in order:
+        length = min(lengths[i], max_seq_length)
+        for space in range(length, max_seq_length + 1):
+            if bins_by_space[space]:
+                pack = bins_by_space[space].pop()
+                break
+        else:
+            pack, space = len(packs), max_seq_length
+            packs.append([])
+        packs[pack].append(i)
+        bins_by_space[space - length].append(pack)
+    return packs
+
+
+def packed_dataloader(dataset, batch_size=32, max_seq_length=128, task='ner', shuffle=True, num_workers=0):
+    """ Creates a DataLoader of packed sequences padded to the longest pack in the batch """
+    packed = dataset if isinstance(dataset, PackedDataset) else PackedDataset(dataset, max_seq_length, task)
+    return DataLoader(packed, batch_size=batch_size, shuffle=shuffle, collate_fn=DynamicPaddingCollator(),
+                      num_workers=num_workers)
+
+
+def block_diagonal_mask(packed_mask, dtype):
+    """ Additive attention mask [batch, 1, seq, seq] letting tokens attend only within their example """
+    allowed = (packed_mask[:, :, None] == packed_mask[:, None, :]) & (packed_mask[:, None, :] != 0)
+    return (1.0 - allowed[:, None].to(dtype=dtype)) * -10000.0
+
+
+def packed_forward(model, input_ids, packed_mask, segment_ids, position_ids, task='ner'):
+    """ Forward pass of a pytorch_pretrained_bert model on packed sequences.
+
+    Runs the embeddings with the restarting position_ids and the encoder with
+    a block-diagonal attention mask. For 'ner' it returns token logits
+    [batch, seq, num_labels] like BertForTokenClassification. For
+    'classification' it returns the logits of every packed example,
+    [num_examples, num_labels], in the order of classification_positions.
+    """
+    bert = model.bert
+    embeddings = bert.embeddings
+    hidden = (embeddings.word_embeddings(input_ids) + embeddings.position_embeddings(position_ids) +
+              embeddings.token_type_embeddings(segment_ids))
+    hidden = embeddings.dropout(embeddings.LayerNorm(hidden))
+    attention_mask = block_diagonal_mask(packed_mask, next(bert.parameters()).dtype)
+    sequence_output = bert.encoder(hidden, attention_mask, output_all_encoded_layers=False)[-1]
+
+    if task == 'ner':
+        return model.classifier(model.dropout(sequence_output))
+    cls_output = sequence_output[classification_positions(packed_mask, position_ids)]
+    pooled_output = bert.pooler.activation(bert.pooler.dense(cls_output))
+    return model.classifier(model.dropout(pooled_output))
+
+
+def classification_positions(packed_mask, position_ids):
+    """ Mask of the [CLS] positions of the packed examples """
+    return (position_ids == 0) & (packed_mask != 0)
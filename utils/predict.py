@@ -0,0 +1,188 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+import numpy as np
+import torch
+
+from .processors import align_wordpieces
+
+logger = logging.getLogger(__name__)
+
+
+class NERPredictor(object):
+    """ Batched NER prediction on raw texts of any length.
+
+    Texts are split on spaces into words, as NERProcessor does, and tokenized
+    once. Texts longer than max_seq_length are split into overlapping windows
+    of wordpieces. The windows of all texts are sorted by length and packed
+    into full batches, the logits of overlapping wordpieces are averaged, and
+    every word gets the prediction of its first wordpiece, the same position
+    its label was trained on.
+
+    With a utils.inference_cache.InferenceCache the word tags of a text are
+    cached under the text as it is tokenized, lowercased with do_lower_case,
+    and repeated texts, also within one call, are only run once.
+
+    Args:
+        model: fine-tuned BertForTokenClassification
+        tokenizer: BertTokenizer used to tokenize to Wordpieces and transform to indices
+        label_list: list of label names, index i is label id i
+        wordpiece_conll_map: map from a label to the label of the following
+            wordpieces of the same word, e.g. NERProcessor.wordpiece_conll_map
+        max_seq_length: length of the windows, including [CLS] and [SEP]
+        stride: (Optional) number of wordpieces between the starts of two
+            windows, defaults to half a window
+        batch_size: number of windows in a batch
+        do_lower_case: lowercase the texts before tokenizing
+        cache: (Optional) InferenceCache of the word tags
+    """
+
+    def __init__(self, model, tokenizer, label_list, wordpiece_conll_map, max_seq_length=128, stride=None,
+                 batch_size=32, do_lower_case=True, device=None, cache=None):
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device)
+        self.tokenizer = tokenizer
+        self.label_list = label_list
+        self.wordpiece_conll_map = wordpiece_conll_map
+        self.max_seq_length = max_seq_length
+        self.window_length = max_seq_length - 2
+        self.stride = stride or max(self.window_length // 2, 1)
+        self.batch_size = batch_size
+        self.do_lower_case = do_lower_case
+        self.cls_id, self.sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        self.cache = cache
+        self.stats = {}
+
+        # B_X -> I_X pairs of the map, every other label is outside an entity
+        self.begin_labels = {k: v for k, v in wordpiece_conll_map.items() if k != v}
+        self.inside_labels = set(self.begin_labels.values())
+
+    @classmethod
+    def from_processor(cls, model, processor, **kwargs):
+        return cls(model, processor.tokenizer, processor.get_label_list(), processor.wordpiece_conll_map,
+                   do_lower_case=processor.do_lower_case, **kwargs)
+
+    def predict(self, texts):
+        """ Predicts the entities of every text.
+
+        Returns a list with a dict per text holding the `words`, one tag per
+        word in `tags` and `entities`, a list of dicts with the entity `type`,
+        the `start` and exclusive `end` word index and the entity `text`.
+        """
+        normalized = [text.lower() if self.do_lower_case else text for text in texts]
+        if self.cache is not None:
+            tags = self.cache.get_or_compute(normalized, self.predict_tags)
+        else:
+            tags = self.predict_tags(normalized)
+        return [self.decode(text, text_tags) for text, text_tags in zip(texts, tags)]
+
+    def predict_tags(self, texts):
+        """ Tag of every space separated word of every text, the texts already lowercased if needed """
+        start_time = time.time()
+        alignments = [align_wordpieces(self.tokenizer, text.split(' ')) for text in texts]
+
+        windows = [(doc, start) for doc, alignment in enumerate(alignments)
+                   for start in self.window_starts(len(alignment))]
+        logit_sums = [np.zeros((len(alignment), len(self.label_list)), dtype=np.float32) for alignment in alignments]
+        counts = [np.zeros((len(alignment), 1), dtype=np.float32) for alignment in alignments]
+
+        # Windows of similar length share a batch to keep the padding small
+        windows.sort(key=lambda window: min(len(alignments[window[0]]) - window[1], self.window_length))
+        num_tokens = 0
+        self.model.eval()
+        with torch.inference_mode():
+            for i in range(0, len(windows), self.batch_size):
+                batch_windows = windows[i:i + self.batch_size]
+                input_ids, input_mask = self.batch_tensors(batch_windows, alignments)
+                logits = self.model(input_ids, token_type_ids=torch.zeros_like(input_ids), attention_mask=input_mask)
+                logits = logits.float().cpu().numpy()
+                num_tokens += int(input_mask.sum())
+                for row, (doc, start) in enumerate(batch_windows):
+                    length = min(len(alignments[doc]) - start, self.window_length)
+                    logit_sums[doc][start:start + length] += logits[row, 1:length + 1]
+                    counts[doc][start:start + length] += 1
+
+        results = []
+        for alignment, logit_sum, count, text in zip(alignments, logit_sums, counts, texts):
+            predictions = (logit_sum / np.maximum(count, 1)).argmax(-1)
+            results.append(self.word_tags(len(text.split(' ')), alignment, predictions))
+
+        elapsed = time.time() - start_time
+        self.stats = {'texts': len(texts), 'windows': len(windows), 'tokens': num_tokens,
+                      'seconds': elapsed, 'tokens_per_second': num_tokens / max(elapsed, 1e-9)}
+        logger.info("Predicted {} texts, {} windows, {} tokens in {:.2f}s ({:.0f} tokens/s)".format(
+            len(texts), len(windows), num_tokens, elapsed, self.stats['tokens_per_second']))
+        return results
+
+    def window_starts(self, num_wordpieces):
+        """ Start of every window covering a text of num_wordpieces wordpieces """
+        starts = list(range(0, max(num_wordpieces - self.window_length, 0) + 1, self.stride))
+        if starts[-1] + self.window_length < num_wordpieces:
+            starts.append(num_wordpieces - self.window_length)
+        return starts
+
+    def batch_tensors(self, batch_windows, alignments):
+        lengths = [min(len(alignments[doc]) - start, self.window_length) for doc, start in batch_windows]
+        input_ids = np.zeros((len(batch_windows), max(lengths) + 2), dtype=np.int64)
+        input_mask = np.zeros_like(input_ids)
+        for row, ((doc, start), length) in enumerate(zip(batch_windows, lengths)):
+            input_ids[row, 0] = self.cls_id
+            input_ids[row, 1:length + 1] = alignments[doc].input_ids[start:start + length]
+            input_ids[row, length + 1] = self.sep_id
+            input_mask[row, :length + 2] = 1
+        return torch.from_numpy(input_ids).to(self.device), torch.from_numpy(input_mask).to(self.device)
+
+    def word_tags(self, num_words, alignment, predictions):
+        """ Maps wordpiece predictions to word tags, the prediction of the first wordpiece of every word """
+        tags = ['O'] * num_words
+        seen = set()
+        for position, word_index in enumerate(alignment.word_ids):
+            if word_index not in seen:
+                seen.add(word_index)
+                tags[word_index] = self.label_list[predictions[position]]
+        return tags
+
+    def decode(self, text, tags):
+        """ Result of a text with its word tags """
+        words = text.split(' ')
+        return {'words': words, 'tags': tags, 'entities': self.entities(words, tags)}
+
+    def entities(self, words, tags):
+        """ Entity spans of word tags, an entity continues while the tag is the
+        wordpiece_conll_map continuation of the tag that started it.
+        """
+        entities, current = [], None
+        for i, tag in enumerate(tags + ['O']):
+            if current is not None and tag == current['inside'] and tag not in self.begin_labels:
+                continue
+            if current is not None:
+                entities.append({'type': entity_type(current['inside']), 'start': current['start'], 'end': i,
+                                 'text': ' '.join(words[current['start']:i])})
+                current = None
+            if tag in self.begin_labels:
+                current = {'start': i, 'inside': self.begin_labels[tag]}
+            elif tag in self.inside_labels:
+                current = {'start': i, 'inside': tag}
+        return entities
+
+
+def entity_type(label):
+    """ Entity type of a label, 'I_COMP' -> 'COMP' """
+    for separator in ('_', '-'):
+        if separator in label:
+            return label.split(separator, 1)[1]
+    return label
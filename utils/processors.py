@@ -15,13 +15,16 @@
 
 import os
 import csv
+import time
 import logging
 import numpy as np
-import pandas as pd
 import torch
-from sklearn.model_selection import train_test_split
+from concurrent.futures import ProcessPoolExecutor
 from torch.utils.data import TensorDataset
 
+from .store import ExampleStore, ExampleStoreBuilder
+from .tokenization import token_ids
+
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
                     level = logging.INFO)
@@ -30,7 +33,7 @@ logger = logging.getLogger(__name__)
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
 
-    def __init__(self, guid, text_a, text_b=None, label=None):
+    def __init__(self, guid, text_a, text_b=None, label=None, alignment=None):
         """Constructs a InputExample.
 
         Args:
@@ -41,11 +44,14 @@ class InputExample(object):
             Only must be specified for sequence pair tasks.
             label: (Optional) string. The label of the example. This should be
             specified for train and dev examples, but not for test examples.
+            alignment: (Optional) WordpieceAlignment of text_a. When given the
+            text is not tokenized again.
         """
         self.guid = guid
         self.text_a = text_a
         self.text_b = text_b
         self.label = label
+        self.alignment = alignment
 
 class InputFeatures(object):
     """A single set of features of data."""
@@ -74,12 +80,15 @@ class DataProcessor(object):
     @classmethod
     def _read_tsv(cls, input_file, delimiter='\t', quotechar=None):
         """Reads a tab separated value file."""
+        return list(cls._iter_tsv(input_file, delimiter=delimiter, quotechar=quotechar))
+
+    @classmethod
+    def _iter_tsv(cls, input_file, delimiter='\t', quotechar=None):
+        """Reads a tab separated value file one line at a time."""
         with open(input_file, "r", encoding='utf-8') as f:
             reader = csv.reader(f, delimiter=delimiter, quotechar=quotechar)
-            lines = []
             for line in reader:
-                lines.append(line)
-            return lines
+                yield line
         
 class SentenceProcessor(DataProcessor):
 
@@ -98,16 +107,15 @@ class SentenceProcessor(DataProcessor):
         return ["0", "1"]
 
     def _create_examples(self, lines, set_type):
-        """Creates examples for the training and dev sets."""
-        examples = []
+        """Creates an `ExampleStore` of the training or dev set, guids numbered
+        by line like the InputExamples it replaces."""
+        # Line 0 is the header
+        examples = ExampleStoreBuilder(self.get_labels(), set_type, first_index=1)
         for (i, line) in enumerate(lines):
             if i == 0:
                 continue
-            guid = "%s-%s" % (set_type, i)
-            text_a = line[1]
-            label = line[0]
-            examples.append(InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-        return examples
+            examples.add(line[1], label=line[0])
+        return examples.build()
         
    
 class NERProcessor(DataProcessor):
@@ -128,64 +136,114 @@ class NERProcessor(DataProcessor):
         
     label_list = ['<pad>', '[CLS]','[SEP]', 'O', 'B_COMP','I_COMP']
     
+    data_files = {'train': 'train.csv', 'val': 'valid.csv', 'test': 'test.csv'}
+    
     def __init__(self, path, tokenizer, do_lower_case=True, separator='\t'):
+        self.path = path
         self.separator = separator
-        self.train_data = self._read_csv(path + 'train.csv')
-        self.valid_data = self._read_csv(path + 'valid.csv')
-        self.test_data = self._read_csv(path + 'test.csv')
         self.tokenizer = tokenizer
         self.do_lower_case = do_lower_case
+        self._data = {}
         
+    # The csv files are read on first use, so a warm start from a
+    # utils.cache.FeatureCache never has to parse them.
+    @property
+    def train_data(self):
+        return self.get_data('train')
+    
+    @property
+    def valid_data(self):
+        return self.get_data('val')
+    
+    @property
+    def test_data(self):
+        return self.get_data('test')
+    
+    def get_data(self, set_type):
+        if set_type not in self._data:
+            self._data[set_type] = self._read_csv(self.get_source_file(set_type))
+        return self._data[set_type]
+    
+    def get_source_file(self, set_type):
+        return self.path + self.data_files[set_type]
+    
+    def get_examples(self, set_type):
+        return self._create_examples(self.get_data(set_type), set_type)
     
     def get_train_examples(self):        
-        return self._create_examples(self.train_data, 'train')
+        return self.get_examples('train')
     
     def get_val_examples(self):        
-        return self._create_examples(self.valid_data, 'val')
+        return self.get_examples('val')
     
     def get_test_examples(self):        
-        return self._create_examples(self.test_data, 'test')
+        return self.get_examples('test')
     
     def get_label_list(self):
         return self.label_list
         
     def _read_csv(self, path):
+        import pandas as pd
 
         data = pd.read_csv(path, names=['labels', 'text'], header=1, sep=self.separator)
         
         return data
         
+    def _iter_csv(self, path, chunksize=10000):
+        """Reads the csv file in DataFrame chunks of `chunksize` rows."""
+        import pandas as pd
+        for chunk in pd.read_csv(path, names=['labels', 'text'], header=1, sep=self.separator, chunksize=chunksize):
+            yield chunk
+        
+    def iter_examples(self, set_type, shard_id=0, num_shards=1, chunksize=10000):
+        """Streams the examples of a split without loading the file into memory.
+
+        Only every `num_shards`-th row starting at `shard_id` is tokenized, so
+        DataLoader workers can split a file between them.
+        """
+        self.token_count = 0
+        i = 0
+        for chunk in self._iter_csv(self.get_source_file(set_type), chunksize):
+            for row in chunk.itertuples():
+                if i % num_shards == shard_id:
+                    yield self._create_example(row, "%s-%s" % (set_type, i))
+                i += 1
+        
     def _create_examples(self, data, set_type):
-        examples = []
+        """Creates an `ExampleStore` of a split, holding the aligned wordpiece
+        ids and labels as arrays instead of one InputExample per row."""
+        examples = ExampleStoreBuilder(self.label_list, set_type)
         self.token_count = 0
         
-        for i, row in enumerate(data.itertuples()):
-            if self.do_lower_case:
-                text_a = row.text.lower()
-            else:
-                text_a = row.text
-                
-            labels = row.labels
-            conll_sentence = zip(text_a.split(' '), labels.split(' '))
-             
-            guid = "%s-%s" % (set_type, i)
-            labels = self.bert_labels(conll_sentence)
-            examples.append(InputExample(guid=guid, text_a=text_a, text_b='', label=labels))   
-        return examples
+        for row in data.itertuples():
+            text_a = row.text.lower() if self.do_lower_case else row.text
+            alignment = self.align(text_a.split(' '), row.labels.split(' '))
+            examples.add(text_a, label=alignment.labels, alignment=alignment)
+        return examples.build()
+    
+    def _create_example(self, row, guid):
+        if self.do_lower_case:
+            text_a = row.text.lower()
+        else:
+            text_a = row.text
+            
+        alignment = self.align(text_a.split(' '), row.labels.split(' '))
+        return InputExample(guid=guid, text_a=text_a, text_b='', label=alignment.labels, alignment=alignment)
+    
+    def align(self, words, labels=None):
+        """Tokenizes a sentence word by word into a `WordpieceAlignment`."""
+        alignment = align_wordpieces(self.tokenizer, words, labels, self.wordpiece_conll_map)
+        self.token_count += len(words) if labels is None else min(len(words), len(labels))
+        return alignment
     
     def bert_labels(self, conll_sentence):
-        bert_labels = []
-        bert_labels.append('[CLS]')
-        for conll in conll_sentence:
-            self.token_count += 1
-            token, label = conll[0], conll[1]
-            bert_tokens = self.tokenizer.tokenize(token)
-            bert_labels.append(label)
-            for bert_token in bert_tokens[1:]:
-                bert_labels.append(self.wordpiece_conll_map[label])
-        return bert_labels
+        words, labels = [], []
+        for token, label in conll_sentence:
+            words.append(token)
+            labels.append(label)
+        return self.align(words, labels).labels
     
-class ConllNERProcessor(DataProcessor):
+class ConllNERProcessor(NERProcessor):
     
     wordpiece_conll_map = { 
         'O':'O', 'B_PER':'I_PER', 'B_ORG':'I_ORG', 'B_LOC':'I_LOC', 'B_MISC':'I_MISC',
@@ -197,57 +255,56 @@ class ConllNERProcessor(DataProcessor):
                   'I_PER', 'I_ORG','I_LOC', 'I_MISC']
     
     def __init__(self, path, tokenizer, do_lower_case=True):
-        self.train_data = self._read_csv(path + 'train.csv')
-        self.valid_data = self._read_csv(path + 'valid.csv')
-        self.test_data = self._read_csv(path + 'test.csv')
-        self.tokenizer = tokenizer
-        self.do_lower_case = do_lower_case
-    
-    def get_train_examples(self):        
-        return self._create_examples(self.train_data, 'train')
-    
-    def get_val_examples(self):        
-        return self._create_examples(self.valid_data, 'val')
-    
-    def get_test_examples(self):        
-        return self._create_examples(self.test_data, 'test')
-    
-    def get_label_list(self):
-        return self.label_list
-        
-    def _read_csv(self, path):
-        data = pd.read_csv(path, names=['labels', 'text'], header=1)
-        return data
-        
-    def _create_examples(self, data, set_type):
-        examples = []
-        self.token_count = 0
-        
-        for i, row in enumerate(data.itertuples()):
-            if self.do_lower_case:
-                text_a = row.text.lower()
-            else:
-                text_a = row.text
-    
-            labels = row.labels
-            conll_sentence = zip(text_a.split(' '), labels.split(' '))
-             
-            guid = "%s-%s" % (set_type, i)
-            labels = self.bert_labels(conll_sentence)
-            examples.append(InputExample(guid=guid, text_a=text_a, text_b='', label=labels))   
-        return examples
-    
-    def bert_labels(self, conll_sentence):
-        bert_labels = []
-        bert_labels.append('[CLS]')
-        for conll in conll_sentence:
-            self.token_count += 1
-            token, label = conll[0], conll[1]
-            bert_tokens = self.tokenizer.tokenize(token)
+        super(ConllNERProcessor, self).__init__(path, tokenizer, do_lower_case=do_lower_case, separator=',')
+
+class WordpieceAlignment(object):
+    """Wordpieces of a sentence aligned with the words they were tokenized from."""
+
+    def __init__(self, tokens, input_ids, labels, word_ids):
+        """Constructs a WordpieceAlignment.
+
+        Args:
+            tokens: list of wordpieces, without [CLS] and [SEP]. None for the
+            alignments of an `ExampleStore`, which only keeps the ids.
+            input_ids: vocabulary index of every wordpiece.
+            labels: (Optional) wordpiece labels starting with '[CLS]', the same
+            labels `NERProcessor.bert_labels` produces. None when the sentence
+            has no labels, e.g. at prediction time.
+            word_ids: index of the word every wordpiece belongs to.
+        """
+        self.tokens = tokens
+        self.input_ids = input_ids
+        self.labels = labels
+        self.word_ids = word_ids
+
+    def __len__(self):
+        return len(self.input_ids)
+
+def align_wordpieces(tokenizer, words, labels=None, wordpiece_conll_map=None):
+    """Tokenizes every word once and aligns wordpieces, ids and labels.
+
+    The first wordpiece of a word gets the word label, the following wordpieces
+    get the label mapped through `wordpiece_conll_map`. Words without any
+    wordpieces are skipped so the labels never drift from the ids.
+    """
+    input_ids, word_ids = [], []
+    bert_labels = None if labels is None else ['[CLS]']
+    if labels is not None:
+        words = words[:len(labels)]
+
+    for word_index, word in enumerate(words):
+        word_tokens = token_ids(tokenizer, word)
+        if not word_tokens:
+            continue
+        input_ids.extend(word_tokens)
+        word_ids.extend([word_index] * len(word_tokens))
+        if bert_labels is not None:
+            label = labels[word_index]
             bert_labels.append(label)
-            for bert_token in bert_tokens[1:]:
-                bert_labels.append(self.wordpiece_conll_map[label])
-        return bert_labels
+            bert_labels.extend([wordpiece_conll_map[label]] * (len(word_tokens) - 1))
+
+    tokens = tokenizer.convert_ids_to_tokens(input_ids)
+    return WordpieceAlignment(tokens, input_ids, bert_labels, word_ids)
     
 def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
     """Loads a data file into a list of `InputBatch`s."""
@@ -256,98 +313,205 @@ def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer
 
     features = []
     for (ex_index, example) in enumerate(examples):
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = None
-        if example.text_b:
-            tokens_b = tokenizer.tokenize(example.text_b)
-            # Modifies `tokens_a` and `tokens_b` in place so that the total
-            # length is less than the specified length.
-            # Account for [CLS], [SEP], [SEP] with "- 3"
-            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-        else:
-            # Account for [CLS] and [SEP] with "- 2"
-            if len(tokens_a) > max_seq_length - 2:
-                tokens_a = tokens_a[:(max_seq_length - 2)]
-
-        # The convention in BERT is:
-        # (a) For sequence pairs:
-        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
-        # (b) For single sequences:
-        #  tokens:   [CLS] the dog is hairy . [SEP]
-        #  type_ids: 0   0   0   0  0     0 0
-        #
-        # Where "type_ids" are used to indicate whether this is the first
-        # sequence or the second sequence. The embedding vectors for `type=0` and
-        # `type=1` were learned during pre-training and are added to the wordpiece
-        # embedding vector (and position vector). This is not *strictly* necessary
-        # since the [SEP] token unambigiously separates the sequences, but it makes
-        # it easier for the model to learn the concept of sequences.
-        #
-        # For classification tasks, the first vector (corresponding to [CLS]) is
-        # used as as the "sentence vector". Note that this only makes sense because
-        # the entire model is fine-tuned.
-        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
-
-        if tokens_b:
-            tokens += tokens_b + ["[SEP]"]
-            segment_ids += [1] * (len(tokens_b) + 1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+        features.append(convert_example_to_features(example, label_map, max_seq_length, tokenizer, ex_index))
+    return features
 
+def convert_example_to_features(example, label_map, max_seq_length, tokenizer, ex_index=None):
+    """Converts a single `InputExample` into `InputFeatures` padded to `max_seq_length`."""
+
+    # Wordpiece ids, aligned examples are not tokenized again
+    alignment = getattr(example, 'alignment', None)
+    if alignment is not None:
+        tokens_a = list(alignment.input_ids)
+    else:
+        tokens_a = token_ids(tokenizer, example.text_a)
+
+    tokens_b = None
+    if example.text_b:
+        tokens_b = token_ids(tokenizer, example.text_b)
+        # Modifies `tokens_a` and `tokens_b` in place so that the total
+        # length is less than the specified length.
+        # Account for [CLS], [SEP], [SEP] with "- 3"
+        _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+    else:
+        # Account for [CLS] and [SEP] with "- 2"
+        if len(tokens_a) > max_seq_length - 2:
+            tokens_a = tokens_a[:(max_seq_length - 2)]
+
+    # The convention in BERT is:
+    # (a) For sequence pairs:
+    #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+    #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
+    # (b) For single sequences:
+    #  tokens:   [CLS] the dog is hairy . [SEP]
+    #  type_ids: 0   0   0   0  0     0 0
+    #
+    # Where "type_ids" are used to indicate whether this is the first
+    # sequence or the second sequence. The embedding vectors for `type=0` and
+    # `type=1` were learned during pre-training and are added to the wordpiece
+    # embedding vector (and position vector). This is not *strictly* necessary
+    # since the [SEP] token unambigiously separates the sequences, but it makes
+    # it easier for the model to learn the concept of sequences.
+    #
+    # For classification tasks, the first vector (corresponding to [CLS]) is
+    # used as as the "sentence vector". Note that this only makes sense because
+    # the entire model is fine-tuned.
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    input_ids = [cls_id] + tokens_a + [sep_id]
+    segment_ids = [0] * len(input_ids)
+
+    if tokens_b:
+        input_ids += tokens_b + [sep_id]
+        segment_ids += [1] * (len(tokens_b) + 1)
+
+    # The mask has 1 for real tokens and 0 for padding tokens. Only real
+    # tokens are attended to.
+    input_mask = [1] * len(input_ids)
+
+    # Zero-pad up to the sequence length.
+    padding = [0] * (max_seq_length - len(input_ids))
+    input_ids += padding
+    input_mask += padding
+    segment_ids += padding
+
+    assert len(input_ids) == max_seq_length
+    assert len(input_mask) == max_seq_length
+    assert len(segment_ids) == max_seq_length
+
+    if isinstance(example.label, list):
+        # NER: one label per wordpiece, padded with the '<pad>' label
+        label_id = [label_map[label] for label in example.label[:max_seq_length]]
+        label_id += [0] * (max_seq_length - len(label_id))
+    else:
         label_id = label_map[example.label]
-        if ex_index < 5:
-            logger.debug("*** Example ***")
-            logger.debug("guid: %s" % (example.guid))
-            logger.debug("tokens: %s" % " ".join(
-                    [str(x) for x in tokens]))
-            logger.debug("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            logger.debug("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            logger.debug("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-            logger.debug("label: %s (id = %d)" % (example.label, label_id))
-
-        features.append(
-                InputFeatures(input_ids=input_ids,
-                              input_mask=input_mask,
-                              segment_ids=segment_ids,
-                              label_id=label_id))
-    return features
+    if ex_index is not None and ex_index < 5:
+        logger.debug("*** Example ***")
+        logger.debug("guid: %s" % (example.guid))
+        logger.debug("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+        logger.debug("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+        logger.debug("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+        logger.debug("label: %s (id = %s)" % (example.label, label_id))
+
+    return InputFeatures(input_ids=input_ids,
+                         input_mask=input_mask,
+                         segment_ids=segment_ids,
+                         label_id=label_id)
+
+def convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, num_workers=1, chunk_size=2000):
+    """Converts examples straight into preallocated fixed-dtype numpy arrays.
+
+    Returns a dict with `input_ids`, `input_mask`, `segment_ids`, `label_ids`
+    and `lengths` (number of real wordpieces) without keeping a list of
+    `InputFeatures` around. `label_ids` has one row per example for NER
+    examples and a single label per example otherwise.
+
+    With `num_workers` > 1 the examples are split into chunks of `chunk_size`
+    and converted in a process pool. The tokenizer is sent once to every
+    worker and each chunk is written back at its own offset, so the output is
+    identical to the single process conversion.
+    """
+    label_map = {label : i for i, label in enumerate(label_list)}
+    num_examples = len(examples)
+    if isinstance(examples, ExampleStore):
+        token_labels = examples.token_labels
+    else:
+        token_labels = num_examples > 0 and isinstance(examples[0].label, list)
+    arrays = _allocate_arrays(num_examples, max_seq_length, token_labels)
+
+    start_time = time.time()
+    if num_workers > 1 and num_examples > chunk_size:
+        chunks = [(offset, examples[offset:offset + chunk_size]) for offset in range(0, num_examples, chunk_size)]
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_conversion_worker,
+                                 initargs=(tokenizer, label_map, max_seq_length, token_labels)) as executor:
+            for offset, chunk_arrays in executor.map(_convert_chunk, chunks):
+                for name in arrays:
+                    arrays[name][offset:offset + len(chunk_arrays['lengths'])] = chunk_arrays[name]
+    else:
+        _fill_arrays(arrays, examples, label_map, max_seq_length, tokenizer)
+
+    elapsed = time.time() - start_time
+    logger.info("Converted {} examples in {:.1f}s ({:.0f} examples/s, {} workers)".format(
+        num_examples, elapsed, num_examples / max(elapsed, 1e-9), max(num_workers, 1)))
+    return arrays
+
+def _allocate_arrays(num_examples, max_seq_length, token_labels):
+    return {
+        'input_ids': np.zeros((num_examples, max_seq_length), dtype=np.int32),
+        'input_mask': np.zeros((num_examples, max_seq_length), dtype=np.int8),
+        'segment_ids': np.zeros((num_examples, max_seq_length), dtype=np.int8),
+        'label_ids': np.zeros((num_examples, max_seq_length) if token_labels else (num_examples,), dtype=np.int16),
+        'lengths': np.zeros((num_examples,), dtype=np.int32),
+    }
+
+def _fill_arrays(arrays, examples, label_map, max_seq_length, tokenizer, offset=0):
+    if isinstance(examples, ExampleStore) and examples.has_alignment and 'text_b' not in examples.columns:
+        _fill_arrays_from_store(arrays, examples, label_map, max_seq_length, tokenizer)
+        return
+    for (i, example) in enumerate(examples):
+        feature = convert_example_to_features(example, label_map, max_seq_length, tokenizer, offset + i)
+        arrays['input_ids'][i] = feature.input_ids
+        arrays['input_mask'][i] = feature.input_mask
+        arrays['segment_ids'][i] = feature.segment_ids
+        arrays['label_ids'][i] = feature.label_id
+        arrays['lengths'][i] = sum(feature.input_mask)
+
+def _fill_arrays_from_store(arrays, store, label_map, max_seq_length, tokenizer):
+    """Copies the wordpiece and label ids of an aligned ExampleStore without creating examples."""
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    label_ids = np.arange(len(store.label_list))
+    if store.label_list != [label for label, _ in sorted(label_map.items(), key=lambda item: item[1])]:
+        label_ids = np.array([label_map[label] for label in store.label_list])
+    lengths = np.minimum(store.token_lengths(), max_seq_length - 2)
+    for i, length in enumerate(lengths):
+        arrays['input_ids'][i, 0] = cls_id
+        arrays['input_ids'][i, 1:length + 1] = store.input_ids(i)[:length]
+        arrays['input_ids'][i, length + 1] = sep_id
+        if store.token_labels:
+            labels = label_ids[store.label_ids(i)[:max_seq_length]]
+            arrays['label_ids'][i, :len(labels)] = labels
+        else:
+            arrays['label_ids'][i] = label_ids[store.label_ids(i)[0]]
+    arrays['input_mask'][np.arange(max_seq_length)[None, :] < (lengths + 2)[:, None]] = 1
+    arrays['lengths'][:] = lengths + 2
+
+_conversion_worker = {}
+
+def _init_conversion_worker(tokenizer, label_map, max_seq_length, token_labels):
+    _conversion_worker.update(tokenizer=tokenizer, label_map=label_map,
+                              max_seq_length=max_seq_length, token_labels=token_labels)
+
+def _convert_chunk(chunk):
+    offset, examples = chunk
+    arrays = _allocate_arrays(len(examples), _conversion_worker['max_seq_length'], _conversion_worker['token_labels'])
+    _fill_arrays(arrays, examples, _conversion_worker['label_map'], _conversion_worker['max_seq_length'],
+                 _conversion_worker['tokenizer'], offset)
+    return offset, arrays
 
 class BertDataset(TensorDataset):
     """ Bert Dataset. """
 
-    def __init__(self, train_examples, tokenizer, max_seq_length=128, label_list=['0', '1'], transform=None):
+    def __init__(self, train_examples, tokenizer, max_seq_length=128, label_list=['0', '1'], transform=None, num_workers=1):
         """
         Args:
-            train_examples: a list of InputExample instances
+            train_examples: a list of InputExample instances or an `ExampleStore`
             tokenizer: BertTokenizer used to tokenize to Wordpieces and transform to indices
             transform (callable, optional): Optional transform to be applied on a sample.
+            num_workers: number of processes converting the examples
         """
         self.tokenizer = tokenizer
         self.train_examples = train_examples
-        self.train_features = convert_examples_to_features(train_examples, label_list, max_seq_length, tokenizer)
-        all_input_ids = torch.tensor([f.input_ids for f in self.train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in self.train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in self.train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in self.train_features], dtype=torch.long)
-        
-        self.tensors = (all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        arrays = convert_examples_to_arrays(train_examples, label_list, max_seq_length, tokenizer, num_workers=num_workers)
+        self.tensors = tuple(torch.from_numpy(arrays[name]).long()
+                             for name in ('input_ids', 'input_mask', 'segment_ids', 'label_ids'))
+
+    @property
+    def train_features(self):
+        """ InputFeatures of every example, built from the tensors for code written against the old attribute """
+        return [InputFeatures(*(t.tolist() for t in row)) for row in zip(*self.tensors)]
+
+    def lengths(self):
+        """ Number of wordpieces, including [CLS] and [SEP], of every example """
+        return self.tensors[1].sum(1).tolist()
 
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
@@ -0,0 +1,167 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import logging
+import contextlib
+from collections import OrderedDict, deque
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer(object):
+    """ Accumulates the time spent in the named stages of a loop.
+
+    Stages that run on the host, like waiting for the data loader, are timed
+    with perf_counter. Stages that launch device work are timed with CUDA
+    events on GPU, since kernels run asynchronously, and with perf_counter on
+    CPU. Timing does not add a host sync per step: every `resolve_interval`
+    stages the events that have already completed are added to the totals
+    without waiting, which keeps the pending events bounded by how far the
+    device lags behind, and the rest are waited for when the totals are read.
+
+    Args:
+        device: device the timed work runs on
+        enabled: when False every stage is a no-op
+        resolve_interval: number of timed stages between resolving the completed events
+    """
+
+    def __init__(self, device, enabled=True, resolve_interval=256):
+        self.use_events = device.type == 'cuda'
+        self.enabled = enabled
+        self.resolve_interval = resolve_interval
+        # Stage names are also recorded as torch.profiler ranges inside a TraceWindow
+        self.record_functions = False
+        self.reset()
+
+    def reset(self):
+        self.seconds = OrderedDict()
+        self.calls = OrderedDict()
+        self._events = deque()
+        self._recorded = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, host=False):
+        if not self.enabled:
+            yield
+            return
+        record = torch.profiler.record_function(name) if self.record_functions else contextlib.nullcontext()
+        with record:
+            if self.use_events and not host:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self._events.append((name, start, end))
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.seconds.setdefault(name, 0.0)
+                self._recorded += 1
+                if self._recorded % self.resolve_interval == 0:
+                    self._resolve(wait=False)
+            else:
+                start = time.perf_counter()
+                yield
+                self._add(name, time.perf_counter() - start)
+
+    def iterate(self, iterable, name='data'):
+        """ Yields the items of iterable, timing every wait for the next one as stage `name` """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name, host=True):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _resolve(self, wait):
+        """ Adds the times of the recorded events, of the completed ones only unless `wait` """
+        if wait and self._events:
+            self._events[-1][2].synchronize()
+        # Events of a stream complete in order, so the completed ones are a prefix
+        while self._events and (wait or self._events[0][2].query()):
+            name, start, end = self._events.popleft()
+            self.seconds[name] += start.elapsed_time(end) / 1000.0
+
+    def totals(self):
+        """ Seconds spent in every stage since the last reset """
+        self._resolve(wait=True)
+        return self.seconds
+
+    def table(self, title='stage'):
+        """ Breakdown of the stages as a text table """
+        totals = self.totals()
+        total = sum(totals.values())
+        lines = ["{:24s} {:>10s} {:>7s} {:>8s} {:>10s}".format(title, 'seconds', 'share', 'calls', 'ms/call')]
+        for name, seconds in totals.items():
+            calls = self.calls[name]
+            lines.append("{:24s} {:10.3f} {:7.1%} {:8d} {:10.3f}".format(
+                name, seconds, seconds / total if total else 0.0, calls, 1000.0 * seconds / max(calls, 1)))
+        lines.append("{:24s} {:10.3f}".format('total', total))
+        return '\n'.join(lines)
+
+    def log_metrics(self, writer, prefix, global_step):
+        """ Adds the seconds of every stage as scalars `prefix/<stage>` """
+        for name, seconds in self.totals().items():
+            writer.add_scalar('{}/{}'.format(prefix, name), seconds, global_step)
+
+
+class TraceWindow(object):
+    """ Runs torch.profiler over the batches [start, stop) and exports a Chrome trace.
+
+    Call step(batch_index) before every batch and close() when the loop ends.
+    The stages of the StageTimer show up as named ranges in the trace.
+
+    Args:
+        start: index of the first profiled batch
+        stop: index of the batch after the last profiled one
+        path: file the Chrome trace is written to, open it in chrome://tracing or Perfetto
+        timer: (Optional) StageTimer whose stages are recorded in the trace
+    """
+
+    def __init__(self, start, stop, path='trace.json', timer=None):
+        self.start = start
+        self.stop = stop
+        self.path = path
+        self.timer = timer
+        self.profiler = None
+
+    def step(self, batch_index):
+        if batch_index == self.start and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.__enter__()
+            if self.timer is not None:
+                self.timer.record_functions = True
+        elif batch_index == self.stop:
+            self.close()
+
+    def close(self):
+        if self.profiler is None:
+            return
+        self.profiler.__exit__(None, None, None)
+        if self.timer is not None:
+            self.timer.record_functions = False
+        self.profiler.export_chrome_trace(self.path)
+        logger.info("Wrote a trace of batches {} to {} to {}".format(self.start, self.stop, self.path))
+        self.profiler = None
+        self.start = None
@@ -0,0 +1,247 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Int8 dynamic quantization of fine-tuned NER models for CPU inference.
+
+    python -m utils.quantization --model-dir swe-uncased_L-12_H-768_A-12-ner --data-dir data/ \\
+        --output-dir quantized/ --export torchscript,onnx --tolerance 0.01
+
+Quantizes the Linear layers of the model to int8, runs NERTrainer.validation
+on the fp32 and int8 models on CPU and writes a report of entity F1, latency
+and size of every variant. Only variants whose F1 is within --tolerance of
+fp32 are saved.
+"""
+
+import io
+import os
+import copy
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def quantize_dynamic(model, dtype=torch.qint8):
+    """ Copy of the model on CPU with int8 weights in every Linear layer.
+
+    Activations are quantized on the fly per batch, so no calibration data
+    is needed. Embeddings and LayerNorm stay in fp32.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=dtype)
+
+
+def example_inputs(max_seq_length=128, batch_size=2):
+    input_ids = torch.zeros((batch_size, max_seq_length), dtype=torch.long)
+    return input_ids, torch.zeros_like(input_ids), torch.ones_like(input_ids)
+
+
+def export_torchscript(model, path, max_seq_length=128):
+    """ Traces model(input_ids, token_type_ids, attention_mask) and saves it.
+
+    The traced graph accepts any batch size and sequence length.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example_inputs(max_seq_length), check_trace=False)
+    torch.jit.save(traced, path)
+    logger.info("Saved TorchScript model to {}".format(path))
+    return traced
+
+
+def load_torchscript(path, num_labels):
+    model = torch.jit.load(path, map_location='cpu')
+    # NERTrainer.loss reads num_labels
+    model.num_labels = num_labels
+    return model
+
+
+def export_onnx(model, path, max_seq_length=128, opset_version=14):
+    """ Exports the fp32 graph to ONNX with dynamic batch and sequence axes.
+
+    Needs the onnx package. Dynamically quantized PyTorch modules do not
+    export to ONNX, quantize the exported graph with onnxruntime instead.
+    """
+    axes = {0: 'batch', 1: 'sequence'}
+    names = ['input_ids', 'token_type_ids', 'attention_mask']
+    with torch.no_grad():
+        torch.onnx.export(model.eval(), example_inputs(max_seq_length), path, input_names=names,
+                          output_names=['logits'], dynamic_axes={name: axes for name in names + ['logits']},
+                          opset_version=opset_version, dynamo=False)
+    logger.info("Saved ONNX model to {}".format(path))
+
+
+def model_size_bytes(model):
+    """ Size of the serialized model """
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def measure_latency(model, dataloader, num_batches=20, warmup=2):
+    """ Per-batch latency and throughput of the model on CPU over the first batches of dataloader """
+    model.eval()
+    batches = []
+    for batch in dataloader:
+        batches.append(batch)
+        if len(batches) == num_batches + warmup:
+            break
+    if not batches:
+        raise ValueError("measure_latency needs at least one batch")
+    # A short dataloader still gets at least one timed batch
+    warmup = min(warmup, len(batches) - 1)
+    timings, examples = [], 0
+    with torch.inference_mode():
+        for i, (input_ids, input_mask, segment_ids) in enumerate(batch[:3] for batch in batches):
+            start = time.perf_counter()
+            model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
+            if i >= warmup:
+                timings.append(time.perf_counter() - start)
+                examples += input_ids.size(0)
+    timings_ms = np.array(timings) * 1000.0
+    return {'p50_ms': float(np.percentile(timings_ms, 50)), 'p90_ms': float(np.percentile(timings_ms, 90)),
+            'examples_per_second': examples / max(float(sum(timings)), 1e-9)}
+
+
+def evaluate(model, valid_dataloader, label_list):
+    """ NERTrainer.validation metrics of the model on CPU """
+    from .train import NERTrainer
+    from .sinks import MetricsSink, NullBackend
+    writer = MetricsSink(NullBackend())
+    try:
+        trainer = NERTrainer(model, None, valid_dataloader, label_list, writer=writer, device=torch.device('cpu'))
+        metrics = trainer.validation(0)
+    finally:
+        # Stops the background thread of the sink
+        writer.close()
+    return {'f1_score': metrics.f1_score(), 'accuracy': float(metrics.accuracy()), 'loss': float(metrics.loss())}
+
+
+def compare_variants(model, valid_dataloader, label_list, tolerance=0.01, output_dir=None, export=(),
+                     max_seq_length=128, num_latency_batches=20):
+    """ Compares the fp32 model with its int8 quantization and exported graphs.
+
+    Every variant is evaluated with NERTrainer.validation and timed on CPU.
+    A variant is `accepted` when its entity F1 is at most `tolerance` below
+    the F1 of fp32. With `output_dir` the accepted variants are saved there
+    together with report.json, without it the TorchScript export goes to a
+    temporary directory that is removed again.
+
+    Args:
+        model: fine-tuned BertForTokenClassification
+        valid_dataloader: validation batches, e.g. from bucketed_dataloader with shuffle=False
+        label_list: list of label names, index i is label id i
+        tolerance: largest allowed drop of entity F1
+        output_dir: (Optional) directory of the accepted variants and the report
+        export: formats exported besides the eager int8 model, 'torchscript' and/or 'onnx'
+    """
+    fp32 = copy.deepcopy(model).cpu().eval()
+    variants = [('fp32', fp32), ('int8', quantize_dynamic(model))]
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    if 'torchscript' in export:
+        directory = output_dir or tempfile.mkdtemp(prefix='quantization-')
+        try:
+            path = os.path.join(directory, 'model-int8.torchscript.pt')
+            export_torchscript(variants[1][1], path, max_seq_length)
+            variants.append(('int8-torchscript', load_torchscript(path, model.num_labels)))
+        finally:
+            if not output_dir:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    report = {'tolerance': tolerance, 'variants': {}}
+    for name, variant in variants:
+        result = evaluate(variant, valid_dataloader, label_list)
+        result['size_mb'] = model_size_bytes(variant) / 1024.0 ** 2
+        result.update(measure_latency(variant, valid_dataloader, num_latency_batches))
+        report['variants'][name] = result
+        logger.info("{}: {}".format(name, result))
+
+    baseline = report['variants']['fp32']
+    for name, result in report['variants'].items():
+        result['f1_drop'] = baseline['f1_score'] - result['f1_score']
+        result['speedup'] = result['examples_per_second'] / baseline['examples_per_second']
+        result['size_ratio'] = result['size_mb'] / baseline['size_mb']
+        result['accepted'] = result['f1_drop'] <= tolerance
+
+    if output_dir:
+        save_variants(dict(variants), report, output_dir, export, max_seq_length)
+    return report
+
+
+def save_variants(variants, report, output_dir, export, max_seq_length):
+    """ Saves the accepted variants and report.json, rejected exports are removed """
+    torchscript_path = os.path.join(output_dir, 'model-int8.torchscript.pt')
+    if report['variants']['int8']['accepted']:
+        torch.save(variants['int8'].state_dict(), os.path.join(output_dir, 'model-int8.bin'))
+    if 'int8-torchscript' in report['variants'] and not report['variants']['int8-torchscript']['accepted']:
+        os.remove(torchscript_path)
+    if 'onnx' in export:
+        export_onnx(variants['fp32'], os.path.join(output_dir, 'model-fp32.onnx'), max_seq_length)
+    with open(os.path.join(output_dir, 'report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+
+def format_report(report):
+    lines = ["{:18s} {:>8s} {:>8s} {:>9s} {:>9s} {:>8s} {:>9s}".format(
+        'variant', 'F1', 'F1 drop', 'size MB', 'p50 ms', 'speedup', 'accepted')]
+    for name, result in report['variants'].items():
+        lines.append("{:18s} {:8.4f} {:8.4f} {:9.1f} {:9.2f} {:8.2f} {:>9s}".format(
+            name, result['f1_score'], result['f1_drop'], result['size_mb'], result['p50_ms'], result['speedup'],
+            'yes' if result['accepted'] else 'no'))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-dir', required=True, help='fine-tuned model and vocab.txt')
+    parser.add_argument('--data-dir', required=True, help='directory of the NERProcessor csv files')
+    parser.add_argument('--output-dir', default=None)
+    parser.add_argument('--export', default='', help='comma separated formats: torchscript, onnx')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='largest allowed drop of entity F1')
+    parser.add_argument('--max-seq-length', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--cased', action='store_true')
+    args = parser.parse_args()
+
+    from pytorch_pretrained_bert import BertForTokenClassification
+    from .tokenization import FastBertTokenizer
+    from .processors import NERProcessor
+    from .datasets import BertDataset, InputExampleToTensors, bucketed_dataloader
+
+    tokenizer = FastBertTokenizer.from_pretrained(args.model_dir, do_lower_case=not args.cased)
+    processor = NERProcessor(args.data_dir, tokenizer, do_lower_case=not args.cased)
+    label_list = processor.get_label_list()
+    model = BertForTokenClassification.from_pretrained(args.model_dir, num_labels=len(label_list))
+    transform = InputExampleToTensors(tokenizer, args.max_seq_length, label_list, pad_to_max_length=False)
+    dataset = BertDataset(processor.get_val_examples(), transform)
+    valid_dataloader = bucketed_dataloader(dataset, batch_size=args.batch_size, shuffle=False)
+
+    export = [f for f in args.export.split(',') if f]
+    report = compare_variants(model, valid_dataloader, label_list, tolerance=args.tolerance,
+                              output_dir=args.output_dir, export=export, max_seq_length=args.max_seq_length)
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
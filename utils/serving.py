@@ -0,0 +1,363 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Asyncio inference server gathering concurrent requests into dynamic batches.
+
+    python -m utils.serving --model-dir swe-uncased_L-12_H-768_A-12-ner --task ner --port 8080
+    curl -d '{"text": "Vi erbjuder en spännande tjänst"}' localhost:8080/predict
+"""
+
+import json
+import time
+import bisect
+import asyncio
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+from .processors import InputExample
+from .datasets import InputExampleToTensors, DynamicPaddingCollator
+
+logger = logging.getLogger(__name__)
+
+
+class ServerOverloaded(Exception):
+    """ Raised when the request queue is full """
+
+
+class ServerStopped(Exception):
+    """ Set on the requests still waiting when the server stops """
+
+
+class LatencyHistogram(object):
+    """ Histogram of latencies in log-spaced millisecond buckets """
+
+    def __init__(self, min_ms=0.1, max_ms=60000.0, buckets_per_decade=20):
+        num_buckets = int(np.ceil(np.log10(max_ms / min_ms) * buckets_per_decade)) + 1
+        self.bounds = list(np.logspace(np.log10(min_ms), np.log10(max_ms), num_buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+
+    def percentile(self, q):
+        """ Upper bound of the bucket holding the q-th percentile, in milliseconds """
+        if self.count == 0:
+            return 0.0
+        rank, seen = q / 100.0 * self.count, 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def summary(self):
+        return {'count': self.count, 'mean_ms': self.total_ms / max(self.count, 1),
+                'p50_ms': self.percentile(50), 'p90_ms': self.percentile(90), 'p99_ms': self.percentile(99)}
+
+
+class MicroBatcher(object):
+    """ Gathers concurrent requests into batches for a model.
+
+    A batch is run as soon as `max_batch_size` requests are waiting or the
+    oldest request has waited `max_wait_ms`. Batches run one at a time in a
+    dedicated executor thread so the event loop keeps accepting requests.
+    When `max_queue_size` requests are waiting, submit raises
+    ServerOverloaded instead of growing the queue.
+
+    Args:
+        run_batch (callable): maps a list of request items to a list of results
+        max_batch_size: largest number of requests in a batch
+        max_wait_ms: longest time the first request of a batch waits for more
+        max_queue_size: number of waiting requests before new ones are rejected
+    """
+
+    def __init__(self, run_batch, max_batch_size=32, max_wait_ms=5.0, max_queue_size=1024):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model')
+        self.latency = LatencyHistogram()
+        self.queue_latency = LatencyHistogram()
+        # Sizes of the last batches, for the mean batch size in stats()
+        self.batch_sizes = deque(maxlen=10000)
+        self.rejected = 0
+        self._queue = None
+        self._task = None
+        self._batch = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        # Fail the batch that was running and the waiting requests instead of leaving them pending
+        waiting = list(self._batch)
+        while not self._queue.empty():
+            waiting.append(self._queue.get_nowait())
+        for _, future, _ in waiting:
+            if not future.done():
+                future.set_exception(ServerStopped())
+        self._batch = []
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, item):
+        """ Queues an item and waits for its result """
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise ServerOverloaded()
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            requests = self._batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000.0
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            started = time.perf_counter()
+            for _, _, queued in requests:
+                self.queue_latency.record(started - queued)
+            self.batch_sizes.append(len(requests))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [r[0] for r in requests])
+            except Exception as error:
+                logger.exception("Batch of {} requests failed".format(len(requests)))
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            finished = time.perf_counter()
+            for (_, future, queued), result in zip(requests, results):
+                self.latency.record(finished - queued)
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        batch_sizes = list(self.batch_sizes)
+        return {'latency': self.latency.summary(), 'queue_latency': self.queue_latency.summary(),
+                'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+                'queued': self._queue.qsize() if self._queue else 0, 'rejected': self.rejected}
+
+
+class ClassificationRunner(object):
+    """ Runs a sentence classification model on a batch of texts.
+
+    Texts are converted with InputExampleToTensors and padded to the longest
+    text of the batch with DynamicPaddingCollator. With a
+    utils.inference_cache.InferenceCache the results are cached by text and
+    repeated texts are only run once.
+    """
+
+    def __init__(self, model, tokenizer, label_list, max_seq_length=128, device=None, cache=None):
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device).eval()
+        self.label_list = label_list
+        self.transform = InputExampleToTensors(tokenizer, max_seq_length, label_list, pad_to_max_length=False)
+        self.collate = DynamicPaddingCollator()
+        self.cache = cache
+
+    def __call__(self, texts):
+        if self.cache is not None:
+            return self.cache.get_or_compute(texts, self.run)
+        return self.run(texts)
+
+    def run(self, texts):
+        examples = [InputExample(guid=i, text_a=text, label=self.label_list[0]) for i, text in enumerate(texts)]
+        input_ids, input_mask, segment_ids, _ = self.collate([self.transform(example) for example in examples])
+        with torch.inference_mode():
+            logits = self.model(input_ids.to(self.device), segment_ids.to(self.device), input_mask.to(self.device))
+            probabilities = torch.softmax(logits.float(), -1).cpu().numpy()
+        return [{'label': self.label_list[int(p.argmax())], 'probabilities': p.tolist()} for p in probabilities]
+
+
+class NERRunner(object):
+    """ Runs a utils.predict.NERPredictor on a batch of texts """
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+
+    @property
+    def cache(self):
+        return self.predictor.cache
+
+    def __call__(self, texts):
+        return [{'tags': r['tags'], 'entities': r['entities']} for r in self.predictor.predict(texts)]
+
+
+class InferenceServer(object):
+    """ Minimal HTTP/1.1 JSON server in front of a MicroBatcher.
+
+    POST /predict with {"text": "..."} returns the result of the runner for
+    that text, GET /stats returns latency histograms, batch sizes and the
+    metrics of the runner's InferenceCache, if any. A text that is not a
+    string answers 400, a failed batch 500 and a full queue or a stopped
+    server 503.
+    """
+
+    def __init__(self, batcher, host='127.0.0.1', port=8080):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("Serving on http://{}:{}".format(self.host, self.port))
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.route(method, path, body)
+                payload = json.dumps(response).encode('utf-8')
+                writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            stats = self.batcher.stats()
+            cache = getattr(self.batcher.run_batch, 'cache', None)
+            if cache is not None:
+                stats['cache'] = cache.stats()
+            return '200 OK', stats
+        if method == 'POST' and path == '/predict':
+            try:
+                text = json.loads(body.decode('utf-8'))['text']
+            except (ValueError, KeyError, TypeError):
+                text = None
+            if not isinstance(text, str):
+                return '400 Bad Request', {'error': 'expected {"text": "..."}'}
+            try:
+                return '200 OK', await self.batcher.submit(text)
+            except ServerOverloaded:
+                return '503 Service Unavailable', {'error': 'overloaded'}
+            except ServerStopped:
+                return '503 Service Unavailable', {'error': 'stopped'}
+            except Exception:
+                # The batcher has logged the error of the batch
+                return '500 Internal Server Error', {'error': 'prediction failed'}
+        return '404 Not Found', {'error': 'not found'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-dir', required=True, help='fine-tuned model and vocab.txt')
+    parser.add_argument('--task', choices=['ner', 'classification'], default='ner')
+    parser.add_argument('--labels', default=None, help='comma separated label list, defaults to NERProcessor labels')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-seq-length', type=int, default=128)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--max-queue-size', type=int, default=1024)
+    parser.add_argument('--cased', action='store_true')
+    parser.add_argument('--cache-size', type=int, default=100000, help='results kept in memory, 0 disables caching')
+    parser.add_argument('--cache-dir', default=None, help='(Optional) directory of the on-disk result cache')
+    args = parser.parse_args()
+
+    from pytorch_pretrained_bert import BertForTokenClassification, BertForSequenceClassification
+    from .tokenization import FastBertTokenizer
+    from .processors import NERProcessor
+    from .predict import NERPredictor
+    from .inference_cache import InferenceCache
+
+    def create_cache(model, label_list):
+        if not args.cache_size:
+            return None
+        config = {'task': args.task, 'max_seq_length': args.max_seq_length, 'label_list': label_list,
+                  'do_lower_case': not args.cased}
+        return InferenceCache(model, config, max_entries=args.cache_size, cache_dir=args.cache_dir)
+
+    tokenizer = FastBertTokenizer.from_pretrained(args.model_dir, do_lower_case=not args.cased)
+    if args.task == 'ner':
+        label_list = args.labels.split(',') if args.labels else NERProcessor.label_list
+        model = BertForTokenClassification.from_pretrained(args.model_dir, num_labels=len(label_list))
+        predictor = NERPredictor(model, tokenizer, label_list, NERProcessor.wordpiece_conll_map,
+                                 max_seq_length=args.max_seq_length, batch_size=args.max_batch_size,
+                                 do_lower_case=not args.cased, cache=create_cache(model, label_list))
+        runner = NERRunner(predictor)
+    else:
+        label_list = args.labels.split(',') if args.labels else ['0', '1']
+        model = BertForSequenceClassification.from_pretrained(args.model_dir, num_labels=len(label_list))
+        runner = ClassificationRunner(model, tokenizer, label_list, max_seq_length=args.max_seq_length,
+                                      cache=create_cache(model, label_list))
+
+    batcher = MicroBatcher(runner, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           max_queue_size=args.max_queue_size)
+    server = InferenceServer(batcher, host=args.host, port=args.port)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsSink(object):
+    """ Buffered metrics writer that never blocks the training loop.
+
+    Scalars are kept as detached device tensors in a buffer, so add_scalar
+    does not force a host sync. A background thread resolves the buffered
+    tensors with one copy per device and hands them to the backend every
+    `flush_interval` seconds, or earlier when `capacity` scalars are waiting.
+    The buffer is a ring of `max_buffered` scalars: when the backend stalls
+    the oldest scalars are dropped and counted in `dropped`, so memory stays
+    bounded. It has the add_scalar/flush/close interface of a tensorboardX
+    SummaryWriter.
+
+    Args:
+        backend: TensorBoardBackend, JsonlBackend or NullBackend, defaults to TensorBoardBackend
+        flush_interval: seconds between two writes to the backend
+        capacity: number of buffered scalars that triggers an early write
+        max_buffered: number of buffered scalars before the oldest are dropped
+    """
+
+    def __init__(self, backend=None, flush_interval=10.0, capacity=4096, max_buffered=65536):
+        self.backend = backend if backend is not None else TensorBoardBackend()
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self.max_buffered = max(max_buffered, capacity)
+        self.dropped = 0
+        self._buffer = deque(maxlen=self.max_buffered)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='MetricsSink', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add_scalar(self, tag, value, global_step=None):
+        if torch.is_tensor(value):
+            # Copy on the device, the caller may update its tensor in place
+            value = value.detach().clone()
+        with self._lock:
+            if len(self._buffer) == self.max_buffered:
+                if not self.dropped:
+                    logger.warning("Metrics backend is behind, dropping the oldest of {} buffered scalars".format(
+                        self.max_buffered))
+                self.dropped += 1
+            self._buffer.append((tag, value, global_step, time.time()))
+            full = len(self._buffer) >= self.capacity
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """ Resolves and writes everything buffered so far """
+        with self._lock:
+            records, self._buffer = list(self._buffer), deque(maxlen=self.max_buffered)
+        with self._write_lock:
+            if records:
+                self.backend.write(_resolve(records))
+            self.backend.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # The exit hook would otherwise keep every closed sink alive
+        atexit.unregister(self.close)
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        self.backend.close()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write metrics")
+
+
+def _resolve(records):
+    """ Replaces tensor values by floats, with a single host copy per device """
+    by_device = {}
+    for i, (tag, value, step, wall_time) in enumerate(records):
+        if torch.is_tensor(value):
+            by_device.setdefault(value.device, []).append(i)
+
+    values = [value for (tag, value, step, wall_time) in records]
+    for device, indices in by_device.items():
+        resolved = torch.stack([records[i][1].reshape(()).float() for i in indices]).tolist()
+        for i, value in zip(indices, resolved):
+            values[i] = value
+    return [(tag, float(value), step, wall_time) for (tag, _, step, wall_time), value in zip(records, values)]
+
+
+class TensorBoardBackend(object):
+    """ Writes scalars to TensorBoard event files with tensorboardX """
+
+    def __init__(self, logdir=None):
+        from tensorboardX import SummaryWriter
+        self.writer = SummaryWriter(logdir)
+
+    def write(self, records):
+        for tag, value, step, wall_time in records:
+            self.writer.add_scalar(tag, value, step, walltime=wall_time)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonlBackend(object):
+    """ Appends one JSON object per scalar to a file """
+
+    def __init__(self, path):
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, records):
+        for tag, value, step, wall_time in records:
+            self.file.write(json.dumps({'tag': tag, 'value': value, 'step': step, 'time': wall_time}) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NullBackend(object):
+    """ Drops every scalar """
+
+    def write(self, records):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,232 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from array import array
+import numpy as np
+
+from . import processors
+
+# Every column is a flat buffer and an offsets array with one more entry than
+# there are examples. Example i of a column is buffer[offsets[i]:offsets[i + 1]].
+COLUMNS = ('text_a', 'text_b', 'labels', 'input_ids', 'word_ids')
+OFFSETS = {'text_a': 'text_a', 'text_b': 'text_b', 'labels': 'labels', 'input_ids': 'tokens', 'word_ids': 'tokens'}
+
+
+class ExampleStore(object):
+    """ Columnar storage of examples.
+
+    Texts are kept as utf-8 bytes in one buffer, labels as int8 (int16 for
+    more than 127 labels) ids of `label_list` and, for examples with a
+    WordpieceAlignment, wordpiece ids and word ids as int32, each with an
+    offsets array. An example costs a few bytes per character and wordpiece
+    instead of the Python objects of an InputExample.
+
+    store[i] returns the InputExample of example i, store[i:j] a store sharing
+    the buffers and store[indices] a compact copy of the examples. The column
+    accessors return numpy views without creating any example object.
+
+    Args:
+        label_list: list of label names, index i is label id i
+        columns: dict of column name to flat numpy buffer
+        offsets: dict of offsets name to numpy int64 offsets
+        token_labels: the examples have one label per wordpiece, as NER examples
+        set_type: prefix of the guids
+        first_index: guid number of the first example
+    """
+
+    def __init__(self, label_list, columns, offsets, token_labels, set_type='', first_index=0):
+        self.label_list = list(label_list)
+        self.columns = columns
+        self.offsets = offsets
+        self.token_labels = token_labels
+        self.set_type = set_type
+        self.first_index = first_index
+
+    def __len__(self):
+        return len(self.offsets['text_a']) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.example(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.take(np.arange(start, stop, step))
+            stop = max(start, stop)
+            offsets = {name: o[start:stop + 1] for name, o in self.offsets.items()}
+            return ExampleStore(self.label_list, self.columns, offsets, self.token_labels, self.set_type,
+                                self.first_index + start)
+        if isinstance(index, (list, np.ndarray)):
+            return self.take(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("example index {} out of range".format(index))
+        return self.example(index)
+
+    @property
+    def has_alignment(self):
+        return 'input_ids' in self.columns
+
+    def column(self, name, index):
+        """ Numpy view of a column of example `index` """
+        offsets = self.offsets[OFFSETS[name]]
+        return self.columns[name][offsets[index]:offsets[index + 1]]
+
+    def text_a(self, index):
+        return self.column('text_a', index).tobytes().decode('utf-8')
+
+    def text_b(self, index):
+        if 'text_b' not in self.columns:
+            return None
+        return self.column('text_b', index).tobytes().decode('utf-8') or None
+
+    def label_ids(self, index):
+        return self.column('labels', index)
+
+    def input_ids(self, index):
+        return self.column('input_ids', index)
+
+    def word_ids(self, index):
+        return self.column('word_ids', index)
+
+    def token_lengths(self):
+        """ Number of wordpieces of every example, without [CLS] and [SEP] """
+        return np.diff(self.offsets['tokens'])
+
+    def guid(self, index):
+        return "%s-%s" % (self.set_type, self.first_index + index)
+
+    def label(self, index):
+        """ Label names of example `index`, a list for token labels and None without labels """
+        label_ids = self.label_ids(index)
+        if len(label_ids) == 0:
+            return None
+        if self.token_labels:
+            return [self.label_list[i] for i in label_ids]
+        return self.label_list[label_ids[0]]
+
+    def example(self, index):
+        """ InputExample of example `index`, its alignment has no wordpiece strings """
+        alignment = None
+        label = self.label(index)
+        if self.has_alignment:
+            alignment = processors.WordpieceAlignment(None, self.input_ids(index).tolist(),
+                                                      label if self.token_labels else None,
+                                                      self.word_ids(index).tolist())
+        return processors.InputExample(guid=self.guid(index), text_a=self.text_a(index),
+                                       text_b=self.text_b(index), label=label, alignment=alignment)
+
+    def take(self, indices):
+        """ Compact store of the examples at indices """
+        indices = np.asarray(indices, dtype=np.int64)
+        columns, offsets = {}, {}
+        for name in self.offsets:
+            source = self.offsets[name]
+            lengths = source[indices + 1] - source[indices]
+            offsets[name] = np.zeros(len(indices) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[name][1:])
+        for name, buffer in self.columns.items():
+            source = self.offsets[OFFSETS[name]]
+            columns[name] = np.concatenate([buffer[source[i]:source[i + 1]] for i in indices]) \
+                if len(indices) else buffer[:0].copy()
+        return ExampleStore(self.label_list, columns, offsets, self.token_labels, self.set_type)
+
+    def nbytes(self):
+        """ Bytes held by the columns and offsets of the store """
+        return sum(a.nbytes for a in self.columns.values()) + sum(a.nbytes for a in self.offsets.values())
+
+    def __getstate__(self):
+        # A slice is pickled without the parts of the buffers outside it
+        state = dict(self.__dict__)
+        if len(self):
+            state['columns'] = {name: buffer[self.offsets[OFFSETS[name]][0]:self.offsets[OFFSETS[name]][-1]].copy()
+                                for name, buffer in self.columns.items()}
+            state['offsets'] = {name: o - o[0] for name, o in self.offsets.items()}
+        return state
+
+
+class ExampleStoreBuilder(object):
+    """ Appends examples to growing typed arrays and builds an ExampleStore.
+
+    Args:
+        label_list: list of label names, index i is label id i
+        set_type: prefix of the guids
+        first_index: guid number of the first example
+    """
+
+    def __init__(self, label_list, set_type='', first_index=0):
+        self.label_list = list(label_list)
+        self.label_map = {label: i for i, label in enumerate(label_list)}
+        self.set_type = set_type
+        self.first_index = first_index
+        self.token_labels = False
+        self._columns = {'text_a': bytearray(), 'text_b': bytearray(), 'labels': array('h'),
+                         'input_ids': array('i'), 'word_ids': array('i')}
+        self._offsets = {name: array('q', [0]) for name in ('text_a', 'text_b', 'labels', 'tokens')}
+        self._aligned = 0
+
+    def __len__(self):
+        return len(self._offsets['text_a']) - 1
+
+    def add_example(self, example):
+        self.add(example.text_a, example.text_b, example.label, getattr(example, 'alignment', None))
+
+    def add(self, text_a, text_b=None, label=None, alignment=None):
+        self._append('text_a', text_a.encode('utf-8'))
+        self._append('text_b', (text_b or '').encode('utf-8'))
+        if isinstance(label, list):
+            self.token_labels = True
+            self._append('labels', [self.label_map[l] for l in label])
+        else:
+            self._append('labels', [] if label is None else [self.label_map[label]])
+        if alignment is not None:
+            self._aligned += 1
+            self._columns['input_ids'].extend(alignment.input_ids)
+            self._columns['word_ids'].extend(alignment.word_ids)
+        self._offsets['tokens'].append(len(self._columns['input_ids']))
+
+    def _append(self, name, values):
+        self._columns[name].extend(values)
+        self._offsets[name].append(len(self._columns[name]))
+
+    def build(self):
+        if self._aligned not in (0, len(self)):
+            raise ValueError("Either all or none of the examples of a store need an alignment")
+        label_dtype = np.int8 if len(self.label_list) <= 127 else np.int16
+        columns = {
+            'text_a': np.frombuffer(bytes(self._columns['text_a']), dtype=np.uint8),
+            'labels': np.asarray(self._columns['labels'], dtype=label_dtype),
+        }
+        offsets = {name: np.frombuffer(o, dtype=np.int64).copy() for name, o in self._offsets.items()}
+        if len(self._columns['text_b']):
+            columns['text_b'] = np.frombuffer(bytes(self._columns['text_b']), dtype=np.uint8)
+        else:
+            del offsets['text_b']
+        if self._aligned:
+            columns['input_ids'] = np.frombuffer(self._columns['input_ids'], dtype=np.int32).copy()
+            columns['word_ids'] = np.frombuffer(self._columns['word_ids'], dtype=np.int32).copy()
+        return ExampleStore(self.label_list, columns, offsets, self.token_labels, self.set_type,
+                            self.first_index)
+
+
+def build_store(examples, label_list, set_type=''):
+    """ ExampleStore of an iterable of InputExamples """
+    builder = ExampleStoreBuilder(label_list, set_type)
+    for example in examples:
+        builder.add_example(example)
+    return builder.build()
@@ -0,0 +1,203 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import logging
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Whitespace to str.split() but control characters to BertTokenizer, which
+# removes them instead of splitting on them
+_REMOVED_WHITESPACE = re.compile('[\x0b\x0c\x1c-\x1f\x85]')
+
+# Key of the vocabulary id in a trie node, a character key always has length 1
+_ID = ''
+
+
+class WordpieceTrie(object):
+    """ Prefix tries of the word-initial and the ## continuation wordpieces of a vocabulary.
+
+    Finds the longest wordpiece at a position by walking the characters of
+    the word once, instead of looking up every shorter substring in the
+    vocabulary as WordpieceTokenizer does.
+
+    Args:
+        vocab: dict of wordpiece to id
+        unk_id: id of words that cannot be split into wordpieces
+        max_input_chars_per_word: longer words are unknown
+    """
+
+    def __init__(self, vocab, unk_id, max_input_chars_per_word=100):
+        self.unk_id = unk_id
+        self.max_input_chars_per_word = max_input_chars_per_word
+        self.roots = ({}, {})
+        for token, token_id in vocab.items():
+            if token.startswith('##'):
+                self._insert(self.roots[1], token[2:], token_id)
+            else:
+                self._insert(self.roots[0], token, token_id)
+
+    @staticmethod
+    def _insert(node, chars, token_id):
+        for char in chars:
+            node = node.setdefault(char, {})
+        node[_ID] = token_id
+
+    def ids(self, word):
+        """ Wordpiece ids of a word by greedy longest-match-first """
+        length = len(word)
+        if length > self.max_input_chars_per_word:
+            return [self.unk_id]
+        ids = []
+        start = 0
+        root = self.roots[0]
+        while start < length:
+            node = root
+            match_id, match_end = None, start
+            for end in range(start, length):
+                node = node.get(word[end])
+                if node is None:
+                    break
+                token_id = node.get(_ID)
+                if token_id is not None:
+                    match_id, match_end = token_id, end + 1
+            if match_id is None:
+                return [self.unk_id]
+            ids.append(match_id)
+            start = match_end
+            root = self.roots[1]
+        return ids
+
+
+class FastBertTokenizer(object):
+    """ BertTokenizer with a trie WordPiece, a word cache and id batch methods.
+
+    Produces the same wordpieces as BertTokenizer, including lowercasing,
+    accent stripping and punctuation splitting. Text is split on whitespace
+    and every whitespace separated word is tokenized once and kept in an LRU
+    cache of its ids, so frequent words cost one dict lookup.
+
+    token_ids() and batch_token_ids() return ids without creating wordpiece
+    strings. The other attributes and methods, e.g. vocab and
+    convert_tokens_to_ids, are those of the wrapped BertTokenizer, which is
+    created with the tokenizer. pytorch_pretrained_bert is only imported
+    then, since it loads boto3 and requests.
+
+    Args:
+        vocab_file: path to a one-wordpiece-per-line vocabulary file, e.g. vocab.txt of the Swedish models
+        do_lower_case: lowercase and strip accents
+        cache_size: number of words kept in the cache, 0 disables it
+    """
+
+    def __init__(self, vocab_file, do_lower_case=True, max_len=None, do_basic_tokenize=True,
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), cache_size=100000):
+        from pytorch_pretrained_bert import BertTokenizer
+        self._wrap(BertTokenizer(vocab_file, do_lower_case=do_lower_case, max_len=max_len,
+                                 do_basic_tokenize=do_basic_tokenize, never_split=never_split), cache_size)
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, cache_dir=None, cache_size=100000, *inputs, **kwargs):
+        """ FastBertTokenizer of BertTokenizer.from_pretrained, None when the vocabulary is not found """
+        from pytorch_pretrained_bert import BertTokenizer
+        tokenizer = BertTokenizer.from_pretrained(pretrained_model_name_or_path, cache_dir, *inputs, **kwargs)
+        if tokenizer is None:
+            return None
+        fast = cls.__new__(cls)
+        fast._wrap(tokenizer, cache_size)
+        return fast
+
+    def _wrap(self, tokenizer, cache_size):
+        self.tokenizer = tokenizer
+        self.trie = WordpieceTrie(tokenizer.vocab, tokenizer.vocab[tokenizer.wordpiece_tokenizer.unk_token],
+                                  tokenizer.wordpiece_tokenizer.max_input_chars_per_word)
+        self.cache_size = cache_size
+        self.clear_cache()
+
+    def __getattr__(self, name):
+        # Only called for names the wrapper lacks. Unpickling looks up
+        # __setstate__ before the tokenizer is restored.
+        if name == 'tokenizer' or name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def clear_cache(self):
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache), 'max_size': self.cache_size}
+
+    def tokenize(self, text):
+        return [self.ids_to_tokens[i] for i in self.token_ids(text)]
+
+    def token_ids(self, text):
+        """ Wordpiece ids of text, the same as convert_tokens_to_ids(tokenize(text)) """
+        if not self.do_basic_tokenize:
+            return [i for word in text.split() for i in self.trie.ids(word)]
+        ids = []
+        for word in _REMOVED_WHITESPACE.sub('', text).split():
+            ids.extend(self._word_ids(word))
+        return ids
+
+    def batch_token_ids(self, texts):
+        """ Wordpiece ids of every text as int32 arrays, views of one buffer """
+        ids, offsets = [], [0]
+        for text in texts:
+            ids += self.token_ids(text)
+            offsets.append(len(ids))
+        ids = np.array(ids, dtype=np.int32)
+        return [ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def _word_ids(self, word):
+        cache = self.cache
+        ids = cache.get(word)
+        if ids is not None:
+            self.hits += 1
+            cache.move_to_end(word)
+            return ids
+        self.misses += 1
+        ids = tuple(i for token in self.basic_tokenizer.tokenize(word) for i in self.trie.ids(token))
+        if self.cache_size:
+            cache[word] = ids
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return ids
+
+    def __getstate__(self):
+        # Process pool workers start with an empty cache
+        state = dict(self.__dict__)
+        state.update(cache=OrderedDict(), hits=0, misses=0)
+        return state
+
+    def check_parity(self, texts):
+        """ Asserts that every text gets the same wordpieces and ids as from the wrapped BertTokenizer """
+        mismatches = []
+        for text in texts:
+            expected = self.tokenizer.tokenize(text)
+            if self.tokenize(text) != expected or self.token_ids(text) != self.convert_tokens_to_ids(expected):
+                mismatches.append(text)
+        assert not mismatches, "{} of {} texts tokenized differently, e.g.\n{}".format(
+            len(mismatches), len(texts), '\n'.join("{!r}\n  BertTokenizer:     {}\n  FastBertTokenizer: {}".format(
+                text, self.tokenizer.tokenize(text), self.tokenize(text)) for text in mismatches[:10]))
+
+
+def token_ids(tokenizer, text):
+    """ Wordpiece ids of text with any tokenizer, without wordpiece strings for a FastBertTokenizer """
+    if isinstance(tokenizer, FastBertTokenizer):
+        return tokenizer.token_ids(text)
+    return tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
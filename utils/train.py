@@ -13,19 +13,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import warnings
+import contextlib
 import torch
 import numpy as np
 from torch.optim import Adam
 from torch.nn import CrossEntropyLoss
-from apex.optimizers import FP16_Optimizer
-from apex.optimizers import FusedAdam
-from tensorboardX import SummaryWriter
-from fastprogress import master_bar, progress_bar
-from seqeval.metrics import f1_score as f1_score_seqeval
-from sklearn.metrics import f1_score as f1_score_sklearn
-
-def create_optimizer(model, fp16=True, no_decay = ['bias', 'gamma', 'beta']):
-    # Remove unused pooler that otherwise break Apex
+from torch.nn.parallel import DistributedDataParallel
+
+from .metrics import NERMetrics
+from .datasets import DevicePrefetcher, loader_length
+from .sinks import MetricsSink, NullBackend
+from .packing import packed_forward
+from .checkpoint import AsyncCheckpointer, load_checkpoint, capture_rng_state, restore_rng_state
+from .profiling import StageTimer, TraceWindow
+from .validation import ValidationScheduler
+from .distributed import is_distributed, is_main_process, get_rank, get_world_size, default_device, all_gather_object
+
+logger = logging.getLogger(__name__)
+
+# tensorboardX, fastprogress, seqeval and sklearn are imported where
+# they are used so `import utils` stays light for workers and inference.
+
+def create_optimizer(model, fp16=None, no_decay = ['bias', 'gamma', 'beta']):
+    # Mixed precision is handled with torch.autocast and a GradScaler in
+    # NERTrainer, so the optimizer is the same with and without fp16.
+    if fp16 is not None:
+        warnings.warn("The fp16 argument of create_optimizer has no effect and will be removed",
+                      DeprecationWarning, stacklevel=2)
     param_optimizer = list(model.named_parameters())
     param_optimizer = [n for n in param_optimizer if 'pooler' not in n[0]]
 
@@ -33,139 +49,426 @@ def create_optimizer(model, fp16=True, no_decay = ['bias', 'gamma', 'beta']):
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.02},
         {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
     ]
-    if fp16:
-        optimizer = FusedAdam(optimizer_grouped_parameters, lr=3e-5, bias_correction=False, max_grad_norm=1.0)
-        optimizer = FP16_Optimizer(optimizer, dynamic_loss_scale=True)
-    else:
-        optimizer = Adam(optimizer_grouped_parameters, lr=3e-5)
+    optimizer = Adam(optimizer_grouped_parameters, lr=3e-5)
     return optimizer
 
 
+class BatchForward(torch.nn.Module):
+    """ Logits of the tensors of a batch, as a module so it can be wrapped in DistributedDataParallel """
+
+    def __init__(self, model):
+        super(BatchForward, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, input_mask, segment_ids, position_ids=None):
+        # Packed batches from utils.packing carry position ids
+        if position_ids is not None:
+            return packed_forward(self.model, input_ids, input_mask, segment_ids, position_ids)
+        return self.model(input_ids, token_type_ids=segment_ids, attention_mask=input_mask)
+
+
 class NERTrainer(object):
-    """ Trainer of BERT model """
+    """ Trainer of BERT model
 
-    def __init__(self, model, train_dataloader, valid_dataloader, label_list, fp16=False):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    When torch.distributed is initialized, e.g. with utils.distributed.init_distributed
+    in a script launched by torchrun, the trainer runs one process of a
+    DistributedDataParallel job. Every process should get its shard of the
+    data from utils.distributed.distributed_dataloader. Metrics are summed
+    over all processes, and only rank 0 writes logs and checkpoints.
+    """
+
+    def __init__(self, model, train_dataloader, valid_dataloader, label_list, fp16=False, writer=None, amp_dtype=None,
+                 device=None, prefetch_batches=2):
+        """
+        Args:
+            fp16: train with mixed precision through torch.autocast. The weights
+                stay in fp32, autocast runs in fp16 with a GradScaler on GPU and
+                in bf16 on CPU.
+            writer: (Optional) metrics writer, defaults to a utils.sinks.MetricsSink
+                writing to TensorBoard from a background thread
+            amp_dtype: (Optional) autocast dtype overriding the default of the device
+            device: (Optional) device overriding the default, e.g. cpu to evaluate
+                a quantized model
+            prefetch_batches: number of batches a utils.datasets.DevicePrefetcher
+                loads and copies to the device ahead of the training and
+                validation loops, 0 loads them in the loops
+        """
+        self.device = device if device is not None else default_device()
         self.model = model
         self.model.to(self.device)
-        if fp16: self.model.half()
+        self.forward_module = BatchForward(model)
+        if is_distributed():
+            # DistributedDataParallel waits for a gradient of every parameter
+            # that requires one, so parameters the forward pass does not use
+            # are frozen instead of searching the graph for them every step
+            for name, parameter in model.named_parameters():
+                if any(unused in name for unused in self.unused_parameters()):
+                    parameter.requires_grad_(False)
+            self.network = DistributedDataParallel(
+                self.forward_module, device_ids=[self.device] if self.device.type == 'cuda' else None)
+        else:
+            self.network = self.forward_module
         
-        self.writer = SummaryWriter()
+        if amp_dtype is None:
+            amp_dtype = torch.float16 if self.device.type == 'cuda' else torch.bfloat16
+        self.amp_dtype = amp_dtype
+        # Loss scaling is only needed for fp16, bf16 has the exponent range of fp32
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=fp16 and amp_dtype == torch.float16)
+        
+        if writer is None:
+            writer = MetricsSink() if is_main_process() else MetricsSink(NullBackend())
+        self.writer = writer
         
         self.loss_fct = CrossEntropyLoss()
         self.train_dataloader = train_dataloader
         self.valid_dataloader = valid_dataloader
+        for dataloader in (train_dataloader, valid_dataloader):
+            dataset = getattr(dataloader, 'dataset', None)
+            # A packed classification dataset labels [CLS] and sets 0 elsewhere, the
+            # token-level loss would train every token toward label 0
+            if getattr(dataset, 'task', 'ner') != 'ner' and hasattr(dataset, 'packs'):
+                raise ValueError("NERTrainer only supports packed NER datasets, got task {}".format(dataset.task))
         self.label_list = label_list
         self.fp16 = fp16
+        self.prefetch_batches = prefetch_batches
+        self.timer = StageTimer(self.device)
+        self.validation_timer = StageTimer(self.device)
+        self.validation_scheduler = None
 
         
-    def fit(self, num_epochs = 25, max_grad_norm = 2.0, learning_rate = 3e-5, warmup_proportion = 0.1):
+    def fit(self, num_epochs = 25, max_grad_norm = 2.0, learning_rate = 3e-5, warmup_proportion = 0.1, metrics_interval = 50,
+            gradient_accumulation_steps = 1, checkpoint_dir = None, checkpoint_interval = 1000, keep_last = 3,
+            resume_from = None, scale_learning_rate = True, trace_steps = None, trace_path = 'trace.json',
+            validation_scheduler = None):
+        """ Trains the model.
+
+        Gradients of `gradient_accumulation_steps` batches are accumulated
+        before every optimizer step, averaged over the batches of the window,
+        which is shorter at the end of an epoch whose number of batches is not
+        a multiple. The learning rate schedule advances once per optimizer
+        step. Loss and token accuracy are accumulated on
+        the device every step. They are logged, together with the entity level
+        F1 score, every `metrics_interval` optimizer steps and at the end of
+        every epoch.
+
+        With `checkpoint_dir` a checkpoint is written from a background thread
+        every `checkpoint_interval` optimizer steps and at the end of every
+        epoch, keeping the last `keep_last`. `resume_from`, a checkpoint file
+        or directory, continues a run at the batch after its last optimizer
+        step, with the same batch order and random state.
+
+        In distributed mode the batch of an optimizer step is the batches of
+        all processes, and with `scale_learning_rate` the learning rate is
+        multiplied by the number of processes to match. The number of steps
+        follows from the length of the per-process train dataloader.
+
+        The time spent in every stage of the loop is logged as a table and as
+        `timing/` scalars at the end of every epoch, see utils.profiling.StageTimer.
+        With prefetching the `data` stage is the time the loop waits for a batch
+        the DevicePrefetcher does not have ready yet.
+        `trace_steps`, a (start, stop) pair of batch numbers counted from the
+        start of fit, runs torch.profiler over those batches and writes a
+        Chrome trace to `trace_path`.
+
+        `validation_scheduler`, a utils.validation.ValidationScheduler, sets
+        when and on what the model is validated, e.g. every N steps on a
+        subsample or in a worker process while training continues, and stops
+        training early. By default the full validation set is scored at the
+        end of every epoch.
+        """
+        from fastprogress import master_bar, progress_bar
         self.num_epochs = num_epochs
+        if scale_learning_rate and get_world_size() > 1:
+            learning_rate = learning_rate * get_world_size()
+            logger.info("Scaled the learning rate to {} for {} processes".format(learning_rate, get_world_size()))
         self.learning_rate = learning_rate
         self.warmup_proportion = warmup_proportion
+        self.metrics_interval = metrics_interval
+        self.gradient_accumulation_steps = gradient_accumulation_steps
         
         self.optimizer = self.create_optimizer(self.fp16)
         
         self.total_steps = self.total_steps()
         
-        self.accuracy_hist = np.array([])
-        self.f1_score_hist = np.array([])
-        self.loss_hist = np.array([])
+        self.train_metrics = self.create_metrics()
+        
+        if validation_scheduler is None:
+            validation_scheduler = ValidationScheduler()
+        self.validation_scheduler = validation_scheduler
+        validation_scheduler.start(self)
         
+        checkpointer = AsyncCheckpointer(checkpoint_dir, keep_last) if checkpoint_dir and is_main_process() else None
+        trace = None
+        try:
+            checkpoint = self.load_checkpoint(resume_from) if resume_from else None
+            start_epoch = checkpoint['epoch'] if checkpoint else 0
         
+            trace = TraceWindow(trace_steps[0], trace_steps[1], trace_path, self.timer) if trace_steps else None
+            batch_index = 0
         
-        epoch_process = master_bar(range(self.num_epochs))
-        for epoch in epoch_process:
-            self.model.train()
-            self.accuracy_hist = np.array([])
-            self.f1_score_hist = np.array([])
-            self.loss_hist = np.array([])
+            epoch_process = master_bar(range(start_epoch, self.num_epochs))
+            for epoch in epoch_process:
+                self.model.train()
+                self.set_epoch(epoch)
+                self.timer.reset()
+                num_batches = loader_length(self.train_dataloader)
+                accumulated_loss = 0
             
-            for step, batch in enumerate(progress_bar(self.train_dataloader, parent=epoch_process)):
-                batch = tuple(t.to(self.device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids = batch
-                logits = self.model(input_ids, segment_ids, input_mask)
-                loss = self.loss(logits, label_ids)
-                
-                accuracy = self.accuracy(logits, label_ids)
-                f1_score = self.f1_score_default_accuracy(logits, label_ids)
-                
-                self.accuracy_hist = np.append(self.accuracy_hist, accuracy)
-                self.f1_score_hist = np.append(self.f1_score_hist, f1_score)
-                self.loss_hist = np.append(self.loss_hist, loss.mean().item())
-
-                
-                if self.fp16:
-                    self.optimizer.backward(loss)
+                start_batch = 0
+                if checkpoint is not None and checkpoint['epoch'] == epoch:
+                    start_batch = checkpoint['batch']
+                    batches = self.resume_batches(checkpoint)
+                    checkpoint = None
                 else:
-                    loss.backward()
+                    self.train_metrics.reset()
+                    self.epoch_rng_state = capture_rng_state()
+                    batches = self.train_dataloader
+            
+                batches = progress_bar(self.prefetch(batches), total=num_batches - start_batch, parent=epoch_process)
+                for step, batch in enumerate(self.timer.iterate(batches), start_batch):
+                    if trace:
+                        trace.step(batch_index)
+                    batch_index += 1
+                    with self.timer.stage('h2d'):
+                        batch = tuple(t.to(self.device) for t in batch)
+                    input_mask, label_ids = batch[1], batch[3]
+                    optimizer_step = (step + 1) % self.gradient_accumulation_steps == 0 or step + 1 == num_batches
+                    # The last window of an epoch may have fewer batches, the loss is averaged over those
+                    window_start = step - step % self.gradient_accumulation_steps
+                    window_size = min(self.gradient_accumulation_steps, num_batches - window_start)
+                    # Gradients are only all-reduced on the last batch of an optimizer step
+                    with self.no_sync(not optimizer_step):
+                        with self.timer.stage('forward'):
+                            with self.autocast():
+                                logits = self.forward(batch)
+                            loss = self.training_loss(logits, batch)
+                    
+                        with self.timer.stage('metrics'):
+                            self.train_metrics.update(logits, label_ids, input_mask)
+                            self.train_metrics.add_loss(loss)
+                            accumulated_loss += loss.detach() / window_size
+                    
+                        with self.timer.stage('backward'):
+                            self.scaler.scale(loss / window_size).backward()
                 
-                # TODO undersök varför man vill göra det här, det får ibland modellen att inte lära sig
-                #self.clip_grad_norm(max_grad_norm)
+                    if not optimizer_step:
+                        continue
                 
-                global_step = self.global_step(epoch, step)
-                 
-                epoch_process.child.comment = ("Train F1 score: {:.2}".format(self.f1_score_hist.mean()))
+                    global_step = self.global_step(epoch, step)
                 
-                lr_this_step = self.update_learning_rate(global_step)
+                    # TODO undersök varför man vill göra det här, det får ibland modellen att inte lära sig
+                    #self.clip_grad_norm(max_grad_norm)
                 
-                self.writer.add_scalar('train/accuracy', accuracy, global_step)
-                self.writer.add_scalar('train/f1_score', f1_score, global_step)
-                self.writer.add_scalar('train/loss', loss.mean().item(), global_step)
-                self.writer.add_scalar('train/learning_rate', lr_this_step, global_step)
+                    with self.timer.stage('logging', host=True):
+                        lr_this_step = self.update_learning_rate(global_step)
+                        self.writer.add_scalar('train/loss', accumulated_loss, global_step)
+                        self.writer.add_scalar('train/learning_rate', lr_this_step, global_step)
+                        accumulated_loss = 0
+                
+                    if (global_step + 1) % self.metrics_interval == 0:
+                        with self.timer.stage('metrics', host=True):
+                            f1_score = self.log_train_metrics(global_step)
+                        epoch_process.child.comment = ("Train F1 score: {:.2}".format(f1_score))
 
-                self.optimizer.step()
-                self.model.zero_grad()
+                    with self.timer.stage('optimizer'):
+                        self.scaler.step(self.optimizer)
+                        self.scaler.update()
+                        self.model.zero_grad()
                 
-            self.validation(global_step)
+                    if checkpoint_dir and (global_step + 1) % checkpoint_interval == 0 and step + 1 != num_batches:
+                        with self.timer.stage('checkpoint', host=True):
+                            self.save_checkpoint(checkpointer, epoch, step + 1, global_step)
                 
-  
-    def loss(self, logits, label_ids):
-        loss = self.loss_fct(logits.view(-1, self.model.num_labels), label_ids.view(-1))
-        return loss
-    
-    def validation(self, global_step):
-        self.model.eval()
-        eval_loss, eval_accuracy = 0, 0
-        nb_eval_steps, nb_eval_examples = 0, 0
-        predictions, true_labels = [], []
-        for batch in self.valid_dataloader:
-            batch = tuple(t.to(self.device) for t in batch)
-            b_input_ids, b_input_mask, b_segment_ids, b_labels = batch
-            
-            with torch.no_grad():
-                tmp_eval_loss = self.model(b_input_ids, token_type_ids=b_segment_ids, attention_mask=b_input_mask, labels=b_labels)
-                logits = self.model(b_input_ids, token_type_ids=b_segment_ids, attention_mask=b_input_mask)
+                    validation_scheduler.step(global_step, self.timer)
+                    if validation_scheduler.should_stop:
+                        break
             
-            f1_score = self.f1_score_default_accuracy(logits, b_labels)
-            #print("F1-Score sklearn: {}".format(f1_score))
-            
-            logits = logits.detach().cpu().numpy()
-            label_ids = b_labels.to('cpu').numpy()
-            predictions.extend([list(p) for p in np.argmax(logits, axis=2)])
-            true_labels.append(label_ids)
-            
-            tmp_eval_accuracy = self.flat_accuracy(logits, label_ids)
+                if validation_scheduler.should_stop:
+                    logger.info("Stopped early at step {}".format(global_step))
+                    break
+                with self.timer.stage('metrics', host=True):
+                    self.log_train_metrics(global_step)
+                validation_scheduler.end_of_epoch(global_step)
+                if checkpoint_dir:
+                    with self.timer.stage('checkpoint', host=True):
+                        self.save_checkpoint(checkpointer, epoch + 1, 0, global_step)
+                self.log_stage_times(epoch, global_step)
+            validation_scheduler.close()
+        finally:
+            # Queued checkpoints are written even when training fails
+            if trace:
+                trace.close()
+            if checkpointer:
+                checkpointer.close()
+        self.writer.flush()
+    
+    def save_checkpoint(self, checkpointer, epoch, batch, global_step):
+        """ Queues a checkpoint of the run before batch `batch` of `epoch`.
+
+        Every process has to call it, the checkpoint holds the random states
+        of all processes and the train metrics summed over them. Only the
+        process with a checkpointer, rank 0, writes it.
+        """
+        rng_state = capture_rng_state()
+        rng_states = all_gather_object(rng_state)
+        epoch_rng_states = all_gather_object(self.epoch_rng_state if batch else rng_state)
+        # A checkpoint at the start of an epoch has no train metrics yet
+        train_metrics = self.train_metrics.reduced().state_dict() if batch else None
+        if checkpointer is None:
+            return
+        state = {'model': self.model.state_dict(), 'optimizer': self.optimizer.state_dict(),
+                 'scaler': self.scaler.state_dict(), 'train_metrics': train_metrics,
+                 'epoch': epoch, 'batch': batch, 'global_step': global_step,
+                 'rng_states': rng_states, 'epoch_rng_states': epoch_rng_states,
+                 'validation': self.validation_scheduler.state_dict(),
+                 'schedule': {'num_epochs': self.num_epochs, 'learning_rate': self.learning_rate,
+                              'warmup_proportion': self.warmup_proportion,
+                              'gradient_accumulation_steps': self.gradient_accumulation_steps}}
+        checkpointer.save(state, global_step + 1)
+    
+    def load_checkpoint(self, path):
+        """ Restores the model, optimizer and loss scale of a checkpoint and returns it """
+        checkpoint = load_checkpoint(path)
+        if checkpoint['schedule'] != {'num_epochs': self.num_epochs, 'learning_rate': self.learning_rate,
+                                      'warmup_proportion': self.warmup_proportion,
+                                      'gradient_accumulation_steps': self.gradient_accumulation_steps}:
+            logger.warning("Resuming with a different schedule than {}".format(checkpoint['schedule']))
+        self.model.load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        self.scaler.load_state_dict(checkpoint['scaler'])
+        # The summed train metrics are restored on one process so they are summed once
+        if checkpoint['train_metrics'] is not None and is_main_process():
+            self.train_metrics.load_state_dict(checkpoint['train_metrics'])
+        if len(checkpoint['rng_states']) != get_world_size():
+            logger.warning("Resuming {} processes from a checkpoint of {}".format(
+                get_world_size(), len(checkpoint['rng_states'])))
+        if checkpoint.get('validation') is not None:
+            self.validation_scheduler.load_state_dict(checkpoint['validation'])
+        rank = get_rank() if len(checkpoint['rng_states']) == get_world_size() else 0
+        checkpoint['rng_state'] = checkpoint['rng_states'][rank]
+        checkpoint['epoch_rng_state'] = checkpoint['epoch_rng_states'][rank]
+        logger.info("Resuming at epoch {} batch {}".format(checkpoint['epoch'], checkpoint['batch']))
+        return checkpoint
+    
+    def resume_batches(self, checkpoint):
+        """ Iterator over the train batches from the checkpointed batch on.
+
+        The random state of the start of the epoch is restored while the
+        iterator is created and the first batches are skipped, so a shuffling
+        sampler draws the same order, and the random state of the checkpoint
+        afterwards. A batch sampler with `skip`, e.g. BucketBatchSampler,
+        skips without loading the batches. A checkpoint at the start of an
+        epoch resumes like a fresh epoch, the iterator draws its seed from the
+        restored state and the state is not rewound over that draw.
+        """
+        self.epoch_rng_state = checkpoint['epoch_rng_state']
+        restore_rng_state(self.epoch_rng_state)
+        if not checkpoint['batch']:
+            return self.train_dataloader
+        batch_sampler = getattr(self.train_dataloader, 'batch_sampler', None)
+        skip_batches = checkpoint['batch']
+        if hasattr(batch_sampler, 'skip'):
+            batch_sampler.skip(skip_batches)
+            skip_batches = 0
+        iterator = iter(self.train_dataloader)
+        for _ in range(skip_batches):
+            next(iterator)
+        restore_rng_state(checkpoint['rng_state'])
+        return iterator
             
-        
-            eval_loss += tmp_eval_loss.mean().item()
-            eval_accuracy += tmp_eval_accuracy
+    def log_stage_times(self, epoch, global_step):
+        """ Logs the time spent in every stage of the epoch and its validation """
+        self.timer.log_metrics(self.writer, 'timing/train', global_step)
+        self.validation_timer.log_metrics(self.writer, 'timing/validation', global_step)
+        if is_main_process():
+            logger.info("Stage times of epoch {}\n{}\n{}".format(
+                epoch, self.timer.table('train'), self.validation_timer.table('validation')))
 
-            nb_eval_examples += b_input_ids.size(0)
-            nb_eval_steps += 1
-        
-        eval_loss = eval_loss/nb_eval_steps
-        eval_accuracy = eval_accuracy/nb_eval_steps
-        #print("Validation loss: {}".format(eval_loss))
-        #print("Validation Accuracy: {}".format(eval_accuracy))
-        pred_tags = [self.label_list[p_i] for p in predictions for p_i in p]
-        valid_tags = [self.label_list[l_ii] for l in true_labels for l_i in l for l_ii in l_i]
-        f1_score = f1_score_seqeval(pred_tags, valid_tags)
+    def log_train_metrics(self, global_step):
+        """ Logs the metrics accumulated since the start of the epoch """
+        metrics = self.train_metrics.reduced() if is_distributed() else self.train_metrics
+        f1_score = metrics.f1_score()
+        self.writer.add_scalar('train/accuracy', metrics.accuracy(), global_step)
+        self.writer.add_scalar('train/f1_score', f1_score, global_step)
+        self.writer.add_scalar('train/epoch_loss', metrics.loss(), global_step)
+        return f1_score
+  
+    def forward(self, batch, network=None):
+        """ Logits of a batch, packed batches from utils.packing carry position ids """
+        network = self.network if network is None else network
+        if len(batch) == 5:
+            input_ids, packed_mask, segment_ids, _, position_ids = batch
+            return network(input_ids, packed_mask, segment_ids, position_ids)
+        input_ids, input_mask, segment_ids, _ = batch
+        return network(input_ids, input_mask, segment_ids)
+
+    def training_loss(self, logits, batch):
+        """ Loss minimized by fit for the logits of a batch """
+        return self.loss(logits.float(), batch[3], batch[1])
+
+    def loss(self, logits, label_ids, input_mask=None, reduction='mean'):
+        """ Cross entropy loss, only over the non-padding positions of input_mask when it is given """
+        logits = logits.view(-1, self.model.num_labels)
+        label_ids = label_ids.view(-1)
+        if input_mask is not None:
+            active = input_mask.view(-1) != 0
+            logits, label_ids = logits[active], label_ids[active]
+        if reduction == 'sum':
+            return torch.nn.functional.cross_entropy(logits, label_ids, reduction='sum')
+        return self.loss_fct(logits, label_ids)
+    
+    def num_scored(self, label_ids, input_mask):
+        """ Number of positions a summed loss is over """
+        return (input_mask != 0).sum()
+    
+    def unused_parameters(self):
+        """ Name parts of the parameters the forward pass does not use, the pooler for token classification """
+        return ['pooler']
+
+    def create_metrics(self):
+        return NERMetrics(self.label_list, self.device)
+    
+    def validation(self, global_step):
+        self.validation_timer.reset()
+        metrics = self.evaluate(self.forward_module, self.validation_timer)
+        f1_score = metrics.f1_score()
         
-        self.writer.add_scalar('validation/loss', eval_loss, global_step)
-        self.writer.add_scalar('validation/accuracy', eval_accuracy, global_step)
+        self.writer.add_scalar('validation/loss', metrics.loss(), global_step)
+        self.writer.add_scalar('validation/accuracy', metrics.accuracy(), global_step)
         self.writer.add_scalar('validation/f1_score', f1_score, global_step)
-        print("Validation F1-Score: {}".format(f1_score))
+        if is_main_process():
+            print("Validation F1-Score: {}".format(f1_score))
+        return metrics
+    
+    def evaluate(self, network, timer=None, dataloader=None):
+        """ Metrics of a BatchForward network on the validation data, summed over all processes """
+        dataloader = dataloader if dataloader is not None else self.valid_dataloader
+        network.eval()
+        timer = timer if timer is not None else StageTimer(self.device, enabled=False)
+        metrics = self.create_metrics()
+        with torch.no_grad():
+            for batch in timer.iterate(self.prefetch(dataloader)):
+                with timer.stage('h2d'):
+                    batch = tuple(t.to(self.device) for t in batch)
+                b_input_mask, b_labels = batch[1], batch[3]
+                
+                # One forward pass, the loss is computed from the logits the same
+                # way the model does when given labels. The processes have
+                # different numbers of batches, so the model is not run through
+                # DistributedDataParallel.
+                with timer.stage('forward'):
+                    with self.autocast():
+                        logits = self.forward(batch, network)
+                    loss = self.loss(logits.float(), b_labels, b_input_mask, reduction='sum')
+                with timer.stage('metrics'):
+                    metrics.update(logits, b_labels, b_input_mask)
+                    metrics.add_loss(loss, self.num_scored(b_labels, b_input_mask))
+        
+        with timer.stage('metrics', host=True):
+            if is_distributed():
+                metrics = metrics.reduced()
+            metrics.f1_score()
+        return metrics
          
         
     def f1_score_default_accuracy(self, logits, label_ids):
@@ -179,6 +482,7 @@ class NERTrainer(object):
         
         if self.global_step == 0:
             print(np_logits.shape, np_label_ids.shape)
+        from seqeval.metrics import f1_score as f1_score_seqeval
         return f1_score_seqeval(pred_tags, valid_tags)
         
     def f1_score_accuracy(self, logits, label_ids):
@@ -186,6 +490,7 @@ class NERTrainer(object):
         np_label_ids = label_ids.to('cpu').numpy()
         pred_flat = np.argmax(np_logits, axis=2).flatten()
         labels_flat = np_label_ids.flatten()
+        from sklearn.metrics import f1_score as f1_score_sklearn
         return f1_score_sklearn(pred_flat, labels_flat, average='samples')
     
     # todo replace with accuracy function
@@ -201,13 +506,50 @@ class NERTrainer(object):
         labels_flat = np_label_ids.flatten()
         return np.sum(pred_flat == labels_flat) / len(labels_flat)
     
+    def set_epoch(self, epoch):
+        # Reshuffle length buckets, e.g. from utils.datasets.bucketed_dataloader
+        batch_sampler = getattr(self.train_dataloader, 'batch_sampler', None)
+        if hasattr(batch_sampler, 'set_epoch'):
+            batch_sampler.set_epoch(epoch)
+        # Reshuffle a DistributedSampler
+        sampler = getattr(self.train_dataloader, 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+        # Reseed the shuffle buffer of e.g. utils.datasets.StreamingBertDataset
+        dataset = getattr(self.train_dataloader, 'dataset', None)
+        if hasattr(dataset, 'set_epoch'):
+            dataset.set_epoch(epoch)
+
+    def prefetch(self, batches):
+        """ Batches loaded and copied to the device ahead, see utils.datasets.DevicePrefetcher """
+        if not self.prefetch_batches:
+            return batches
+        return DevicePrefetcher(batches, self.device, self.prefetch_batches)
+
+    def no_sync(self, skip_sync):
+        if skip_sync and isinstance(self.network, DistributedDataParallel):
+            return self.network.no_sync()
+        return contextlib.nullcontext()
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.fp16)
+
+    def steps_per_epoch(self):
+        """ Number of optimizer steps in an epoch """
+        accumulation_steps = getattr(self, 'gradient_accumulation_steps', 1)
+        return (loader_length(self.train_dataloader) + accumulation_steps - 1) // accumulation_steps
+
     def global_step(self, epoch, step):
-        return epoch * len(self.train_dataloader) + step
+        """ Index of the optimizer step that batch `step` of `epoch` contributes to """
+        accumulation_steps = getattr(self, 'gradient_accumulation_steps', 1)
+        return epoch * self.steps_per_epoch() + step // accumulation_steps
     
     def total_steps(self):
-        return self.num_epochs * len(self.train_dataloader)
+        return self.num_epochs * self.steps_per_epoch()
     
     def clip_grad_norm(self, max_grad_norm):
+        # Gradients are still multiplied by the loss scale until the scaler steps
+        self.scaler.unscale_(self.optimizer)
         torch.nn.utils.clip_grad_norm_(parameters = self.model.parameters(), max_norm=max_grad_norm)
         
     def update_learning_rate(self, global_step):
@@ -220,19 +562,17 @@ class NERTrainer(object):
         if x < warmup: return x/warmup
         return 1.0 - x
     
-    def create_optimizer(self, fp16=True, no_decay = ['bias', 'gamma', 'beta']):
-        # Remove unused pooler that otherwise break Apex
+    def create_optimizer(self, fp16=True, no_decay = ['bias', 'gamma', 'beta'], skip = ['pooler']):
+        # Mixed precision is handled by autocast and self.scaler, see __init__
         param_optimizer = list(self.model.named_parameters())
-        param_optimizer = [n for n in param_optimizer if 'pooler' not in n[0]]
+        param_optimizer = [n for n in param_optimizer if not any(sk in n[0] for sk in skip)]
         
         optimizer_grouped_parameters = [
             {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.02},
             {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
         ]
-        if fp16:
-            optimizer = FusedAdam(optimizer_grouped_parameters, lr=self.learning_rate, bias_correction=False, max_grad_norm=1.0)
-            optimizer = FP16_Optimizer(optimizer, dynamic_loss_scale=True)
-        else:
-            optimizer = Adam(optimizer_grouped_parameters, lr=self.learning_rate)
+        # The fused implementation runs the update in a few kernels on GPU
+        fused = self.device.type == 'cuda'
+        optimizer = Adam(optimizer_grouped_parameters, lr=self.learning_rate, fused=fused)
         return optimizer
         
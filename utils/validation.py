@@ -0,0 +1,344 @@
+# coding=utf-8
+# Copyright 2019 Arbetsförmedlingen AI-center.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import queue
+import logging
+import itertools
+import traceback
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+from .sinks import MetricsSink
+from .profiling import StageTimer
+from .checkpoint import AsyncCheckpointer, cpu_snapshot, capture_rng_state, restore_rng_state
+from .distributed import is_distributed, is_main_process
+
+logger = logging.getLogger(__name__)
+
+
+class SubsampleLoader(object):
+    """ DataLoaders over `num_batches` batches of a validation DataLoader.
+
+    The batches are drawn in a random order fixed by `seed`, since the
+    batches of a bucketed dataloader are sorted by length. A fixed subsample
+    is the same batches every time, so its scores are comparable between
+    validations. A rotating subsample moves on to the next batches every
+    time and covers the whole validation set every
+    len(dataloader) / num_batches validations. A dataloader over an
+    IterableDataset only supports a fixed subsample of its first batches.
+
+    Args:
+        dataloader: DataLoader of the full validation set
+        num_batches: number of batches in a subsample
+        rotate: use the next batches on every call
+        seed: seed of the batch order
+    """
+
+    def __init__(self, dataloader, num_batches, rotate=False, seed=0):
+        self.dataloader = dataloader
+        self.num_batches = num_batches
+        self.rotate = rotate
+        self.offset = 0
+        if isinstance(dataloader.dataset, IterableDataset):
+            if rotate:
+                raise ValueError("A rotating subsample needs a dataset with random access")
+            self.batches = None
+        else:
+            batches = list(dataloader.batch_sampler)
+            self.batches = [batches[i] for i in np.random.RandomState(seed).permutation(len(batches))]
+
+    def next(self):
+        if self.batches is None:
+            return itertools.islice(self.dataloader, self.num_batches)
+        count = min(self.num_batches, len(self.batches))
+        if self.rotate:
+            batches = [self.batches[(self.offset + i) % len(self.batches)] for i in range(count)]
+            self.offset = (self.offset + count) % len(self.batches)
+        else:
+            batches = self.batches[:count]
+        loader = self.dataloader
+        return DataLoader(loader.dataset, batch_sampler=batches, collate_fn=loader.collate_fn,
+                          num_workers=loader.num_workers, pin_memory=loader.pin_memory)
+
+
+class ValidationScheduler(object):
+    """ Decides when NERTrainer.fit validates and on what, and acts on the results.
+
+    By default the model is validated on the full validation set at the end
+    of every epoch, like fit always did. With `interval` it is also validated
+    every `interval` optimizer steps, on a subsample of `subsample_batches`
+    batches when given, see SubsampleLoader. Full results are logged as
+    `validation/` scalars and subsample results as `validation_subsample/`.
+
+    With `asynchronous` the full validations run in a worker process. fit
+    copies the weights to CPU memory, queues the copy and continues
+    training, and the results are logged under the step of the weights they
+    were taken at once the worker returns them. At most `max_pending`
+    snapshots wait for the worker, fit blocks on the oldest beyond that. In
+    distributed mode every process validates its shard, so validation stays
+    synchronous there.
+
+    The `metric` of the `monitor` validations, 'full' or 'subsample', drives
+    early stopping after `patience` validations without an improvement of
+    more than `min_delta`, and with `best_dir` the weights of the best
+    validation are written to best_dir/checkpoint-<step>.pt, replacing the
+    previous best.
+
+    Args:
+        interval: (Optional) optimizer steps between two validations during an epoch
+        subsample_batches: (Optional) number of batches the interval validations run on
+        rotate: rotate the subsample instead of using the same batches every time
+        epoch_end: validate on the full validation set at the end of every epoch
+        asynchronous: run full validations in a worker process
+        worker_device: (Optional) device of the worker, the device of the trainer by default
+        max_pending: number of snapshots waiting for the worker before fit blocks
+        metric: 'f1_score', 'accuracy' or 'loss'
+        mode: (Optional) 'max' or 'min', 'min' for the loss and 'max' otherwise
+        monitor: 'full' or 'subsample', the validations early stopping and best_dir follow
+        patience: (Optional) validations without improvement before training stops
+        min_delta: smallest change of the metric that counts as an improvement
+        best_dir: (Optional) directory of the checkpoint of the best weights
+        seed: seed of the subsample batch order
+    """
+
+    def __init__(self, interval=None, subsample_batches=None, rotate=False, epoch_end=True, asynchronous=False,
+                 worker_device=None, max_pending=1, metric='f1_score', mode=None, monitor='full', patience=None,
+                 min_delta=0.0, best_dir=None, seed=0):
+        if monitor not in ('full', 'subsample'):
+            raise ValueError("Unknown monitor {}".format(monitor))
+        if monitor == 'subsample' and not (interval and subsample_batches):
+            raise ValueError("monitor='subsample' needs an interval and subsample_batches")
+        self.interval = interval
+        self.subsample_batches = subsample_batches
+        self.rotate = rotate
+        self.epoch_end = epoch_end
+        self.asynchronous = asynchronous
+        self.worker_device = worker_device
+        self.max_pending = max_pending
+        self.metric = metric
+        self.mode = mode if mode is not None else ('min' if metric == 'loss' else 'max')
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_dir = best_dir
+        self.seed = seed
+
+        self.trainer = None
+        self.subsample = None
+        self.best_score = None
+        self.best_step = None
+        self.num_bad_validations = 0
+        self.should_stop = False
+        self.pending = {}
+        self.last_full_step = None
+        self._checkpointer = None
+        self._worker = None
+
+    def start(self, trainer):
+        """ Prepares the subsample and starts the worker process for a fit of `trainer` """
+        self.trainer = trainer
+        self.should_stop = False
+        if self.interval and self.subsample_batches:
+            offset = self.subsample.offset if self.subsample is not None else 0
+            self.subsample = SubsampleLoader(trainer.valid_dataloader, self.subsample_batches, self.rotate, self.seed)
+            self.subsample.offset = offset
+        if self.best_dir and is_main_process() and self._checkpointer is None:
+            self._checkpointer = AsyncCheckpointer(self.best_dir, keep_last=1)
+        if self.asynchronous and is_distributed():
+            logger.warning("Asynchronous validation is not supported in distributed mode, validating synchronously")
+            self.asynchronous = False
+        if self.asynchronous and self._worker is None:
+            self._start_worker()
+
+    def step(self, global_step, timer=None):
+        """ Called by fit after every optimizer step """
+        timer = timer if timer is not None else StageTimer(self.trainer.device, enabled=False)
+        if self.pending:
+            self.poll()
+        if self.interval and (global_step + 1) % self.interval == 0:
+            # Iterating a DataLoader draws from the random state, which is
+            # restored so the training run does not depend on the interval
+            rng_state = capture_rng_state()
+            with timer.stage('validation', host=True):
+                self.validate(global_step, full=self.subsample is None)
+            restore_rng_state(rng_state)
+
+    def end_of_epoch(self, global_step):
+        """ Called by fit at the end of every epoch """
+        # An interval validation of the full set may just have run
+        if self.epoch_end and self.last_full_step != global_step:
+            self.validate(global_step, full=True)
+        if self.pending:
+            self.poll()
+
+    def validate(self, global_step, full=True):
+        trainer = self.trainer
+        if full:
+            self.last_full_step = global_step
+        if full and self.asynchronous:
+            self._submit(global_step)
+            return
+        training = trainer.model.training
+        if full:
+            summary = _summary(trainer.validation(global_step))
+        else:
+            metrics = trainer.evaluate(trainer.forward_module, dataloader=self.subsample.next())
+            summary = _summary(metrics)
+            for name, value in summary.items():
+                trainer.writer.add_scalar('validation_subsample/{}'.format(name), value, global_step)
+        trainer.model.train(training)
+        if self.monitor == ('full' if full else 'subsample'):
+            self._update(global_step, summary)
+
+    def poll(self, block=False):
+        """ Logs the results the worker has returned, with `block` waits for all pending ones """
+        while self.pending:
+            result = self._next_result(block)
+            if result is None:
+                return
+            self._log_result(*result)
+
+    def close(self):
+        """ Waits for the pending validations and stops the worker """
+        if self._worker is not None:
+            self.poll(block=True)
+            self._requests.put(None)
+            self._worker.join()
+            self._worker = None
+        if self._checkpointer is not None:
+            self._checkpointer.close()
+            self._checkpointer = None
+
+    def state_dict(self):
+        return {'best_score': self.best_score, 'best_step': self.best_step,
+                'num_bad_validations': self.num_bad_validations,
+                'subsample_offset': self.subsample.offset if self.subsample is not None else 0}
+
+    def load_state_dict(self, state):
+        self.best_score = state['best_score']
+        self.best_step = state['best_step']
+        self.num_bad_validations = state['num_bad_validations']
+        if self.subsample is not None:
+            self.subsample.offset = state['subsample_offset']
+
+    def _update(self, global_step, summary, state=None):
+        score = summary[self.metric]
+        if self.best_score is None or self._improved(score):
+            self.best_score, self.best_step = score, global_step
+            self.num_bad_validations = 0
+            if self._checkpointer is not None:
+                if state is None:
+                    state = self.trainer.model.state_dict()
+                self._checkpointer.save({'model': state, 'global_step': global_step, 'metrics': summary},
+                                        global_step + 1)
+        else:
+            self.num_bad_validations += 1
+            if self.patience is not None and self.num_bad_validations >= self.patience:
+                logger.info("Early stopping, no improvement of validation {} since step {}".format(
+                    self.metric, self.best_step))
+                self.should_stop = True
+
+    def _improved(self, score):
+        if self.mode == 'max':
+            return score > self.best_score + self.min_delta
+        return score < self.best_score - self.min_delta
+
+    def _submit(self, global_step):
+        # The worker validates in order, so the next result is the oldest pending one
+        while len(self.pending) >= self.max_pending:
+            self._log_result(*self._next_result(block=True))
+        state = cpu_snapshot(self.trainer.model.state_dict())
+        self.pending[global_step] = state
+        self._requests.put((global_step, state))
+
+    def _next_result(self, block):
+        while True:
+            try:
+                return self._results.get(block=block, timeout=1.0 if block else None)
+            except queue.Empty:
+                if not block:
+                    return None
+                if not self._worker.is_alive():
+                    raise RuntimeError("The validation worker exited with code {}".format(self._worker.exitcode))
+
+    def _log_result(self, global_step, summary, error):
+        if error is not None:
+            raise RuntimeError("Validation of step {} failed in the worker:\n{}".format(global_step, error))
+        state = self.pending.pop(global_step)
+        for name, value in summary.items():
+            self.trainer.writer.add_scalar('validation/{}'.format(name), value, global_step)
+        if is_main_process():
+            print("Validation F1-Score of step {}: {}".format(global_step, summary['f1_score']))
+        if self.monitor == 'full':
+            self._update(global_step, summary, state)
+
+    def _start_worker(self):
+        trainer = self.trainer
+        device = torch.device(self.worker_device) if self.worker_device is not None else trainer.device
+        context = torch.multiprocessing.get_context('spawn')
+        self._requests = context.Queue()
+        self._results = context.Queue()
+        self._worker = context.Process(target=_validation_worker, name='ValidationWorker',
+                                       args=(_evaluation_copy(trainer, device), self._requests, self._results),
+                                       daemon=True)
+        self._worker.start()
+        logger.info("Started a validation worker on {}".format(device))
+
+
+# Attributes of a trainer a validation worker does not need, besides
+# modules other than the model, optimizers, writers and timers
+_TRAINING_ATTRIBUTES = ('train_dataloader', 'train_metrics', 'epoch_rng_state')
+_TRAINING_TYPES = (torch.nn.Module, torch.optim.Optimizer, torch.amp.GradScaler, MetricsSink, StageTimer,
+                   ValidationScheduler)
+
+
+def _evaluation_copy(trainer, device):
+    """ Picklable copy of a trainer with what evaluate() needs, its model copied to CPU memory """
+    evaluator = copy.copy(trainer)
+    evaluator.__dict__ = {name: value for name, value in vars(trainer).items()
+                          if name not in _TRAINING_ATTRIBUTES and not isinstance(value, _TRAINING_TYPES)}
+    # The tensors are copied to CPU before the module is, so the copy does not
+    # take device memory
+    tensors = list(trainer.model.parameters()) + list(trainer.model.buffers())
+    memo = {id(t): torch.nn.Parameter(t.detach().cpu().clone(), requires_grad=False)
+            if isinstance(t, torch.nn.Parameter) else t.detach().cpu().clone() for t in tensors}
+    evaluator.model = copy.deepcopy(trainer.model, memo)
+    evaluator.forward_module = type(trainer.forward_module)(evaluator.model)
+    if device.type != trainer.device.type:
+        evaluator.amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    evaluator.device = device
+    return evaluator
+
+
+def _validation_worker(evaluator, requests, results):
+    evaluator.model.to(evaluator.device)
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        global_step, state = request
+        try:
+            evaluator.model.load_state_dict(state)
+            del state
+            results.put((global_step, _summary(evaluator.evaluate(evaluator.forward_module)), None))
+        except Exception:
+            results.put((global_step, None, traceback.format_exc()))
+
+
+def _summary(metrics):
+    return {'loss': float(metrics.loss()), 'accuracy': float(metrics.accuracy()),
+            'f1_score': float(metrics.f1_score())}